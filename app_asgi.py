@@ -0,0 +1,539 @@
+"""
+ASGI serving mode for the text-to-image app
+
+Serves the routes of app_hf.py on asyncio with Quart. Generation jobs are
+tasks that talk to Ollama and Automatic1111 through httpx, and CPU-bound
+work (PIL decoding, encoding and rendering, storage calls) runs in a small
+thread pool, so one process can hold hundreds of waiting requests and
+jobs without a thread for each. Configuration, caches and storage are
+shared with app_hf.py.
+
+Run it with an ASGI server:
+
+    hypercorn app_asgi:app --bind 0.0.0.0:5000
+"""
+import os
+import json
+import time
+import asyncio
+import functools
+from contextlib import asynccontextmanager, AsyncExitStack
+from concurrent.futures import ThreadPoolExecutor
+from quart import Quart, Response, render_template, request, url_for, redirect, abort, send_file
+import app_hf
+from app_hf import (
+    MODELS, DEFAULT_MODEL, DEFAULT_PRESET, PROMPT_GENERATOR_MODEL, TXT2IMG_CHUNK_SIZE, OLLAMA_STREAMING,
+    PROGRESS_POLL_INTERVAL, A1111_PROGRESS_PARAMS, MAX_BATCH_PROMPTS, IMAGE_OFFLOAD_PREFIX, STAGE_SECONDS,
+    storage, prompt_cache_key, ollama_pool, sd_pool, has_model, has_checkpoint, check_sd_api_available,
+    known_enhanced_prompt, store_enhanced_prompt, ollama_payload, parse_ollama_line, add_token,
+    txt2img_payload, txt2img_size_hint, txt2img_images, a1111_progress_fields,
+    model_unavailable_response, plan_diffusion_results, fill_results, unsupported_model_results, save_results,
+    generation_response, generation_error_response, generation_cache_key, generation_manifest, lookup_result,
+    cached_response, create_text_image, image_etag, image_content_type, image_delivery, with_image_headers,
+    index_context, job_result, job_group, replay_arguments, model_pull_response, model_status_response,
+    parse_size, parse_num_images, parse_preset, parse_seed
+)
+from utils.http_clients import AsyncBackendClient
+from utils.job_queue import AsyncJobQueue, QueueFullError, JobCancelled, current_job
+from utils.json_images import Base64ArrayParser
+from utils.renderers import text_image_capacity
+from utils import metrics
+
+# Threads for CPU-bound PIL work and blocking storage calls
+ASGI_EXECUTOR_THREADS = int(os.environ.get('ASGI_EXECUTOR_THREADS', '4'))
+executor = ThreadPoolExecutor(max_workers=ASGI_EXECUTOR_THREADS)
+
+app = Quart(__name__)
+app.config['SECRET_KEY'] = app_hf.app.config['SECRET_KEY']
+
+# Jobs waiting on a backend are cheap here, so more of them may run at once
+generation_queue = AsyncJobQueue(
+    workers=int(os.environ.get('ASGI_GENERATION_WORKERS', '16')),
+    max_pending=app_hf.GENERATION_QUEUE_SIZE,
+    result_ttl=app_hf.JOB_RESULT_TTL
+)
+
+# Report this app's queue on /metrics instead of app_hf's thread queue
+app_hf.report_queue(generation_queue)
+
+# Enhancements in flight, so concurrent requests for a prompt share one completion
+_enhancements = {}
+
+@app.before_serving
+async def open_clients():
+    """Give every backend server an async client; they belong to the server's event loop"""
+    for pool in (ollama_pool, sd_pool):
+        for node in pool.nodes:
+            node.async_client = AsyncBackendClient(node.url, name=pool.name, timeouts=node.client.timeouts)
+
+@app.after_serving
+async def close_clients():
+    for pool in (ollama_pool, sd_pool):
+        for node in pool.nodes:
+            await node.async_client.aclose()
+    executor.shutdown(wait=False)
+
+async def run_sync(func, *args, **kwargs):
+    """Run a blocking function in the executor"""
+    return await asyncio.get_running_loop().run_in_executor(executor, functools.partial(func, *args, **kwargs))
+
+@asynccontextmanager
+async def checkpoint_lease(node, model_name):
+    """
+    Async form of node.checkpoints.use()
+
+    Waiting for other checkpoints and switching run on a thread of the
+    default executor, so they never occupy the PIL executor.
+    """
+    loop = asyncio.get_running_loop()
+    lease = node.checkpoints.use(model_name)
+    entered = loop.run_in_executor(None, lease.__enter__)
+    try:
+        await asyncio.shield(entered)
+    except asyncio.CancelledError:
+        # Give the lease back as soon as the thread has taken it
+        entered.add_done_callback(lambda _: loop.run_in_executor(None, lease.__exit__, None, None, None))
+        raise
+    try:
+        yield
+    finally:
+        await loop.run_in_executor(None, lease.__exit__, None, None, None)
+
+async def ollama_generate(model_name, prompt, timeout=None, on_text=None, max_chars=None):
+    """Async form of app_hf.ollama_generate()"""
+    if timeout is None:
+        timeout = ollama_pool.timeout_for("/api/generate")
+    payload = ollama_payload(model_name, prompt, OLLAMA_STREAMING)
+
+    if not OLLAMA_STREAMING:
+        response = await ollama_pool.call_async(
+            lambda node: node.async_client.post("/api/generate", json=payload, timeout=timeout),
+            prefer=has_model(model_name)
+        )
+        if response.status_code != 200:
+            raise Exception(f"API error: {response.status_code}, {response.text}")
+        return response.json().get("response", "")
+
+    async def read():
+        text = ""
+        # Leaving the block early closes the connection, which stops Ollama
+        async with AsyncExitStack() as stack, ollama_pool.open_async(
+            lambda node: stack.enter_async_context(
+                node.async_client.stream("POST", "/api/generate", json=payload, timeout=timeout)
+            ),
+            prefer=has_model(model_name)
+        ) as response:
+            if response.status_code != 200:
+                await response.aread()
+                raise Exception(f"API error: {response.status_code}, {response.text}")
+            async for line in response.aiter_lines():
+                if not line:
+                    continue
+                token, done = parse_ollama_line(line)
+                if token:
+                    text, enough = add_token(text, token, model_name, on_text, max_chars)
+                    if enough:
+                        break
+                if done:
+                    break
+        return text
+
+    # The timeout bounds the whole completion
+    return await asyncio.wait_for(read(), timeout)
+
+async def enhance_prompt_with_generator(prompt, model_name=PROMPT_GENERATOR_MODEL):
+    """Async form of app_hf.enhance_prompt_with_generator()"""
+    enhanced_prompt = await run_sync(known_enhanced_prompt, prompt, model_name)
+    if enhanced_prompt is not None:
+        return enhanced_prompt
+
+    key = prompt_cache_key(prompt, model_name)
+    future = _enhancements.get(key)
+    if future is None:
+        future = asyncio.ensure_future(request_enhanced_prompt(prompt, model_name, current_job()))
+        _enhancements[key] = future
+        future.add_done_callback(lambda _: _enhancements.pop(key, None))
+    # A cancelled waiter must not cancel the completion other requests share
+    enhanced_prompt = await asyncio.shield(future)
+    return enhanced_prompt or prompt
+
+async def request_enhanced_prompt(prompt, model_name, job=None):
+    """Ask the prompt generator model to enhance a prompt; returns None on failure"""
+    def forward(text):
+        if job:
+            job.update_progress(stage='enhancing', text=text)
+
+    try:
+        completion = await ollama_generate(model_name, prompt, timeout=30, on_text=forward)
+        return await run_sync(store_enhanced_prompt, prompt, model_name, completion)
+    except Exception as e:
+        print(f"❌ Error using prompt generator: {str(e)}")
+        return None
+
+async def watch_progress(client, job):
+    """Poll Automatic1111's progress endpoint into the job's progress until cancelled"""
+    while True:
+        await asyncio.sleep(PROGRESS_POLL_INTERVAL)
+        try:
+            response = await client.get("/sdapi/v1/progress", params=A1111_PROGRESS_PARAMS, timeout=5)
+            if response.status_code != 200:
+                continue
+            progress = response.json()
+        except Exception:
+            continue
+        job.update_progress(**a1111_progress_fields(progress))
+
+async def interrupt_a1111(client):
+    try:
+        await client.post("/sdapi/v1/interrupt", timeout=5)
+    except Exception as e:
+        print(f"⚠️ Error interrupting Automatic1111: {str(e)}")
+
+async def txt2img(client, prompt, width, height, num_images=1, preset=DEFAULT_PRESET, seed=-1):
+    """Async form of app_hf._txt2img(); returns the generated PNG files as bytes-like objects"""
+    payload = txt2img_payload(prompt, width, height, num_images, preset, seed)
+
+    job = current_job()
+    watcher = asyncio.ensure_future(watch_progress(client, job)) if job else None
+    try:
+        with STAGE_SECONDS.time(stage='sampling'):
+            async with client.stream("POST", "/sdapi/v1/txt2img", json=payload) as response:
+                if response.status_code != 200:
+                    await response.aread()
+                    print(f"❌ Error from Automatic1111 API: {response.status_code}, {response.text}")
+                    raise Exception(f"API error: {response.text}")
+
+                # Decode the images as they arrive, into buffers sized from the body
+                parser = Base64ArrayParser(size_hint=txt2img_size_hint(response.headers, payload))
+                encoded_images = []
+                # Read the whole body so the connection can be reused
+                async for chunk in response.aiter_bytes(TXT2IMG_CHUNK_SIZE):
+                    encoded_images.extend(parser.feed(chunk))
+                parser.close()
+    except asyncio.CancelledError:
+        # Nobody is waiting for these images any more
+        asyncio.ensure_future(interrupt_a1111(client))
+        raise
+    finally:
+        if watcher:
+            watcher.cancel()
+
+    return txt2img_images(encoded_images, payload, num_images)
+
+async def generate_a1111(prompt_requests, width, height, model_name, preset=DEFAULT_PRESET):
+    """Run txt2img for (prompt, count, seed) requests under one checkpoint lease; see app_hf._generate_a1111()"""
+    if not await run_sync(check_sd_api_available):
+        raise Exception("Automatic1111 API is not available")
+
+    async def generate_on(node):
+        images = []
+        async with checkpoint_lease(node, model_name):
+            for prompt, count, seed in prompt_requests:
+                images.append(await txt2img(node.async_client, prompt, width, height, count, preset, seed))
+        return images
+
+    return await sd_pool.call_async(generate_on, prefer=has_checkpoint(model_name))
+
+async def generate_image_with_llava(prompt, model_name="llava", width=512, height=512):
+    """Async form of app_hf.generate_image_with_llava()"""
+    job = current_job()
+
+    def forward(text):
+        # Show the description to the client while it is being written
+        if job:
+            job.update_progress(stage='describing', text=text)
+
+    try:
+        with STAGE_SECONDS.time(stage='describe'):
+            description = await ollama_generate(
+                model_name,
+                f"Generate a detailed description of what an image of '{prompt}' would look like. Make it detailed and vivid.",
+                on_text=forward,
+                # Anything beyond what the text image can show is wasted
+                max_chars=text_image_capacity(width)
+            )
+        return await run_sync(create_text_image, prompt, description, width, height)
+    except Exception as e:
+        print(f"❌ Error generating with LLaVA: {str(e)}")
+        raise
+
+async def run_generation(prompt, model_name, width, height, num_images=1, preset=DEFAULT_PRESET, seed=None,
+                         enhanced_prompt=None):
+    """Async form of app_hf.run_generation()"""
+    enhanced_prompts = [enhanced_prompt] if enhanced_prompt else None
+    return await run_batch_generation([prompt], model_name, width, height, num_images, preset, seed, enhanced_prompts)
+
+async def run_batch_generation(prompts, model_name, width, height, num_images=1, preset=DEFAULT_PRESET, seed=None,
+                               enhanced_prompts=None):
+    """
+    Async form of app_hf.run_batch_generation()
+
+    Returns the same (response, status_code) tuple. Concurrent requests
+    are not fused into one backend call here; each job makes its own.
+    """
+    with STAGE_SECONDS.time(stage='total'):
+        job = current_job()
+        if job:
+            STAGE_SECONDS.observe(job.started_at - job.created_at, stage='queue_wait')
+
+        try:
+            unavailable = await run_sync(model_unavailable_response, model_name)
+            if unavailable:
+                return unavailable
+
+            print(f"Generating {num_images} image(s) for {len(prompts)} prompt(s) using model: {model_name}")
+            model_type = MODELS.get(model_name, {}).get("type", "unknown")
+            timestamp = int(time.time())
+
+            if model_type == "diffusion":
+                if job:
+                    job.update_progress(stage='enhancing')
+                if not enhanced_prompts:
+                    with STAGE_SECONDS.time(stage='enhance'):
+                        enhanced_prompts = await asyncio.gather(
+                            *[enhance_prompt_with_generator(prompt) for prompt in prompts]
+                        )
+
+                results, pending = await run_sync(
+                    plan_diffusion_results, prompts, enhanced_prompts, model_name, width, height, num_images, seed,
+                    preset
+                )
+                if pending:
+                    if job:
+                        job.check_cancelled()
+                        job.update_progress(stage='sampling')
+                    prompt_requests = [(prompt, num_images, prompt_seed) for prompt, prompt_seed in pending]
+                    images = await generate_a1111(prompt_requests, width, height, model_name, preset)
+                    fill_results(results, [image for prompt_images in images for image in prompt_images])
+            elif model_type == "multimodal":
+                results = []
+                for prompt in prompts:
+                    key = generation_cache_key(prompt, None, model_name, width, height)
+                    cached = await run_sync(lookup_result, key)
+                    if cached:
+                        results.append([prompt, key, None, cached])
+                        continue
+                    if job:
+                        job.update_progress(stage='describing')
+                    image = await generate_image_with_llava(prompt, model_name, width, height)
+                    results.append([prompt, key, image, generation_manifest(prompt, None, model_name, width, height)])
+            else:
+                results = await run_sync(unsupported_model_results, prompts, model_type, width, height)
+
+            # Don't keep results nobody is waiting for
+            if job:
+                job.check_cancelled()
+                job.update_progress(stage='saving')
+
+            return generation_response(await run_sync(save_results, results), timestamp)
+
+        except (JobCancelled, asyncio.CancelledError):
+            raise
+        except Exception as e:
+            return await run_sync(generation_error_response, e, prompts[0], width, height)
+
+@app.route('/')
+async def index():
+    """Render the main page"""
+    # Event streams hold no thread here, so the page always uses them
+    context = dict(await run_sync(index_context), job_events=True)
+    return await render_template('index_ollama.html', **context)
+
+def queue_full_response(error):
+    """Tell the client to retry later because the job queue is full"""
+    return {'success': False, 'error': str(error)}, 503, {'Retry-After': '5'}
+
+def job_accepted_response(job):
+    """Return the 202 response pointing the client at a queued job"""
+    return {
+        'success': True,
+        'job_id': job.id,
+        'status': job.status,
+        'status_url': url_for('get_job_status', job_id=job.id),
+        'result_url': url_for('get_job_result', job_id=job.id)
+    }, 202
+
+@app.route('/generate', methods=['POST'])
+async def generate():
+    """Queue an image generation job and return its id immediately"""
+    form = await request.form
+    prompt = form.get('prompt', '')
+    if not prompt:
+        return {'success': False, 'error': 'No prompt provided'}, 400
+
+    model_name = form.get('model', DEFAULT_MODEL)
+    size = parse_size(form.get('size', '512x512'))
+    if size is None:
+        return {'success': False, 'error': 'Invalid size, expected WIDTHxHEIGHT'}, 400
+    width, height = size
+    num_images = parse_num_images(form.get('num_images', 1))
+    preset = parse_preset(form.get('preset'), model_name)
+    seed = parse_seed(form.get('seed'))
+
+    # Answer repeat requests straight from the cache without queueing
+    response = await run_sync(cached_response, prompt, model_name, width, height, num_images, preset, seed)
+    if response:
+        return response
+
+    try:
+        job = generation_queue.submit(
+            run_generation, prompt, model_name, width, height, num_images, preset, seed, group=job_group(model_name)
+        )
+    except QueueFullError as e:
+        return queue_full_response(e)
+    return job_accepted_response(job)
+
+@app.route('/generate_batch', methods=['POST'])
+async def generate_batch():
+    """Queue a batched generation job; see app_hf.generate_batch()"""
+    data = await request.get_json(silent=True) or {}
+    prompts = [p for p in data.get('prompts', []) if isinstance(p, str) and p.strip()]
+
+    if not prompts:
+        return {'success': False, 'error': 'No prompts provided'}, 400
+    if len(prompts) > MAX_BATCH_PROMPTS:
+        return {'success': False, 'error': f"At most {MAX_BATCH_PROMPTS} prompts per batch"}, 400
+
+    model_name = data.get('model', DEFAULT_MODEL)
+    size = parse_size(data.get('size', '512x512'))
+    if size is None:
+        return {'success': False, 'error': 'Invalid size, expected WIDTHxHEIGHT'}, 400
+    width, height = size
+    num_images = parse_num_images(data.get('num_images', 1))
+    preset = parse_preset(data.get('preset'), model_name)
+    seed = parse_seed(data.get('seed'))
+
+    try:
+        job = generation_queue.submit(
+            run_batch_generation, prompts, model_name, width, height, num_images, preset, seed,
+            group=job_group(model_name)
+        )
+    except QueueFullError as e:
+        return queue_full_response(e)
+    return job_accepted_response(job)
+
+@app.route('/replay', methods=['POST'])
+async def replay():
+    """Queue a job that regenerates an image from its manifest; see app_hf.replay()"""
+    arguments = replay_arguments(await request.get_json(silent=True) or {})
+    if arguments is None:
+        return {'success': False, 'error': 'Missing or invalid manifest or size'}, 400
+
+    try:
+        job = generation_queue.submit(run_generation, group=job_group(arguments['model_name']), **arguments)
+    except QueueFullError as e:
+        return queue_full_response(e)
+    return job_accepted_response(job)
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+async def get_job_status(job_id):
+    """Get the status of a generation job"""
+    job = generation_queue.get(job_id)
+    if job is None:
+        return {'success': False, 'error': f"Unknown job: {job_id}"}, 404
+
+    status = job.to_dict()
+    status['success'] = True
+    status['queue_position'] = generation_queue.position(job)
+    return status
+
+@app.route('/jobs/<job_id>/result', methods=['GET'])
+async def get_job_result(job_id):
+    """Get the result of a generation job, or 202 while it is still running"""
+    job = generation_queue.get(job_id)
+    if job is None:
+        return {'success': False, 'error': f"Unknown job: {job_id}"}, 404
+    return job_result(job, generation_queue)
+
+@app.route('/jobs/<job_id>/events', methods=['GET'])
+async def stream_job_events(job_id):
+    """Stream a job's progress as Server-Sent Events, ending with its result"""
+    job = generation_queue.get(job_id)
+    if job is None:
+        return {'success': False, 'error': f"Unknown job: {job_id}"}, 404
+
+    async def events():
+        version = None
+        last_sent = 0
+        while not job.done:
+            if job.progress_version != version:
+                version = job.progress_version
+                last_sent = time.time()
+                state = dict(job.progress, status=job.status,
+                             queue_position=generation_queue.position(job))
+                yield f"event: progress\ndata: {json.dumps(state)}\n\n".encode("utf-8")
+            elif time.time() - last_sent > 15:
+                # Keep idle connections from being closed by proxies
+                last_sent = time.time()
+                yield b": keep-alive\n\n"
+            await asyncio.sleep(0.25)
+
+        response, status_code = job_result(job, generation_queue)
+        yield f"event: result\ndata: {json.dumps(dict(response, status_code=status_code))}\n\n".encode("utf-8")
+
+    response = Response(events(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'  # Stop nginx from buffering the stream
+    })
+    response.timeout = None  # The stream lasts as long as the job
+    return response
+
+@app.route('/jobs/<job_id>/cancel', methods=['POST'])
+async def cancel_job(job_id):
+    """Cancel a queued or running generation job"""
+    if not generation_queue.cancel(job_id):
+        return {'success': False, 'error': f"Job {job_id} is unknown or already finished"}, 404
+    return {'success': True, 'job_id': job_id}
+
+@app.route('/pull_model/<model_name>', methods=['POST'])
+async def start_model_pull(model_name):
+    """Start pulling a model"""
+    return await run_sync(model_pull_response, model_name)
+
+@app.route('/model_status/<model_name>', methods=['GET'])
+async def get_model_status(model_name):
+    """Get the status of a model"""
+    return await run_sync(model_status_response, model_name)
+
+@app.route('/metrics')
+async def metrics_endpoint():
+    """Expose pipeline metrics in the Prometheus text format"""
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+@app.route('/image/<path:filename>')
+async def serve_image(filename):
+    """Serve a stored image through the storage backend; see app_hf.serve_image()"""
+    url = storage.url(filename)
+    if url:
+        return redirect(url)
+
+    etag = await run_sync(image_etag, filename)
+    if etag is None:
+        abort(404)
+
+    content_type = image_content_type(filename)
+    delivery = image_delivery(etag, request.if_none_match)
+    if delivery == 'not_modified':
+        response = Response(b'', status=304)
+    elif delivery == 'offload':
+        # nginx sends the file from an internal location
+        response = Response(b'', mimetype=content_type)
+        response.headers['X-Accel-Redirect'] = IMAGE_OFFLOAD_PREFIX + filename
+    elif delivery == 'local':
+        # Handles Range requests
+        response = await send_file(storage.path(filename), mimetype=content_type, conditional=True)
+    else:
+        def read_object():
+            body = storage.open(filename)
+            try:
+                return body.read()
+            finally:
+                body.close()
+
+        try:
+            body = await run_sync(read_object)
+        except FileNotFoundError:
+            abort(404)
+        response = Response(body, mimetype=content_type)
+
+    return with_image_headers(response, etag)
@@ -3,18 +3,36 @@ Advanced Flask application for text-to-image generation
 Using Ollama for LLMs and Automatic1111 API for Stable Diffusion
 """
 import os
-import uuid
+import re
+import random
+import hashlib
 import time
 import json
 import requests
 import subprocess
-import base64
 import threading
 import tempfile
+import traceback
 from io import BytesIO
-from flask import Flask, render_template, request, jsonify, url_for, send_from_directory
-from PIL import Image, ImageDraw, ImageFont
+from flask import Flask, Response, render_template, request, jsonify, url_for, send_from_directory, redirect, abort
+from PIL import Image
 from dotenv import load_dotenv
+from utils.job_queue import JobQueue, JobStore, QueueFullError, JobCancelled, current_job
+from utils.status_cache import StatusCache
+from utils.checkpoints import CheckpointManager
+from utils.http_clients import BackendClient
+from utils.backend_pool import BackendPool, parse_hosts
+from utils.result_cache import ResultCache, cache_key, normalize_prompt
+from utils.storage import LocalStorage, StorageGC, create_storage, shard_name, collect, CONTENT_TYPES
+from utils.prompt_cache import PromptCache
+from utils.model_pulls import PullManager
+from utils.singleflight import SingleFlight
+from utils.batch_scheduler import MicroBatcher
+from utils.presets import get_preset, available_presets, resolve_preset
+from utils.json_images import iter_base64_array
+from utils import output_formats
+from utils import metrics
+from utils.renderers import render, render_text_image, render_fallback_image, text_image_capacity
 
 # Load environment variables
 load_dotenv()
@@ -26,13 +44,74 @@ app.config['UPLOAD_FOLDER'] = os.path.join('static', 'images')
 # Ensure the upload directory exists
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
-# Ollama configuration
-OLLAMA_HOST = os.environ.get('OLLAMA_HOST', 'http://localhost:11434')
+# Generated images are written to and served from this backend
+storage = create_storage(app.config['UPLOAD_FOLDER'])
+
+# Stored images never change, so browsers and proxies may keep them forever
+IMAGE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# Let the front-end server send image files: "x-sendfile" (Apache, lighttpd)
+# or "x-accel-redirect" (nginx, with IMAGE_OFFLOAD_PREFIX as internal location)
+IMAGE_OFFLOAD = os.environ.get('IMAGE_OFFLOAD', '').lower()
+IMAGE_OFFLOAD_PREFIX = os.environ.get('IMAGE_OFFLOAD_PREFIX', '/protected-images/')
+app.use_x_sendfile = IMAGE_OFFLOAD == 'x-sendfile'
+
+# Retention of uncached results, which are stored by date under outputs/
+OUTPUT_MAX_AGE = int(os.environ.get('OUTPUT_MAX_AGE', str(7 * 24 * 3600)))
+OUTPUT_MAX_MB = int(os.environ.get('OUTPUT_MAX_MB', '2048'))
+
+# Ollama configuration; OLLAMA_HOSTS lists several servers to spread requests over
+OLLAMA_HOSTS = parse_hosts(os.environ.get('OLLAMA_HOSTS') or os.environ.get('OLLAMA_HOST', 'http://localhost:11434'))
+OLLAMA_HOST = OLLAMA_HOSTS[0]
 DEFAULT_MODEL = os.environ.get('OLLAMA_DEFAULT_MODEL', 'llava')
 
-# Automatic1111 configuration
-SD_API_HOST = os.environ.get('SD_API_HOST', 'http://localhost:7860')
-SD_API_AVAILABLE = True  # Will be checked during initialization
+# Automatic1111 configuration; SD_API_HOSTS lists several servers
+SD_API_HOSTS = parse_hosts(os.environ.get('SD_API_HOSTS') or os.environ.get('SD_API_HOST', 'http://localhost:7860'))
+SD_API_HOST = SD_API_HOSTS[0]
+SD_API_AVAILABLE = True  # Updated by the background status probe
+# Requests beyond the least busy server a server with the right checkpoint may have
+SD_AFFINITY_SLACK = int(os.environ.get('SD_AFFINITY_SLACK', '2'))
+
+# Keep-alive clients shared by every call to each backend server; requests
+# go to the least busy healthy server and fail over when one is down
+OLLAMA_TIMEOUTS = {
+    '/api/tags': 5,
+    '/api/generate': 60,
+    '/api/pull': 300  # Pulls are streamed, so this is the longest wait for progress
+}
+SD_TIMEOUTS = {
+    '/sdapi/v1/sd-models': 10,
+    '/sdapi/v1/options': 120,  # Loading a checkpoint can take a while
+    '/sdapi/v1/txt2img': 120
+}
+ollama_pool = BackendPool('ollama', [
+    BackendClient(host, name='ollama', timeouts=OLLAMA_TIMEOUTS) for host in OLLAMA_HOSTS
+])
+sd_pool = BackendPool('automatic1111', [
+    BackendClient(host, name='automatic1111', timeouts=SD_TIMEOUTS) for host in SD_API_HOSTS
+], affinity_slack=SD_AFFINITY_SLACK)
+
+# Automatic1111 generation settings
+SD_NEGATIVE_PROMPT = "watermark, text, low quality, blurry, distorted, deformed, disfigured"
+# Speed/quality preset (steps, cfg scale, sampler) used unless the request picks one
+DEFAULT_PRESET = os.environ.get('GENERATION_PRESET', 'quality')
+# Diffusion models whose Automatic1111 checkpoints are LCM-distilled (or
+# turbo); the turbo preset is only offered and used for these
+SD_LCM_MODELS = {name.strip() for name in os.environ.get('SD_LCM_MODELS', '').split(',') if name.strip()}
+SD_MAX_BATCH_SIZE = int(os.environ.get('SD_MAX_BATCH_SIZE', '4'))
+TXT2IMG_CHUNK_SIZE = 256 * 1024  # Bytes read at a time from txt2img responses
+
+# Micro-batching of concurrent Automatic1111 requests: how many images one
+# fused call may hold and how long to wait for compatible requests. The
+# txt2img API takes a single prompt, so fused requests still run one after
+# another and only identical (prompt, seed) pairs share work; waiting is
+# therefore off unless SD_MICROBATCH_MAX_WAIT_MS is set
+MICROBATCH_MAX_SIZE = int(os.environ.get('MICROBATCH_MAX_SIZE', '4'))
+SD_MICROBATCH_MAX_WAIT_MS = int(os.environ.get('SD_MICROBATCH_MAX_WAIT_MS', '0'))
+
+# Each server remembers its loaded checkpoint so txt2img calls don't re-select it
+for node in sd_pool.nodes:
+    node.checkpoints = CheckpointManager(node.client)
 
 # Models for different types of generation
 MODELS = {
@@ -68,74 +147,243 @@ MODELS = {
     }
 }
 
-# Model pulling status
-MODEL_PULLING_STATUS = {}
+# Model downloads: how many run at once per process, and where their state is
+# kept so every worker sees it and restarts resume interrupted pulls
+MODEL_PULL_CONCURRENCY = int(os.environ.get('MODEL_PULL_CONCURRENCY', '1'))
+MODEL_PULL_STATE_PATH = os.environ.get(
+    'MODEL_PULL_STATE_PATH',
+    os.path.join(tempfile.gettempdir(), 'text-to-image-model-pulls.sqlite3')
+)
 
-def check_sd_api_available():
-    """Check if Automatic1111 Stable Diffusion API is available"""
+# Prompt enhancement is memoized per (prompt, generator model)
+PROMPT_GENERATOR_MODEL = "brxce/stable-diffusion-prompt-generator"
+PROMPT_CACHE_SIZE = int(os.environ.get('PROMPT_CACHE_SIZE', '1024'))
+PROMPT_CACHE_PATH = os.environ.get('PROMPT_CACHE_PATH')  # SQLite file, unset = memory only
+
+prompt_cache = PromptCache(max_entries=PROMPT_CACHE_SIZE, path=PROMPT_CACHE_PATH)
+prompt_enhancements = SingleFlight()
+
+# Read Ollama completions token by token instead of waiting for the full text
+OLLAMA_STREAMING = os.environ.get('OLLAMA_STREAMING', '1') == '1'
+
+# Generation job queue configuration
+GENERATION_WORKERS = int(os.environ.get('GENERATION_WORKERS', '2'))
+GENERATION_QUEUE_SIZE = int(os.environ.get('GENERATION_QUEUE_SIZE', '32'))
+JOB_RESULT_TTL = int(os.environ.get('JOB_RESULT_TTL', '3600'))
+# Jobs run in the process that accepted them; their state is kept here so
+# every web worker process can report on and cancel them
+JOB_STATE_PATH = os.environ.get(
+    'JOB_STATE_PATH',
+    os.path.join(tempfile.gettempdir(), 'text-to-image-jobs.sqlite3')
+)
+
+# Generations run on background workers so web workers are never blocked
+generation_queue = JobQueue(
+    workers=GENERATION_WORKERS,
+    max_pending=GENERATION_QUEUE_SIZE,
+    result_ttl=JOB_RESULT_TTL,
+    store=JobStore(JOB_STATE_PATH),
+    # Run jobs for the checkpoint loaded on the least busy server first to
+    # avoid switching back and forth
+    preferred_group=lambda: sd_pool.choose().checkpoints.current_model
+)
+
+# Limits for multi-image requests
+MAX_IMAGES_PER_PROMPT = int(os.environ.get('MAX_IMAGES_PER_PROMPT', '4'))
+MAX_IMAGE_SIZE = int(os.environ.get('MAX_IMAGE_SIZE', '1024'))  # Largest side the page offers
+MAX_BATCH_PROMPTS = int(os.environ.get('MAX_BATCH_PROMPTS', '8'))
+
+# Progress reporting for running jobs
+PROGRESS_POLL_INTERVAL = float(os.environ.get('PROGRESS_POLL_INTERVAL', '1.0'))
+PROGRESS_PREVIEWS = os.environ.get('PROGRESS_PREVIEWS', '0') == '1'
+# A Server-Sent Events stream holds a worker thread for as long as its job
+# runs, so the page polls for progress unless this is set (ASGI mode always streams)
+JOB_EVENTS = os.environ.get('JOB_EVENTS', '0') == '1'
+
+# Identical generation requests are served from this cache
+RESULT_CACHE_MAX_ENTRIES = int(os.environ.get('RESULT_CACHE_MAX_ENTRIES', '1000'))
+RESULT_CACHE_MAX_MB = int(os.environ.get('RESULT_CACHE_MAX_MB', '1024'))
+RESULT_CACHE_MAX_AGE = int(os.environ.get('RESULT_CACHE_MAX_AGE', str(7 * 24 * 3600)))
+
+result_cache = ResultCache(
+    storage,
+    prefix='cache',
+    shard=True,
+    evict_on_put=False,  # Eviction runs in storage_gc
+    extension=output_formats.extension(),
+    # A result is an index plus its image variants; max_entries counts results
+    entry_extension='.json',
+    max_entries=RESULT_CACHE_MAX_ENTRIES,
+    max_bytes=RESULT_CACHE_MAX_MB * 1024 * 1024,
+    max_age=RESULT_CACHE_MAX_AGE
+)
+
+# Error images are content-addressed, so repeated failures share one file
+fallback_cache = ResultCache(
+    storage,
+    prefix='errors',
+    shard=True,
+    evict_on_put=False,
+    max_entries=int(os.environ.get('FALLBACK_CACHE_MAX_ENTRIES', '256'))
+)
+fallback_renders = SingleFlight()
+
+# Background retention for everything in storage
+storage_gc = StorageGC()
+storage_gc.register(result_cache.evict)
+storage_gc.register(fallback_cache.evict)
+storage_gc.register(lambda: collect(
+    storage, 'outputs', max_bytes=OUTPUT_MAX_MB * 1024 * 1024, max_age=OUTPUT_MAX_AGE
+))
+
+# Pipeline metrics exposed on /metrics (backend HTTP metrics live in utils.http_clients)
+STAGE_SECONDS = metrics.histogram(
+    'generation_stage_seconds',
+    'Time spent in each stage of the generation pipeline',
+    ('stage',)
+)
+CACHE_LOOKUPS = metrics.counter(
+    'cache_lookups_total',
+    'Result and prompt cache lookups by outcome',
+    ('cache', 'result')
+)
+FALLBACK_IMAGES = metrics.counter(
+    'fallback_images_total',
+    'Requests answered with a fallback image instead of a generated one',
+    ('reason',)
+)
+QUEUE_PENDING = metrics.gauge('generation_queue_pending', 'Jobs waiting for a worker')
+QUEUE_RUNNING = metrics.gauge('generation_queue_running', 'Jobs being run by a worker')
+
+def report_queue(queue):
+    """Report queue's depth on /metrics; an app serving its own queue calls this with it"""
+    QUEUE_PENDING.set_function(lambda: queue.stats()['pending'])
+    QUEUE_RUNNING.set_function(lambda: queue.stats()['running'])
+
+report_queue(generation_queue)
+
+# Health checks are served from a cache refreshed in the background
+STATUS_CACHE_TTL = int(os.environ.get('STATUS_CACHE_TTL', '30'))
+service_status = StatusCache(ttl=STATUS_CACHE_TTL)
+
+@STAGE_SECONDS.time(stage='health_check')
+def probe_sd_api():
+    """Check which Automatic1111 servers are available; True if any is"""
     global SD_API_AVAILABLE
+    for node in sd_pool.nodes:
+        if probe_sd_node(node):
+            sd_pool.mark_healthy(node)
+        else:
+            sd_pool.mark_failed(node)
+    
+    SD_API_AVAILABLE = bool(sd_pool.healthy_nodes())
+    return SD_API_AVAILABLE
+
+def probe_sd_node(node):
+    """Check if one Automatic1111 server is available"""
     try:
-        response = requests.get(f"{SD_API_HOST}/sdapi/v1/sd-models", timeout=5)
+        response = node.client.get("/sdapi/v1/sd-models", timeout=5)
         if response.status_code == 200:
-            print("✅ Automatic1111 API is available")
-            SD_API_AVAILABLE = True
+            print(f"✅ Automatic1111 API is available at {node.url}")
             return True
         else:
-            print(f"❌ Automatic1111 API returned status {response.status_code}")
+            print(f"❌ Automatic1111 API at {node.url} returned status {response.status_code}")
     except Exception as e:
-        print(f"❌ Automatic1111 API is not available: {str(e)}")
-    
-    SD_API_AVAILABLE = False
+        print(f"❌ Automatic1111 API at {node.url} is not available: {str(e)}")
     return False
 
-def ensure_ollama_running():
-    """Check if Ollama is running, if not try to start it"""
+def fetch_ollama_models():
+    """
+    Fetch the local models of every Ollama server, or None if none is reachable
+
+    Records each server's health and models for routing, and returns the
+    models installed on any of them.
+    """
+    models = {}
+    reachable = False
+    for node in ollama_pool.nodes:
+        node_models = fetch_node_models(node)
+        if node_models is None:
+            ollama_pool.mark_failed(node)
+            continue
+        ollama_pool.mark_healthy(node)
+        reachable = True
+        node.models = {model.get("name") for model in node_models}
+        for model in node_models:
+            models.setdefault(model.get("name"), model)
+    
+    return list(models.values()) if reachable else None
+
+def fetch_node_models(node):
+    """Fetch the list of local models from one Ollama server, or None if it is unreachable"""
     try:
-        # Try to connect to Ollama API
-        response = requests.get(f"{OLLAMA_HOST}/api/tags", timeout=2)
+        response = node.client.get("/api/tags", timeout=2)
         if response.status_code == 200:
-            print("✅ Ollama is running")
-            return True
+            return response.json().get("models", [])
+        else:
+            print(f"Failed to get models from {node.url}: {response.status_code}")
     except requests.exceptions.ConnectionError:
-        print("Ollama is not running, attempting to start...")
+        print(f"Ollama is not running at {node.url}")
     except requests.exceptions.Timeout:
-        print("Connection to Ollama timed out")
+        print(f"Connection to Ollama at {node.url} timed out")
+    except Exception as e:
+        print(f"Error getting models: {str(e)}")
+    
+    return None
+
+# The `ollama serve` process started by probe_ollama, if any
+ollama_process = None
+
+@STAGE_SECONDS.time(stage='health_check')
+def probe_ollama():
+    """Check if Ollama is running, if not try to start it"""
+    global ollama_process
+    models = fetch_ollama_models()
+    if models is not None:
+        print("✅ Ollama is running")
+        return {"running": True, "models": models}
+    
+    # A server started earlier that is still alive is only slow to answer;
+    # poll() also reaps one that exited so it doesn't linger as a zombie
+    if ollama_process is not None and ollama_process.poll() is None:
+        print("⚠️ Ollama was started but is not answering yet")
+        return {"running": False, "models": []}
     
     # Try to start Ollama
+    print("Attempting to start Ollama...")
     try:
-        # This runs as a background process
-        subprocess.Popen(["ollama", "serve"], 
-                         stdout=subprocess.PIPE, 
-                         stderr=subprocess.PIPE)
+        # This runs as a background process; nothing reads its output
+        ollama_process = subprocess.Popen(["ollama", "serve"], 
+                                          stdout=subprocess.DEVNULL, 
+                                          stderr=subprocess.DEVNULL)
         
         # Give it a moment to start
         time.sleep(5)
         
         # Check again
-        try:
-            response = requests.get(f"{OLLAMA_HOST}/api/tags", timeout=2)
-            if response.status_code == 200:
-                print("✅ Ollama started successfully")
-                return True
-        except:
-            pass
+        models = fetch_ollama_models()
+        if models is not None:
+            print("✅ Ollama started successfully")
+            return {"running": True, "models": models}
     except:
         print("❌ Could not start Ollama automatically")
     
-    return False
+    return {"running": False, "models": []}
+
+service_status.register('ollama', probe_ollama)
+service_status.register('sd_api', probe_sd_api)
+
+def check_sd_api_available():
+    """Check if Automatic1111 Stable Diffusion API is available (cached)"""
+    return service_status.get('sd_api')
+
+def ensure_ollama_running():
+    """Check if Ollama is running (cached; the background probe tries to start it)"""
+    return service_status.get('ollama')["running"]
 
 def get_available_models():
-    """Get list of available models from Ollama"""
-    try:
-        response = requests.get(f"{OLLAMA_HOST}/api/tags", timeout=5)
-        if response.status_code == 200:
-            return response.json().get("models", [])
-        else:
-            print(f"Failed to get models: {response.status_code}")
-    except Exception as e:
-        print(f"Error getting models: {str(e)}")
-    
-    return []
+    """Get list of available models from Ollama (cached)"""
+    return service_status.get('ollama')["models"]
 
 def is_model_available(model_name):
     """Check if a model is available locally"""
@@ -145,143 +393,410 @@ def is_model_available(model_name):
             return True
     return False
 
-def async_pull_model(model_name):
-    """Pull a model asynchronously and update status"""
-    global MODEL_PULLING_STATUS
+def pull_to_servers(model_name, report):
+    """
+    Pull a model onto every reachable Ollama server that lacks it
+
+    The servers download in parallel, and Ollama's streamed progress is
+    passed to report(completed, total, detail) summed over every layer on
+    every server. Raises if no server got the model.
+    """
+    nodes = [node for node in ollama_pool.healthy_nodes() if model_name not in node.models]
+    layers = {}
+    errors = []
+    lock = threading.Lock()
     
-    MODEL_PULLING_STATUS[model_name] = "pulling"
+    def pull_on(node):
+        try:
+            response = node.client.post("/api/pull", json={"name": model_name, "stream": True}, stream=True)
+            with response:
+                if response.status_code != 200:
+                    raise Exception(f"API error: {response.status_code}, {response.text}")
+                for line in response.iter_lines():
+                    if not line:
+                        continue
+                    chunk = json.loads(line)
+                    if chunk.get("error"):
+                        raise Exception(chunk["error"])
+                    with lock:
+                        if chunk.get("total"):
+                            layers[(node.url, chunk.get("digest"))] = (chunk.get("completed", 0), chunk["total"])
+                        report(
+                            sum(completed for completed, _ in layers.values()),
+                            sum(total for _, total in layers.values()),
+                            chunk.get("status", "")
+                        )
+        except Exception as e:
+            print(f"❌ Failed to pull {model_name} on {node.url}: {str(e)}")
+            errors.append(str(e))
     
-    try:
-        print(f"Starting pull of model {model_name}...")
-        response = requests.post(
-            f"{OLLAMA_HOST}/api/pull",
-            json={"name": model_name},
-            timeout=3600  # Long timeout for large models
-        )
-        
-        if response.status_code == 200:
-            print(f"✅ Successfully pulled {model_name}")
-            MODEL_PULLING_STATUS[model_name] = "completed"
-        else:
-            print(f"❌ Failed to pull {model_name}: {response.text}")
-            MODEL_PULLING_STATUS[model_name] = "failed"
-    except Exception as e:
-        print(f"❌ Error pulling model {model_name}: {str(e)}")
-        MODEL_PULLING_STATUS[model_name] = "failed"
+    threads = [threading.Thread(target=pull_on, args=(node,), daemon=True) for node in nodes]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    
+    if not nodes:
+        raise Exception(f"No Ollama server available to pull {model_name}")
+    if len(errors) == len(nodes):
+        raise Exception(errors[0])
+    # Make the new model visible before reporting completion
+    service_status.invalidate('ollama', wait=True)
+
+model_pulls = PullManager(
+    pull_to_servers,
+    path=MODEL_PULL_STATE_PATH,
+    max_concurrent=MODEL_PULL_CONCURRENCY
+)
+
+metrics.gauge('model_pulls_active', 'Model pulls running or queued in this process',
+              func=model_pulls.active)
 
 def pull_model(model_name):
-    """Start pulling a model if not already available"""
+    """Start pulling a model if not already available; returns its pull status"""
     if is_model_available(model_name):
         return {"status": "available"}
-    
-    # Check if already pulling
-    if model_name in MODEL_PULLING_STATUS:
-        return {"status": MODEL_PULLING_STATUS[model_name]}
-    
-    # Start pulling in background
-    thread = threading.Thread(target=async_pull_model, args=(model_name,))
-    thread.daemon = True
-    thread.start()
-    
-    return {"status": "pulling"}
+    return model_pulls.start(model_name)
 
-def enhance_prompt_with_generator(prompt, model_name="brxce/stable-diffusion-prompt-generator"):
-    """Use the prompt generator model to enhance a basic prompt"""
+def prompt_cache_key(prompt, model_name):
+    """Return the memoization key for enhancing prompt with model_name"""
+    return f"{model_name}\n{normalize_prompt(prompt)}"
+
+def cached_enhanced_prompt(prompt, model_name=PROMPT_GENERATOR_MODEL):
+    """Return a previously enhanced prompt without contacting Ollama, or None"""
+    return prompt_cache.get(prompt_cache_key(prompt, model_name))
+
+def known_enhanced_prompt(prompt, model_name=PROMPT_GENERATOR_MODEL):
+    """
+    Return the prompt to use when the generator needn't be asked, else None
+
+    That is a cached enhancement, or the prompt itself when the generator
+    model isn't available.
+    """
+    enhanced_prompt = cached_enhanced_prompt(prompt, model_name)
+    CACHE_LOOKUPS.inc(cache='prompt', result='miss' if enhanced_prompt is None else 'hit')
+    if enhanced_prompt is not None:
+        return enhanced_prompt
+    
     if not is_model_available(model_name):
         print(f"⚠️ Prompt generator model {model_name} not available, using original prompt")
         return prompt
-        
+    return None
+
+def store_enhanced_prompt(prompt, model_name, completion):
+    """Cache the generator's completion for a prompt; returns the enhanced prompt, or None if it is empty"""
+    enhanced_prompt = completion.strip()
+    print(f"Enhanced prompt: {enhanced_prompt}")
+    if not enhanced_prompt:
+        return None
+    prompt_cache.put(prompt_cache_key(prompt, model_name), enhanced_prompt)
+    return enhanced_prompt
+
+def enhance_prompt_with_generator(prompt, model_name=PROMPT_GENERATOR_MODEL):
+    """Use the prompt generator model to enhance a basic prompt"""
+    enhanced_prompt = known_enhanced_prompt(prompt, model_name)
+    if enhanced_prompt is not None:
+        return enhanced_prompt
+    
+    # Concurrent requests for the same prompt share a single completion
+    key = prompt_cache_key(prompt, model_name)
+    enhanced_prompt = prompt_enhancements.do(key, request_enhanced_prompt, prompt, model_name)
+    return enhanced_prompt or prompt
+
+def has_model(model_name):
+    """Routing preference for the Ollama servers that have a model installed"""
+    return lambda node: model_name in node.models
+
+def ollama_stream(model_name, prompt, timeout=None, deadline=None):
+    """
+    Yield the text of an Ollama completion as tokens arrive
+
+    Reads the NDJSON stream from /api/generate. Closing the generator early
+    closes the connection, which makes Ollama stop generating.
+    """
+    payload = ollama_payload(model_name, prompt, True)
+    with ollama_pool.open(
+        lambda node: node.client.post("/api/generate", json=payload, stream=True, timeout=timeout),
+        prefer=has_model(model_name)
+    ) as response:
+        try:
+            if response.status_code != 200:
+                raise Exception(f"API error: {response.status_code}, {response.text}")
+            
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                token, done = parse_ollama_line(line)
+                if token:
+                    yield token
+                if done:
+                    break
+                if deadline and time.time() > deadline:
+                    raise requests.exceptions.Timeout("Ollama did not finish within the time limit")
+        finally:
+            response.close()
+
+def ollama_generate(model_name, prompt, timeout=None, on_text=None, max_chars=None):
+    """
+    Run an Ollama completion and return its text
+
+    In streaming mode on_text(text_so_far) is called as tokens arrive, and
+    generation stops early once max_chars characters have been received.
+    timeout bounds the whole completion, as it did for non-streaming calls.
+    """
+    if timeout is None:
+        timeout = ollama_pool.timeout_for("/api/generate")
+    
+    if not OLLAMA_STREAMING:
+        payload = ollama_payload(model_name, prompt, False)
+        response = ollama_pool.post("/api/generate", json=payload, timeout=timeout, prefer=has_model(model_name))
+        if response.status_code != 200:
+            raise Exception(f"API error: {response.status_code}, {response.text}")
+        return response.json().get("response", "")
+    
+    text = ""
+    tokens = ollama_stream(model_name, prompt, timeout=timeout, deadline=time.time() + timeout)
     try:
-        url = f"{OLLAMA_HOST}/api/generate"
-        payload = {
-            "model": model_name,
-            "prompt": prompt,
-            "stream": False
-        }
-        
-        response = requests.post(url, json=payload, timeout=30)
-        
-        if response.status_code == 200:
-            result = response.json()
-            enhanced_prompt = result.get("response", "").strip()
-            print(f"Enhanced prompt: {enhanced_prompt}")
-            return enhanced_prompt
-        else:
-            print(f"❌ Error from prompt generator: {response.status_code}, {response.text}")
-            return prompt
+        for token in tokens:
+            text, enough = add_token(text, token, model_name, on_text, max_chars)
+            if enough:
+                break
+    finally:
+        tokens.close()
+    return text
+
+def ollama_payload(model_name, prompt, stream):
+    """Build the request body of an Ollama completion"""
+    return {
+        "model": model_name,
+        "prompt": prompt,
+        "stream": stream
+    }
+
+def parse_ollama_line(line):
+    """Return (token, done) for one NDJSON line of a streamed completion, raising on errors"""
+    chunk = json.loads(line)
+    if chunk.get("error"):
+        raise Exception(f"API error: {chunk['error']}")
+    return chunk.get("response", ""), bool(chunk.get("done"))
+
+def add_token(text, token, model_name, on_text=None, max_chars=None):
+    """
+    Append a streamed token to a completion's text
+
+    Returns the new text and whether max_chars characters have been
+    received, at which point the caller stops reading.
+    """
+    text += token
+    if on_text:
+        on_text(text)
+    if max_chars and len(text) >= max_chars:
+        print(f"Stopping {model_name} after {len(text)} characters")
+        return text, True
+    return text, False
+
+def request_enhanced_prompt(prompt, model_name):
+    """Ask the prompt generator model to enhance a prompt; returns None on failure"""
+    # The enhancement may have finished while this call was waiting to start
+    enhanced_prompt = cached_enhanced_prompt(prompt, model_name)
+    if enhanced_prompt is not None:
+        return enhanced_prompt
+    
+    job = current_job()
+    
+    def forward(text):
+        if job:
+            job.update_progress(stage='enhancing', text=text)
+    
+    try:
+        completion = ollama_generate(model_name, prompt, timeout=30, on_text=forward)
+        return store_enhanced_prompt(prompt, model_name, completion)
     except Exception as e:
         print(f"❌ Error using prompt generator: {str(e)}")
-        return prompt
+        return None
 
-def generate_image_with_automatic1111(prompt, width=512, height=512, model_name="sdxl"):
+def generate_image_with_automatic1111(prompt, width=512, height=512, model_name="sdxl", preset=DEFAULT_PRESET,
+                                      seed=None):
     """
     Generate an image using Automatic1111 Stable Diffusion API
     """
-    if not SD_API_AVAILABLE:
+    return generate_images_with_automatic1111([prompt], width, height, model_name, preset=preset, seed=seed)[0]
+
+def generate_images_with_automatic1111(prompts, width=512, height=512, model_name="sdxl", num_images=1,
+                                       preset=DEFAULT_PRESET, seed=None):
+    """
+    Generate num_images images for each prompt using Automatic1111
+
+    Each prompt is sent as one txt2img call with batch_size/n_iter set, so
+    the images of a prompt share a single UNet batch. Image i of a prompt
+    uses seed + i; without a seed each prompt gets a random one. Returns the
+    images ordered by prompt, with their seed in image.info['seed'].
+    """
+    prompt_requests = [(prompt, num_images, random_seed() if seed is None else seed) for prompt in prompts]
+    images = _generate_a1111(prompt_requests, width, height, model_name, preset=preset)
+    
+    decoded = []
+    for (_, _, prompt_seed), prompt_images in zip(prompt_requests, images):
+        for index, image in enumerate(prompt_images):
+            image = decode_image(image)
+            image.info['seed'] = prompt_seed + index
+            decoded.append(image)
+    return decoded
+
+def random_seed():
+    """Pick a seed for a request that didn't ask for one, so its images can be reproduced"""
+    return random.randrange(2 ** 32)
+
+def decode_image(data):
+    """Open encoded image bytes as a PIL image"""
+    return Image.open(BytesIO(data))
+
+def _generate_a1111(prompt_requests, width, height, model_name, jobs=None, preset=DEFAULT_PRESET):
+    """
+    Run txt2img for (prompt, count, seed) requests under one checkpoint lease
+
+    The requests go to one Automatic1111 server, preferably one that has
+    the checkpoint loaded already. Returns a list with the encoded images
+    of each request.
+    """
+    if not check_sd_api_available():
         raise Exception("Automatic1111 API is not available")
     
-    # Set the model in Automatic1111 first
-    try:
-        # Try to select the SDXL model in Automatic1111
-        available_models_response = requests.get(f"{SD_API_HOST}/sdapi/v1/sd-models", timeout=10)
-        if available_models_response.status_code == 200:
-            available_models = available_models_response.json()
-            
-            # Look for SDXL model
-            sdxl_model = None
-            for model in available_models:
-                model_title = model.get("title", "").lower()
-                if "sdxl" in model_title:
-                    sdxl_model = model["title"]
-                    break
-            
-            if sdxl_model:
-                print(f"Found SDXL model: {sdxl_model}")
-                # Set the model
-                requests.post(
-                    f"{SD_API_HOST}/sdapi/v1/options", 
-                    json={"sd_model_checkpoint": sdxl_model},
-                    timeout=30
-                )
-            else:
-                print("⚠️ No SDXL model found in Automatic1111, using default model")
-        else:
-            print("⚠️ Unable to get model list from Automatic1111")
-    except Exception as e:
-        print(f"⚠️ Error setting model in Automatic1111: {str(e)}")
+    def generate_on(node):
+        # Keep the requested checkpoint loaded while generating; it is only
+        # switched when a different model than the current one is needed
+        images = []
+        with node.checkpoints.use(model_name):
+            for prompt, count, seed in prompt_requests:
+                images.append(_txt2img(node.client, prompt, width, height, count, jobs, preset, seed))
+        return images
+    
+    return sd_pool.call(generate_on, prefer=has_checkpoint(model_name))
+
+def has_checkpoint(model_name):
+    """Routing preference for the Automatic1111 servers with a model's checkpoint loaded"""
+    return lambda node: node.checkpoints.current_model == model_name
+
+def run_a1111_batch(key, items):
+    """
+    Run fused requests collected by the micro-batcher
+
+    key is (model_name, width, height, num_images, preset) and each item is
+    (prompts, seeds, job). Requests for the same prompt and seed produce the
+    same images, so they become one txt2img call; the images are then handed
+    back per request. Different prompts still need a txt2img call each, run
+    in turn under one checkpoint lease, so every request in the batch waits
+    for all of them.
+    """
+    model_name, width, height, num_images, preset = key
+    
+    requested = {}
+    for prompts, seeds, _ in items:
+        for prompt, seed in zip(prompts, seeds):
+            requested[(prompt, seed)] = (prompt, num_images, seed)
+    
+    jobs = [job for _, _, job in items if job is not None]
+    images = _generate_a1111(list(requested.values()), width, height, model_name, jobs, preset)
+    by_request = dict(zip(requested, images))
+    
+    results = []
+    for prompts, seeds, _ in items:
+        results.append([image for request in zip(prompts, seeds) for image in by_request[request]])
+    return results
+
+# Concurrent identical diffusion requests share one backend call
+a1111_batcher = MicroBatcher(
+    run_a1111_batch,
+    max_batch_size=MICROBATCH_MAX_SIZE,
+    max_wait=SD_MICROBATCH_MAX_WAIT_MS / 1000
+)
+
+def watch_a1111_progress(client, jobs, stop):
+    """
+    Poll Automatic1111's progress endpoint into each job's progress until stop is set
+
+    Also forwards cancellation to Automatic1111 once every job sharing the
+    call has been cancelled, so abandoned work stops sampling instead of
+    running to completion.
+    """
+    interrupted = False
+    while not stop.wait(PROGRESS_POLL_INTERVAL):
+        if not interrupted and all(job.cancel_requested for job in jobs):
+            try:
+                client.post("/sdapi/v1/interrupt", timeout=5)
+                interrupted = True
+            except Exception as e:
+                print(f"⚠️ Error interrupting Automatic1111: {str(e)}")
+        
+        try:
+            response = client.get("/sdapi/v1/progress", params=A1111_PROGRESS_PARAMS, timeout=5)
+            if response.status_code != 200:
+                continue
+            progress = response.json()
+        except Exception:
+            continue
+        
+        fields = a1111_progress_fields(progress)
+        for job in jobs:
+            job.update_progress(**fields)
+
+# Query of Automatic1111's progress endpoint; previews are only sent when enabled
+A1111_PROGRESS_PARAMS = {"skip_current_image": "false" if PROGRESS_PREVIEWS else "true"}
+
+def a1111_progress_fields(progress):
+    """Turn a response of Automatic1111's progress endpoint into job progress fields"""
+    state = progress.get("state", {})
+    fields = {
+        'stage': 'sampling',
+        'fraction': progress.get("progress", 0),
+        'step': state.get("sampling_step"),
+        'total': state.get("sampling_steps"),
+        'eta': progress.get("eta_relative")
+    }
+    if progress.get("current_image"):
+        fields['preview'] = f"data:image/png;base64,{progress['current_image']}"
+    return fields
+
+def _txt2img(client, prompt, width, height, num_images=1, jobs=None, preset=DEFAULT_PRESET, seed=-1):
+    """Call the txt2img endpoint of an Automatic1111 server and return the encoded images"""
+    # Report sampling progress while the (blocking) txt2img call runs
+    if jobs is None:
+        jobs = [job for job in [current_job()] if job is not None]
+    stop = threading.Event()
+    if jobs:
+        watcher = threading.Thread(target=watch_a1111_progress, args=(client, jobs, stop), daemon=True)
+        watcher.start()
     
-    # Now generate the image
     try:
-        # Prepare the API call
-        payload = {
-            "prompt": prompt,
-            "negative_prompt": "watermark, text, low quality, blurry, distorted, deformed, disfigured",
-            "width": width,
-            "height": height,
-            "steps": 30,
-            "cfg_scale": 7.5,
-            "sampler_name": "DPM++ 2M Karras",
-        }
+        with STAGE_SECONDS.time(stage='sampling'):
+            return _post_txt2img(client, prompt, width, height, num_images, preset, seed)
+    finally:
+        stop.set()
+
+def _post_txt2img(client, prompt, width, height, num_images=1, preset=DEFAULT_PRESET, seed=-1):
+    """
+    Send the txt2img request and return the generated PNG files as bytes-like objects
+
+    Image i is generated with seed + i; -1 lets Automatic1111 pick a random seed.
+    """
+    try:
+        payload = txt2img_payload(prompt, width, height, num_images, preset, seed)
         
-        # Make the API call
-        response = requests.post(
-            f"{SD_API_HOST}/sdapi/v1/txt2img",
-            json=payload,
-            timeout=120
-        )
+        # Stream the response so the images are decoded as they arrive
+        response = client.post("/sdapi/v1/txt2img", json=payload, stream=True)
         
         if response.status_code == 200:
-            result = response.json()
+            with response:
+                chunks = response.iter_content(chunk_size=TXT2IMG_CHUNK_SIZE)
+                encoded_images = list(iter_base64_array(
+                    chunks,
+                    size_hint=txt2img_size_hint(response.headers, payload)
+                ))
+                # Read the rest so the connection can be reused
+                for _ in chunks:
+                    pass
             
-            # Check if there's an image in the response
-            if "images" in result and len(result["images"]) > 0:
-                # Decode the base64 image
-                image_data = base64.b64decode(result["images"][0])
-                image = Image.open(BytesIO(image_data))
-                return image
-            else:
-                print("❌ No image found in Automatic1111 response")
-                raise Exception("No image found in response")
+            return txt2img_images(encoded_images, payload, num_images)
         else:
             print(f"❌ Error from Automatic1111 API: {response.status_code}, {response.text}")
             raise Exception(f"API error: {response.text}")
@@ -290,33 +805,74 @@ def generate_image_with_automatic1111(prompt, width=512, height=512, model_name=
         print(f"❌ Error generating image with Automatic1111: {str(e)}")
         raise
 
+def txt2img_payload(prompt, width, height, num_images=1, preset=DEFAULT_PRESET, seed=-1):
+    """
+    Build the txt2img request for num_images images of a prompt
+
+    The images are split into batches Automatic1111 runs in one pass, so
+    batch_size * n_iter images are generated.
+    """
+    settings = get_preset(preset, DEFAULT_PRESET)
+    batch_size = max(1, min(num_images, SD_MAX_BATCH_SIZE))
+    return {
+        "prompt": prompt,
+        "negative_prompt": SD_NEGATIVE_PROMPT,
+        "width": width,
+        "height": height,
+        "steps": settings['steps'],
+        "cfg_scale": settings['cfg_scale'],
+        "sampler_name": settings['sampler'],
+        "seed": seed,
+        "batch_size": batch_size,
+        "n_iter": -(-num_images // batch_size),
+    }
+
+def txt2img_size_hint(headers, payload):
+    """Estimate the decoded size of each image from a txt2img response's length, to preallocate buffers"""
+    content_length = int(headers.get("Content-Length") or 0)
+    return content_length * 3 // 4 // (payload['batch_size'] * payload['n_iter'])
+
+def txt2img_images(encoded_images, payload, num_images):
+    """
+    Pick the requested images out of those in a txt2img response
+
+    The PNG bytes are kept as they are; callers that need pixels decode
+    them with decode_image().
+    """
+    if not encoded_images:
+        print("❌ No image found in Automatic1111 response")
+        raise Exception("No image found in response")
+    # Multi-image runs may also return a grid of all images first
+    if len(encoded_images) > payload['batch_size'] * payload['n_iter']:
+        encoded_images = encoded_images[1:]
+    return encoded_images[:num_images]
+
+@STAGE_SECONDS.time(stage='describe')
 def generate_image_with_llava(prompt, model_name="llava", width=512, height=512):
     """
     Generate an image description using LLaVA's multimodal capabilities
     Note: LLaVA doesn't actually generate images, but can provide detailed descriptions
     """
+    job = current_job()
+    
+    def forward(text):
+        # Show the description to the client while it is being written
+        if job:
+            job.update_progress(stage='describing', text=text)
+            job.check_cancelled()
+    
     try:
-        # Prepare the API call
-        url = f"{OLLAMA_HOST}/api/generate"
-        payload = {
-            "model": model_name,
-            "prompt": f"Generate a detailed description of what an image of '{prompt}' would look like. Make it detailed and vivid.",
-            "stream": False
-        }
-        
-        # Make the API call
-        response = requests.post(url, json=payload, timeout=60)
+        description = ollama_generate(
+            model_name,
+            f"Generate a detailed description of what an image of '{prompt}' would look like. Make it detailed and vivid.",
+            on_text=forward,
+            # Anything beyond what the text image can show is wasted
+            max_chars=text_image_capacity(width)
+        )
         
-        if response.status_code == 200:
-            result = response.json()
-            description = result.get("response", "")
-            
-            # Create a text image with the description
-            image = create_text_image(prompt, description, width, height)
-            return image
-        else:
-            print(f"❌ Error from LLaVA API: {response.status_code}, {response.text}")
-            raise Exception(f"API error: {response.text}")
+        # Create a text image with the description
+        image = create_text_image(prompt, description, width, height)
+        return image
     
     except Exception as e:
         print(f"❌ Error generating with LLaVA: {str(e)}")
@@ -324,132 +880,56 @@ def generate_image_with_llava(prompt, model_name="llava", width=512, height=512)
 
 def create_text_image(prompt, description, width=512, height=512):
     """Create an image with text description when image generation fails"""
-    # Create a gradient background
-    image = Image.new('RGB', (width, height), (255, 255, 255))
-    draw = ImageDraw.Draw(image)
-    
-    # Create a gradient background
-    for y in range(height):
-        # Calculate color based on position
-        r = int(100 + (y / height) * 50)
-        g = int(150 + (y / height) * 50)
-        b = int(200 + (y / height) * 30)
-        draw.line([(0, y), (width, y)], fill=(r, g, b))
-    
-    # Try to use a nice font
-    try:
-        title_font = ImageFont.truetype("Arial", 24)
-        caption_font = ImageFont.truetype("Arial", 16)
-    except:
-        title_font = ImageFont.load_default()
-        caption_font = title_font
-    
-    # Add the prompt text to the image
-    draw.text(
-        (width // 2, 50),
-        f"Prompt: {prompt}",
-        font=title_font,
-        fill=(255, 255, 255),
-        anchor="mm"
-    )
-    
-    # Add description - wrap text to fit
-    max_width = width - 60
-    lines = []
-    words = description.split()
-    current_line = ""
-    
-    for word in words:
-        test_line = current_line + " " + word if current_line else word
-        # Estimate text width (this is approximate)
-        if len(test_line) * 10 < max_width:  # rough estimate of text width
-            current_line = test_line
-        else:
-            lines.append(current_line)
-            current_line = word
-    
-    if current_line:
-        lines.append(current_line)
-    
-    # Limit to a reasonable number of lines
-    max_lines = 15
-    if len(lines) > max_lines:
-        lines = lines[:max_lines-1] + ["..."]
-    
-    # Draw the lines
-    y_position = 100
-    for line in lines:
-        draw.text(
-            (30, y_position),
-            line,
-            font=caption_font,
-            fill=(255, 255, 255)
-        )
-        y_position += 24
-    
-    return image
+    with STAGE_SECONDS.time(stage='render'):
+        return render(render_text_image, prompt, description, width, height)
+
+def fallback_help_message():
+    """Return a help message based on what's missing"""
+    if not ensure_ollama_running():
+        return "Install Ollama and start it with 'ollama serve'"
+    elif not check_sd_api_available():
+        return "Install Automatic1111 and start the API server"
+    return "Check logs for more details on the error"
 
 def create_fallback_image(prompt, error_message, width=512, height=512):
     """Create a fallback image when generation fails"""
-    # Create a gradient background
-    image = Image.new('RGB', (width, height), (255, 255, 255))
-    draw = ImageDraw.Draw(image)
-    
-    # Create a gradient background
-    for y in range(height):
-        # Calculate color based on position
-        r = int(100 + (y / height) * 50)
-        g = int(150 + (y / height) * 50)
-        b = int(200 + (y / height) * 30)
-        draw.line([(0, y), (width, y)], fill=(r, g, b))
-    
-    # Try to use a nice font
-    try:
-        title_font = ImageFont.truetype("Arial", 28)
-        caption_font = ImageFont.truetype("Arial", 20)
-    except:
-        title_font = ImageFont.load_default()
-        caption_font = title_font
-    
-    # Add error message
-    draw.text(
-        (width // 2, height // 3),
-        error_message,
-        font=caption_font,
-        fill=(255, 0, 0),
-        anchor="mm"
-    )
-    
-    # Add the prompt text to the image
-    draw.text(
-        (width // 2, height // 2),
-        f"Prompt: {prompt}",
-        font=title_font,
-        fill=(255, 255, 255),
-        anchor="mm"
+    with STAGE_SECONDS.time(stage='render'):
+        return render(render_fallback_image, prompt, error_message, fallback_help_message(), width, height)
+
+def save_fallback_image(prompt, error_message, width=512, height=512):
+    """
+    Save the fallback image for an error and return its URL
+
+    Fallback images are named after a hash of everything drawn on them, so
+    an error repeated for the same prompt reuses the existing file, and
+    concurrent identical failures render it only once.
+    """
+    message = fallback_help_message()
+    key = cache_key(
+        prompt=prompt,
+        error=error_message,
+        message=message,
+        width=width,
+        height=height
     )
     
-    # Add help message based on what's missing
-    if not ensure_ollama_running():
-        message = "Install Ollama and start it with 'ollama serve'"
-    elif not SD_API_AVAILABLE:
-        message = "Install Automatic1111 and start the API server"
-    else:
-        message = "Check logs for more details on the error"
-    
-    draw.text(
-        (width // 2, height * 2/3),
-        message,
-        font=caption_font,
-        fill=(255, 255, 255),
-        anchor="mm"
-    )
+    def render_and_store():
+        if not fallback_cache.get(key):
+            with STAGE_SECONDS.time(stage='render'):
+                image = render(render_fallback_image, prompt, error_message, message, width, height)
+            fallback_cache.put(key, image)
     
-    return image
+    storage_gc.start()
+    fallback_renders.do(key, render_and_store)
+    return upload_url(fallback_cache.filename(key))
 
 @app.route('/')
 def index():
     """Render the main page"""
+    return render_template('index_ollama.html', **index_context())
+
+def index_context():
+    """Return the template variables of the main page"""
     # Add a timestamp query parameter to prevent caching
     timestamp = int(time.time())
     
@@ -474,212 +954,796 @@ def index():
     # Add models that are in our list but not yet pulled
     for model_name, model_info in MODELS.items():
         if not any(m.get("name") == model_name for m in available_models):
-            status = "not_pulled"
-            if model_name in MODEL_PULLING_STATUS:
-                status = MODEL_PULLING_STATUS[model_name]
-                
+            pull = model_pulls.status(model_name)
+            status = pull["status"] if pull else "not_pulled"
+            
             available_models.append({
                 "name": model_name,
                 "description": model_info["description"],
                 "status": status
             })
     
-    return render_template(
-        'index_ollama.html', 
-        timestamp=timestamp,
-        ollama_running=ollama_running,
-        sd_available=sd_available,
-        available_models=available_models
-    )
+    return {
+        'timestamp': timestamp,
+        'ollama_running': ollama_running,
+        'sd_available': sd_available,
+        'available_models': available_models,
+        'presets': available_presets(bool(SD_LCM_MODELS)),
+        'default_preset': DEFAULT_PRESET,
+        'job_events': JOB_EVENTS
+    }
 
-@app.route('/generate', methods=['POST'])
-def generate():
-    """Generate an image based on the provided text prompt"""
-    # Get the text prompt from the form
-    prompt = request.form.get('prompt', '')
+def upload_url(name):
+    """Return the URL of a stored file (usable outside a request)"""
+    return storage.url(name) or f"/image/{name}"
+
+def generation_cache_key(prompt, enhanced_prompt, model_name, width, height, seed=None, preset=DEFAULT_PRESET):
+    """Return the result cache key for a generation request"""
+    model_type = MODELS.get(model_name, {}).get("type", "unknown")
+    fields = {
+        'prompt': normalize_prompt(prompt),
+        'enhanced_prompt': enhanced_prompt,
+        'model': model_name,
+        'width': width,
+        'height': height,
+        'seed': seed
+    }
+    if model_type == "diffusion":
+        settings = get_preset(preset, DEFAULT_PRESET)
+        fields.update(steps=settings['steps'], cfg_scale=settings['cfg_scale'], sampler=settings['sampler'])
+    return cache_key(**fields)
+
+def lookup_result(key):
+    """Return the cached_variants() of key, or None on a miss, counting the hit or miss"""
+    cached = cached_variants(key)
+    CACHE_LOOKUPS.inc(cache='result', result='hit' if cached else 'miss')
+    return cached
+
+# Response fields holding the URL of each image variant
+VARIANT_FIELDS = {
+    'full': 'image_path',
+    'preview': 'preview_path',
+    'thumbnail': 'thumbnail_path'
+}
+
+def generation_manifest(prompt, enhanced_prompt, model_name, width, height, seed=None, preset=None):
+    """Describe how an image was generated, with everything needed to reproduce it"""
+    manifest = {
+        'prompt': prompt,
+        'enhanced_prompt': enhanced_prompt,
+        'model': model_name,
+        'seed': seed,
+        'width': width,
+        'height': height
+    }
+    if preset is not None:
+        settings = get_preset(preset, DEFAULT_PRESET)
+        manifest.update(preset=preset, steps=settings['steps'], cfg_scale=settings['cfg_scale'],
+                        sampler=settings['sampler'])
+    return manifest
+
+def cached_variants(key):
+    """
+    Return the URLs of a cached result's variants and its manifest, or None on a miss
+
+    The cache entry of a request is a small JSON index naming the files of
+    its variants, which are stored under their content hashes. Regenerating
+    an evicted entry (or two identical requests racing) therefore writes new
+    files instead of changing what an URL already handed out points to.
+    The full image stands in for missing variants.
+    """
+    if not result_cache.get(key, ".json"):
+        return None
+    try:
+        f = result_cache.open(key, ".json")
+        try:
+            entry = json.loads(f.read())
+        finally:
+            f.close()
+    except (OSError, ValueError):
+        return None
     
-    if not prompt:
-        return jsonify({'success': False, 'error': 'No prompt provided'}), 400
+    paths = {}
+    for name, filename in entry.get('variants', {}).items():
+        content, extension = os.path.splitext(filename)
+        if name in VARIANT_FIELDS and result_cache.get(content, extension):
+            paths[VARIANT_FIELDS[name]] = upload_url(result_cache.filename(content, extension))
+    if 'image_path' not in paths:
+        return None
+    for field in VARIANT_FIELDS.values():
+        paths.setdefault(field, paths['image_path'])
+    paths['manifest'] = entry.get('manifest')
+    return paths
+
+def cached_result(cached):
+    """Build the response for a request answered from the result cache"""
+    result = {
+        'success': True,
+        'message': 'Image served from cache',
+        'cached': True
+    }
+    result.update(cached)
+    return result
+
+def save_result(image, key, manifest=None):
+    """
+    Save a generated image with its preview and thumbnail and return their URLs
+
+    image is a PIL image, or the encoded PNG as a bytes-like object, which
+    is written out unchanged when the output format is PNG. Files are named
+    after their contents, so every URL is immutable. Results with a key are
+    also indexed in the result cache together with their manifest, so cache
+    hits can report how they were made.
+
+    Returns:
+        dict: 'image_path', 'preview_path' and 'thumbnail_path' URLs
+    """
+    storage_gc.start()
+    variants = output_formats.encode_variants(image)
+    base = hashlib.sha256(variants['full'][0]).hexdigest()
     
-    # Get model selection
-    model_name = request.form.get('model', DEFAULT_MODEL)
+    paths = {}
+    stored = {}
+    for name, (data, extension) in variants.items():
+        if key:
+            content = result_cache.put_content(data, extension)
+            stored[name] = f"{content}{extension}"
+            url = upload_url(result_cache.filename(content, extension))
+        else:
+            entry = base if name == 'full' else f"{base}-{name}"
+            filename = shard_name(f"{entry}{extension}", "date", "outputs")
+            storage.put(filename, data)
+            url = upload_url(filename)
+        paths[VARIANT_FIELDS[name]] = url
     
-    # Get image size from the form
-    size_option = request.form.get('size', '512x512')
-    if 'x' in size_option:
-        width, height = map(int, size_option.split('x'))
-    else:
-        width, height = 512, 512
+    if key:
+        # Written last, so a hit never names files that aren't stored yet
+        index = {'variants': stored, 'manifest': manifest}
+        result_cache.put(key, json.dumps(index).encode("utf-8"), ".json")
+    
+    # Disabled variants fall back to the full image
+    for field in VARIANT_FIELDS.values():
+        paths.setdefault(field, paths['image_path'])
+    return paths
+
+def run_generation(prompt, model_name, width, height, num_images=1, preset=DEFAULT_PRESET, seed=None,
+                   enhanced_prompt=None):
+    """
+    Generate images for a prompt and save them to the upload folder
+
+    Runs on a job queue worker. Returns a (response, status_code) tuple
+    describing the result in the same shape the /generate route used to
+    return synchronously.
+    """
+    enhanced_prompts = [enhanced_prompt] if enhanced_prompt else None
+    return run_batch_generation([prompt], model_name, width, height, num_images, preset, seed, enhanced_prompts)
+
+@STAGE_SECONDS.time(stage='total')
+def run_batch_generation(prompts, model_name, width, height, num_images=1, preset=DEFAULT_PRESET, seed=None,
+                         enhanced_prompts=None):
+    """
+    Generate num_images images for each prompt as batched backend calls
+
+    The response lists every image under 'images' (ordered by prompt) and
+    repeats the first one as 'image_path'. Prompts already in the result
+    cache are not sent to the backend. Image i of a prompt is generated
+    with seed + i (a random seed is picked when none is given), and every
+    image carries a 'manifest' describing how to reproduce it.
+    enhanced_prompts replaces the prompt generator, e.g. when replaying.
+    """
+    job = current_job()
+    if job:
+        STAGE_SECONDS.observe(job.started_at - job.created_at, stage='queue_wait')
     
     try:
-        # Check if Ollama is running
-        if not ensure_ollama_running():
-            return jsonify({
-                'success': False,
-                'error': 'Ollama is not running. Please install and start Ollama.'
-            }), 500
-        
-        # Check if model is available
-        if not is_model_available(model_name):
-            # Try to pull the model
-            pull_status = pull_model(model_name)
-            
-            if pull_status["status"] == "pulling":
-                return jsonify({
-                    'success': False,
-                    'error': f"Model {model_name} is being downloaded. Please wait and try again later."
-                }), 500
-            elif pull_status["status"] == "failed":
-                return jsonify({
-                    'success': False,
-                    'error': f"Failed to download model {model_name}. Please pull it manually with 'ollama pull {model_name}'."
-                }), 500
-            else:
-                return jsonify({
-                    'success': False,
-                    'error': f"Model {model_name} is not available. Please pull it with 'ollama pull {model_name}'."
-                }), 500
-        
-        # Generate a unique filename based on timestamp and random uuid
-        timestamp = int(time.time())
-        filename = f"{uuid.uuid4()}_{timestamp}.png"
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+        # Check that Ollama is running and has the model
+        unavailable = model_unavailable_response(model_name)
+        if unavailable:
+            return unavailable
         
         # Generate the image based on model type
-        print(f"Generating image for prompt: '{prompt}' using model: {model_name}")
+        print(f"Generating {num_images} image(s) for {len(prompts)} prompt(s) using model: {model_name}")
         
         # Determine the model type and use appropriate generator
         model_type = MODELS.get(model_name, {}).get("type", "unknown")
+        timestamp = int(time.time())
         
         # Enhance prompt if using diffusion
         if model_type == "diffusion":
             # First, enhance the prompt using stable-diffusion-prompt-generator if available
-            enhanced_prompt = enhance_prompt_with_generator(prompt)
+            if job:
+                job.update_progress(stage='enhancing')
+            if not enhanced_prompts:
+                with STAGE_SECONDS.time(stage='enhance'):
+                    enhanced_prompts = [enhance_prompt_with_generator(prompt) for prompt in prompts]
             
-            # Use SD API if available
-            if SD_API_AVAILABLE:
-                image = generate_image_with_automatic1111(enhanced_prompt, width, height)
-            else:
-                raise Exception("Stable Diffusion API is not available. Please install Automatic1111 with API enabled.")
+            results, pending = plan_diffusion_results(
+                prompts, enhanced_prompts, model_name, width, height, num_images, seed, preset
+            )
+            if pending:
+                # Use SD API if available
+                if job:
+                    job.check_cancelled()
+                    job.update_progress(stage='sampling')
+                if not check_sd_api_available():
+                    raise Exception("Stable Diffusion API is not available. Please install Automatic1111 with API enabled.")
+                pending_prompts, pending_seeds = zip(*pending)
+                fill_results(results, a1111_batcher.submit(
+                    (model_name, width, height, num_images, preset),
+                    (list(pending_prompts), list(pending_seeds), job),
+                    size=len(pending) * num_images
+                ))
         elif model_type == "multimodal":
-            # Use LLaVA-like generator
-            image = generate_image_with_llava(prompt, model_name, width, height)
+            # LLaVA writes one description per prompt
+            results = []
+            for prompt in prompts:
+                key = generation_cache_key(prompt, None, model_name, width, height)
+                cached = lookup_result(key)
+                if cached:
+                    results.append([prompt, key, None, cached])
+                    continue
+                
+                # Use LLaVA-like generator
+                if job:
+                    job.update_progress(stage='describing')
+                results.append([prompt, key, generate_image_with_llava(prompt, model_name, width, height),
+                                generation_manifest(prompt, None, model_name, width, height)])
         else:
             # Fallback to default
-            image = create_fallback_image(
-                prompt, 
-                f"Unsupported model type: {model_type}", 
-                width, 
-                height
-            )
+            results = unsupported_model_results(prompts, model_type, width, height)
+        
+        # Don't keep results nobody is waiting for
+        if job:
+            job.check_cancelled()
+            job.update_progress(stage='saving')
         
-        # Save the image
-        image.save(filepath)
+        return generation_response(save_results(results), timestamp)
+    
+    except JobCancelled:
+        raise
+    except Exception as e:
+        return generation_error_response(e, prompts[0], width, height)
+
+def model_unavailable_response(model_name):
+    """Return the error response for a model that can't be used yet, or None if it can"""
+    # Check if Ollama is running
+    if not ensure_ollama_running():
+        return {
+            'success': False,
+            'error': 'Ollama is not running. Please install and start Ollama.'
+        }, 500
+    
+    if is_model_available(model_name):
+        return None
+    
+    # Try to pull the model
+    pull_status = pull_model(model_name)
+    if pull_status["status"] == "pulling":
+        error = f"Model {model_name} is being downloaded. Please wait and try again later."
+    elif pull_status["status"] == "failed":
+        error = f"Failed to download model {model_name}. Please pull it manually with 'ollama pull {model_name}'."
+    else:
+        error = f"Model {model_name} is not available. Please pull it with 'ollama pull {model_name}'."
+    return {'success': False, 'error': error}, 500
+
+def plan_diffusion_results(prompts, enhanced_prompts, model_name, width, height, num_images=1, seed=None,
+                           preset=DEFAULT_PRESET):
+    """
+    Look up the prompts of a diffusion request in the result cache
+
+    Returns (results, pending). results has an entry per output image,
+    [prompt, cache key, image or None, manifest]: cache hits carry their
+    cached_variants() in place of the manifest, and images still to be
+    generated are True until fill_results() is given those of the
+    (enhanced prompt, seed) requests in pending.
+    """
+    results = []
+    pending = []
+    # Cache keys identify one image per request, so only single images are cached
+    for prompt, enhanced_prompt in zip(prompts, enhanced_prompts):
+        key = None
+        if num_images == 1:
+            key = generation_cache_key(prompt, enhanced_prompt, model_name, width, height, seed, preset)
+            cached = lookup_result(key)
+            if cached:
+                results.append([prompt, key, None, cached])
+                continue
+        prompt_seed = random_seed() if seed is None else seed
+        pending.append((enhanced_prompt, prompt_seed))
+        for index in range(num_images):
+            manifest = generation_manifest(
+                prompt, enhanced_prompt, model_name, width, height, prompt_seed + index, preset
+            )
+            results.append([prompt, key, True, manifest])
+    return results, pending
+
+def fill_results(results, images):
+    """Hand the generated images, ordered by request, to the result entries waiting for them"""
+    images = iter(images)
+    for entry in results:
+        if entry[2] is True:
+            entry[2] = next(images)
+
+def unsupported_model_results(prompts, model_type, width, height):
+    """Result entries with a fallback image for each prompt of a model type nothing can run"""
+    FALLBACK_IMAGES.inc(len(prompts), reason='unsupported_model')
+    return [
+        [prompt, None, create_fallback_image(prompt, f"Unsupported model type: {model_type}", width, height), None]
+        for prompt in prompts
+    ]
+
+@STAGE_SECONDS.time(stage='save')
+def save_results(results):
+    """Store the new images of result entries and describe every entry for the response"""
+    images = []
+    for prompt, key, image, manifest in results:
+        if image is None:
+            # Cache hits carry their cached_variants() instead of a manifest
+            entry = {'prompt': prompt, 'cached': True}
+            entry.update(manifest)
+        else:
+            entry = {'prompt': prompt, 'cached': False, 'manifest': manifest}
+            entry.update(save_result(image, key, manifest))
+        images.append(entry)
+    return images
+
+def generation_response(images, timestamp):
+    """Return the success response of a generation job with the images from save_results()"""
+    return {
+        'success': True,
+        'message': 'Image generated successfully',
+        'image_path': images[0]['image_path'],
+        'preview_path': images[0]['preview_path'],
+        'thumbnail_path': images[0]['thumbnail_path'],
+        'manifest': images[0]['manifest'],
+        'images': images,
+        'timestamp': timestamp
+    }, 200
+
+def generation_error_response(error, prompt, width, height):
+    """Return the error response of a failed generation job, with a fallback image showing the error"""
+    # Print full error details to console
+    traceback.print_exception(type(error), error, error.__traceback__)
+    
+    # Generate a fallback image with error message
+    try:
+        error_message = str(error)
+        if len(error_message) > 100:
+            error_message = error_message[:97] + "..."
         
-        # Add timestamp to prevent browser caching
-        image_url = url_for('static', filename=f'images/{filename}') + f'?t={timestamp}'
+        FALLBACK_IMAGES.inc(reason='error')
+        image_url = save_fallback_image(prompt, error_message, width, height)
         
-        # Return success response with image path
-        return jsonify({
+        # Return error response with fallback image
+        return {
+            'success': False,
+            'error': str(error),
+            'fallback_image': image_url
+        }, 500
+    except:
+        # Return plain error if even fallback fails
+        return {
+            'success': False,
+            'error': str(error)
+        }, 500
+
+@app.route('/generate', methods=['POST'])
+def generate():
+    """Queue an image generation job and return its id immediately"""
+    # Get the text prompt from the form
+    prompt = request.form.get('prompt', '')
+    
+    if not prompt:
+        return jsonify({'success': False, 'error': 'No prompt provided'}), 400
+    
+    # Get model selection
+    model_name = request.form.get('model', DEFAULT_MODEL)
+    
+    # Get image size from the form
+    size = parse_size(request.form.get('size', '512x512'))
+    if size is None:
+        return jsonify({'success': False, 'error': 'Invalid size, expected WIDTHxHEIGHT'}), 400
+    width, height = size
+    num_images = parse_num_images(request.form.get('num_images', 1))
+    preset = parse_preset(request.form.get('preset'), model_name)
+    seed = parse_seed(request.form.get('seed'))
+    
+    # Answer repeat requests straight from the cache without queueing
+    response = cached_response(prompt, model_name, width, height, num_images, preset, seed)
+    if response:
+        return jsonify(response)
+    
+    try:
+        job = generation_queue.submit(
+            run_generation, prompt, model_name, width, height, num_images, preset, seed, group=job_group(model_name)
+        )
+    except QueueFullError as e:
+        return queue_full_response(e)
+    
+    return job_accepted_response(job)
+
+def job_group(model_name):
+    """Group diffusion jobs by checkpoint so the queue can minimise switches"""
+    return model_name if MODELS.get(model_name, {}).get("type") == "diffusion" else None
+
+def cached_response(prompt, model_name, width, height, num_images=1, preset=DEFAULT_PRESET, seed=None):
+    """Return the response for a request the result cache can answer without a job, or None"""
+    model_type = MODELS.get(model_name, {}).get("type")
+    key = None
+    if num_images == 1 and model_type == "multimodal":
+        key = generation_cache_key(prompt, None, model_name, width, height)
+    elif num_images == 1 and model_type == "diffusion":
+        # Only possible when the enhanced prompt is already memoized
+        enhanced_prompt = cached_enhanced_prompt(prompt)
+        if enhanced_prompt is not None:
+            key = generation_cache_key(prompt, enhanced_prompt, model_name, width, height, seed, preset)
+    cached = cached_variants(key) if key else None
+    if cached:
+        # Misses are counted by the job that then looks the key up again
+        CACHE_LOOKUPS.inc(cache='result', result='hit')
+        print(f"Serving cached result {key[:12]}")
+        return cached_result(cached)
+    return None
+
+@app.route('/generate_batch', methods=['POST'])
+def generate_batch():
+    """
+    Queue a batched generation job
+
+    Expects JSON: {"prompts": [...], "model": ..., "size": "512x512",
+    "num_images": n, "preset": "fast", "seed": 42}. The job result lists
+    one entry per image.
+    """
+    data = request.get_json(silent=True) or {}
+    prompts = [p for p in data.get('prompts', []) if isinstance(p, str) and p.strip()]
+    
+    if not prompts:
+        return jsonify({'success': False, 'error': 'No prompts provided'}), 400
+    if len(prompts) > MAX_BATCH_PROMPTS:
+        return jsonify({'success': False, 'error': f"At most {MAX_BATCH_PROMPTS} prompts per batch"}), 400
+    
+    model_name = data.get('model', DEFAULT_MODEL)
+    size = parse_size(data.get('size', '512x512'))
+    if size is None:
+        return jsonify({'success': False, 'error': 'Invalid size, expected WIDTHxHEIGHT'}), 400
+    width, height = size
+    num_images = parse_num_images(data.get('num_images', 1))
+    preset = parse_preset(data.get('preset'), model_name)
+    seed = parse_seed(data.get('seed'))
+    
+    try:
+        job = generation_queue.submit(
+            run_batch_generation, prompts, model_name, width, height, num_images, preset, seed,
+            group=job_group(model_name)
+        )
+    except QueueFullError as e:
+        return queue_full_response(e)
+    
+    return job_accepted_response(job)
+
+@app.route('/replay', methods=['POST'])
+def replay():
+    """
+    Queue a job that regenerates an image from its manifest
+
+    Expects JSON: {"manifest": {...}} as returned with every image, and
+    optionally "size" and "preset" overrides, e.g. to render a good draft
+    again at a higher resolution or quality. The recorded enhanced prompt
+    and seed are reused, so the prompt generator is skipped.
+    """
+    arguments = replay_arguments(request.get_json(silent=True) or {})
+    if arguments is None:
+        return jsonify({'success': False, 'error': 'Missing or invalid manifest or size'}), 400
+    
+    try:
+        job = generation_queue.submit(run_generation, group=job_group(arguments['model_name']), **arguments)
+    except QueueFullError as e:
+        return queue_full_response(e)
+    
+    return job_accepted_response(job)
+
+def replay_arguments(data):
+    """
+    Return the run_generation() keyword arguments that replay a manifest, or None if it is invalid
+    """
+    manifest = data.get('manifest')
+    if not isinstance(manifest, dict) or not isinstance(manifest.get('prompt'), str) or not manifest['prompt'].strip():
+        return None
+    
+    size = data.get('size')
+    if not size:
+        width, height = manifest.get('width', 512), manifest.get('height', 512)
+        if type(width) is int and type(height) is int:
+            size = f"{width}x{height}"
+    size = parse_size(size)
+    if size is None:
+        return None
+    width, height = size
+    enhanced_prompt = manifest.get('enhanced_prompt')
+    if not isinstance(enhanced_prompt, str):
+        enhanced_prompt = None
+    model_name = manifest.get('model', DEFAULT_MODEL)
+    return {
+        'prompt': manifest['prompt'],
+        'model_name': model_name,
+        'width': width,
+        'height': height,
+        'preset': parse_preset(data.get('preset') or manifest.get('preset'), model_name),
+        'seed': parse_seed(manifest.get('seed')),
+        'enhanced_prompt': enhanced_prompt
+    }
+
+def parse_size(size_option):
+    """
+    Parse a WIDTHxHEIGHT size option into (width, height), or return None if it isn't one
+
+    Each side is clamped to 64..MAX_IMAGE_SIZE and rounded down to a
+    multiple of 8, which Stable Diffusion requires.
+    """
+    if not isinstance(size_option, str):
+        return None
+    match = re.fullmatch(r'\s*(\d+)\s*x\s*(\d+)\s*', size_option, re.ASCII | re.IGNORECASE)
+    if match is None:
+        return None
+    return tuple(max(64, min(int(side), MAX_IMAGE_SIZE)) // 8 * 8 for side in match.groups())
+
+def parse_num_images(value):
+    """Parse the requested number of images per prompt, clamped to the allowed range"""
+    try:
+        num_images = int(value)
+    except (TypeError, ValueError):
+        num_images = 1
+    return max(1, min(num_images, MAX_IMAGES_PER_PROMPT))
+
+def parse_preset(value, model_name=None):
+    """Return the requested preset name, or the default one if it is unknown or unusable with the model"""
+    return resolve_preset(value, DEFAULT_PRESET, model_name in SD_LCM_MODELS)
+
+def parse_seed(value):
+    """Parse a requested seed; a missing, invalid or negative one means a random seed"""
+    try:
+        seed = int(value)
+    except (TypeError, ValueError):
+        return None
+    return seed if 0 <= seed < 2 ** 32 else None
+
+def queue_full_response(error):
+    """Tell the client to retry later because the job queue is full"""
+    response = jsonify({'success': False, 'error': str(error)})
+    response.headers['Retry-After'] = '5'
+    return response, 503
+
+def job_accepted_response(job):
+    """Return the 202 response pointing the client at a queued job"""
+    return jsonify({
+        'success': True,
+        'job_id': job.id,
+        'status': job.status,
+        'status_url': url_for('get_job_status', job_id=job.id),
+        'result_url': url_for('get_job_result', job_id=job.id)
+    }), 202
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job_status(job_id):
+    """Get the status of a generation job"""
+    job = generation_queue.get(job_id)
+    if job is None:
+        return jsonify({'success': False, 'error': f"Unknown job: {job_id}"}), 404
+    
+    status = job.to_dict()
+    status['success'] = True
+    status['queue_position'] = generation_queue.position(job)
+    return jsonify(status)
+
+def job_result(job, queue=generation_queue):
+    """Return the (response, status_code) describing a job's outcome or state"""
+    if not job.done:
+        return {
             'success': True,
-            'message': 'Image generated successfully',
-            'image_path': image_url,
-            'timestamp': timestamp
-        })
+            'job_id': job.id,
+            'status': job.status,
+            'progress': job.progress,
+            'queue_position': queue.position(job)
+        }, 202
     
-    except Exception as e:
-        # Print full error details to console
-        import traceback
-        traceback.print_exc()
+    if job.status == "cancelled":
+        return {'success': False, 'job_id': job.id, 'status': job.status, 'error': job.error}, 409
+    
+    if job.status == "failed":
+        return {'success': False, 'job_id': job.id, 'error': job.error}, 500
+    
+    response, status_code = job.result
+    return dict(response, job_id=job.id), status_code
+
+@app.route('/jobs/<job_id>/result', methods=['GET'])
+def get_job_result(job_id):
+    """Get the result of a generation job, or 202 while it is still running"""
+    job = generation_queue.get(job_id)
+    if job is None:
+        return jsonify({'success': False, 'error': f"Unknown job: {job_id}"}), 404
+    
+    response, status_code = job_result(job)
+    return jsonify(response), status_code
+
+@app.route('/jobs/<job_id>/events', methods=['GET'])
+def stream_job_events(job_id):
+    """
+    Stream a job's progress as Server-Sent Events, ending with its result
+
+    Each stream keeps a worker thread busy until its job finishes, which is
+    why the page only uses it with JOB_EVENTS=1.
+    """
+    job = generation_queue.get(job_id)
+    if job is None:
+        return jsonify({'success': False, 'error': f"Unknown job: {job_id}"}), 404
+    
+    def events():
+        nonlocal job
+        version = None
+        last_sent = 0
+        while not job.done:
+            if job.progress_version != version:
+                version = job.progress_version
+                last_sent = time.time()
+                state = dict(job.progress, status=job.status,
+                             queue_position=generation_queue.position(job))
+                yield f"event: progress\ndata: {json.dumps(state)}\n\n"
+            elif time.time() - last_sent > 15:
+                # Keep idle connections from being closed by proxies
+                last_sent = time.time()
+                yield ": keep-alive\n\n"
+            time.sleep(0.25)
+            # Jobs of other worker processes are snapshots
+            job = generation_queue.get(job_id) or job
         
-        # Generate a fallback image with error message
-        try:
-            error_message = str(e)
-            if len(error_message) > 100:
-                error_message = error_message[:97] + "..."
-                
-            timestamp = int(time.time())
-            filename = f"error_{uuid.uuid4()}_{timestamp}.png"
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            
-            fallback_image = create_fallback_image(prompt, error_message, width, height)
-            fallback_image.save(filepath)
-            
-            image_url = url_for('static', filename=f'images/{filename}') + f'?t={timestamp}'
-            
-            # Return error response with fallback image
-            return jsonify({
-                'success': False,
-                'error': str(e),
-                'fallback_image': image_url
-            }), 500
-        except:
-            # Return plain error if even fallback fails
-            return jsonify({
-                'success': False,
-                'error': str(e)
-            }), 500
+        response, status_code = job_result(job)
+        yield f"event: result\ndata: {json.dumps(dict(response, status_code=status_code))}\n\n"
+    
+    return Response(events(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'  # Stop nginx from buffering the stream
+    })
+
+@app.route('/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    """Cancel a queued or running generation job"""
+    if not generation_queue.cancel(job_id):
+        return jsonify({'success': False, 'error': f"Job {job_id} is unknown or already finished"}), 404
+    return jsonify({'success': True, 'job_id': job_id})
 
 @app.route('/pull_model/<model_name>', methods=['POST'])
 def start_model_pull(model_name):
     """Start pulling a model"""
+    response, status_code = model_pull_response(model_name)
+    return jsonify(response), status_code
+
+def model_pull_response(model_name):
+    """Start pulling a model and return the (response, status_code) describing it"""
     if model_name not in MODELS:
-        return jsonify({
+        return {
             'success': False,
             'error': f"Unknown model: {model_name}"
-        }), 400
+        }, 400
     
     # Check if Ollama is running
     if not ensure_ollama_running():
-        return jsonify({
+        return {
             'success': False,
             'error': 'Ollama is not running. Please install and start Ollama.'
-        }), 500
+        }, 500
     
-    # Start pulling the model
+    # Start pulling the model, or join the pull already running
     pull_status = pull_model(model_name)
     
-    return jsonify({
-        'success': True,
-        'status': pull_status["status"],
-        'message': f"Started pulling model {model_name}"
-    })
+    response = dict(pull_status, success=True, message=f"Started pulling model {model_name}")
+    return response, 200
 
 @app.route('/model_status/<model_name>', methods=['GET'])
 def get_model_status(model_name):
     """Get the status of a model"""
+    response, status_code = model_status_response(model_name)
+    return jsonify(response), status_code
+
+def model_status_response(model_name):
+    """Return the (response, status_code) describing a model's availability"""
     if model_name not in MODELS:
-        return jsonify({
+        return {
             'success': False,
             'error': f"Unknown model: {model_name}"
-        }), 400
+        }, 400
     
     # Check if model is available locally
     if is_model_available(model_name):
-        return jsonify({
+        return {
             'success': True,
             'status': 'available'
-        })
+        }, 200
     
-    # Check pull status
-    if model_name in MODEL_PULLING_STATUS:
-        return jsonify({
-            'success': True,
-            'status': MODEL_PULLING_STATUS[model_name]
-        })
+    # Check pull status, including the progress of a running pull
+    pull_status = model_pulls.status(model_name)
+    if pull_status is not None:
+        return dict(pull_status, success=True), 200
     
-    return jsonify({
+    return {
         'success': True,
         'status': 'not_pulled'
-    })
+    }, 200
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Expose pipeline metrics in the Prometheus text format"""
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
 
-# Custom route to serve images with no caching
+# Stored images are immutable, so they are served with long-lived caching headers
 @app.route('/image/<path:filename>')
 def serve_image(filename):
-    response = send_from_directory(app.config['UPLOAD_FOLDER'], filename)
-    response.headers['Cache-Control'] = 'no-store, no-cache, must-revalidate, max-age=0'
-    response.headers['Pragma'] = 'no-cache'
-    response.headers['Expires'] = '0'
+    """
+    Serve a stored image through the storage backend
+
+    Images are named after their contents (error images after everything
+    drawn on them), so a URL never changes what it serves and responses may
+    be cached forever.
+    Conditional requests are answered with 304, and local files support
+    Range requests or are handed to the front-end server to send.
+    """
+    url = storage.url(filename)
+    if url:
+        return redirect(url)
+    
+    etag = image_etag(filename)
+    if etag is None:
+        abort(404)
+    
+    content_type = image_content_type(filename)
+    delivery = image_delivery(etag, request.if_none_match)
+    if delivery == 'not_modified':
+        response = Response(status=304)
+    elif delivery == 'offload':
+        # nginx sends the file from an internal location
+        response = Response(mimetype=content_type)
+        response.headers['X-Accel-Redirect'] = IMAGE_OFFLOAD_PREFIX + filename
+    elif delivery == 'local':
+        # Handles Range requests, and X-Sendfile when app.use_x_sendfile is set
+        response = send_from_directory(storage.root, filename, etag=etag)
+    else:
+        try:
+            body = storage.open(filename)
+        except FileNotFoundError:
+            abort(404)
+        response = Response(iter(lambda: body.read(64 * 1024), b''), mimetype=content_type)
+        response.call_on_close(body.close)
+    
+    return with_image_headers(response, etag)
+
+def image_etag(filename):
+    """Return the ETag of a stored image, or None if there is no such image"""
+    try:
+        return storage.etag(filename)
+    except ValueError:
+        # Names escaping the storage root
+        return None
+
+def image_content_type(filename):
+    return CONTENT_TYPES.get(os.path.splitext(filename)[1], 'application/octet-stream')
+
+def image_delivery(etag, if_none_match):
+    """
+    Decide how a stored image is sent
+
+    Returns 'not_modified' when the client has it already, 'offload' when
+    nginx sends local files, 'local' to send them from the app and
+    'stream' to relay them from the storage backend.
+    """
+    if etag in if_none_match:
+        return 'not_modified'
+    if isinstance(storage, LocalStorage):
+        return 'offload' if IMAGE_OFFLOAD == 'x-accel-redirect' else 'local'
+    return 'stream'
+
+def with_image_headers(response, etag):
+    """Add the validator and the caching headers every image response carries"""
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = IMAGE_CACHE_CONTROL
     return response
 
 if __name__ == '__main__':
@@ -0,0 +1,62 @@
+"""
+Benchmark the CPU inference modes of the local diffusers generator
+
+Run from the repository root:
+
+    python -m benchmarks.bench_cpu_modes --modes fp32,bf16,int8 --runs 3
+
+Reports seconds per image for each mode and the mean absolute pixel
+difference from the fp32 output for the same seed, so the fastest mode
+that is still accurate enough can be picked for HF_CPU_MODE.
+"""
+import argparse
+import time
+import numpy as np
+import torch
+from utils.hf_image_generator import DEFAULT_MODEL_ID, get_pipeline, clear_pipelines
+
+def run_mode(model_id, mode, args):
+    """Time one mode and return (seconds per image, first image)"""
+    entry = get_pipeline(model_id, device="cpu", cpu_mode=mode)
+
+    def generate():
+        return entry.pipeline(
+            prompt=args.prompt,
+            width=args.size,
+            height=args.size,
+            num_inference_steps=args.steps,
+            generator=torch.Generator("cpu").manual_seed(args.seed)
+        ).images[0]
+
+    # The first call pays for lazy initialisation (and compilation)
+    image = generate()
+    start = time.perf_counter()
+    for _ in range(args.runs):
+        generate()
+    elapsed = (time.perf_counter() - start) / args.runs
+    clear_pipelines()
+    return elapsed, image
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--model", default=DEFAULT_MODEL_ID)
+    parser.add_argument("--modes", default="fp32,bf16,int8")
+    parser.add_argument("--prompt", default="a bird flying over the sea at sunset")
+    parser.add_argument("--size", type=int, default=512)
+    parser.add_argument("--steps", type=int, default=20)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    reference = None
+    print(f"{'mode':<8}{'s/image':>10}{'diff vs fp32':>15}")
+    for mode in args.modes.split(","):
+        seconds, image = run_mode(args.model, mode.strip(), args)
+        pixels = np.asarray(image, dtype=np.float32)
+        if mode.strip() == "fp32":
+            reference = pixels
+        diff = f"{np.abs(pixels - reference).mean():.2f}" if reference is not None else "-"
+        print(f"{mode:<8}{seconds:>10.2f}{diff:>15}")
+
+if __name__ == "__main__":
+    main()
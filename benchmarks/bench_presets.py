@@ -0,0 +1,86 @@
+"""
+Measure the latency of each speed/quality preset
+
+Run from the repository root:
+
+    python -m benchmarks.bench_presets --backend diffusers
+    python -m benchmarks.bench_presets --backend a1111 --sd-host http://localhost:7860
+
+Reports seconds per image for every preset in utils.presets. The turbo
+preset only produces usable images with LCM/turbo checkpoints, so it is
+skipped unless the diffusers checkpoint's name marks it as one, or --lcm
+says the Automatic1111 server has one loaded.
+"""
+import argparse
+import time
+from utils.presets import PRESETS, available_presets, is_lcm_checkpoint
+
+def time_diffusers(preset, args):
+    """Return seconds per image for a preset on the local diffusers pipeline"""
+    from utils.hf_image_generator import generate_images
+    settings = {
+        'width': args.size,
+        'height': args.size,
+        'preset': preset,
+        'use_cache': False
+    }
+    if args.model:
+        settings['model_id'] = args.model
+    # Warm-up loads the pipeline and builds the scheduler
+    generate_images([args.prompt], settings)
+    start = time.perf_counter()
+    for _ in range(args.runs):
+        generate_images([args.prompt], settings)
+    return (time.perf_counter() - start) / args.runs
+
+def time_a1111(preset, args):
+    """Return seconds per image for a preset on an Automatic1111 server"""
+    from utils.http_clients import BackendClient
+    client = BackendClient(args.sd_host, default_timeout=600)
+    settings = PRESETS[preset]
+    payload = {
+        "prompt": args.prompt,
+        "width": args.size,
+        "height": args.size,
+        "steps": settings['steps'],
+        "cfg_scale": settings['cfg_scale'],
+        "sampler_name": settings['sampler']
+    }
+    client.post("/sdapi/v1/txt2img", json=payload)
+    start = time.perf_counter()
+    for _ in range(args.runs):
+        response = client.post("/sdapi/v1/txt2img", json=payload)
+        if response.status_code != 200:
+            raise Exception(f"API error: {response.text}")
+    return (time.perf_counter() - start) / args.runs
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--backend", choices=["diffusers", "a1111"], default="diffusers")
+    parser.add_argument("--sd-host", default="http://localhost:7860")
+    parser.add_argument("--model", help="Diffusers checkpoint (default HF_MODEL_ID)")
+    parser.add_argument("--lcm", action="store_true", help="The Automatic1111 checkpoint is LCM-distilled")
+    parser.add_argument("--presets", default=",".join(PRESETS))
+    parser.add_argument("--prompt", default="a bird flying over the sea at sunset")
+    parser.add_argument("--size", type=int, default=512)
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.backend == "diffusers":
+        from utils.hf_image_generator import DEFAULT_MODEL_ID
+        measure, lcm = time_diffusers, is_lcm_checkpoint(args.model or DEFAULT_MODEL_ID)
+    else:
+        measure, lcm = time_a1111, args.lcm
+    usable = available_presets(lcm)
+
+    print(f"{'preset':<10}{'steps':>6}{'s/image':>10}")
+    for preset in args.presets.split(","):
+        preset = preset.strip()
+        if preset not in usable:
+            print(f"{preset:<10}{PRESETS[preset]['steps']:>6}{'skipped':>10}  (needs an LCM checkpoint)")
+            continue
+        seconds = measure(preset, args)
+        print(f"{preset:<10}{PRESETS[preset]['steps']:>6}{seconds:>10.2f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""
+Micro-benchmark the text and fallback image renderers
+
+Run from the repository root:
+
+    python -m benchmarks.bench_renderers --runs 50
+
+Reports milliseconds per image for create_text_image and
+create_fallback_image at several sizes, rendered on the calling thread and
+through the render process pool (RENDER_PROCESSES).
+"""
+import argparse
+import time
+from utils import renderers
+
+DESCRIPTION = (
+    "A bird glides low over a calm sea at sunset. The sky fades from orange to violet, "
+    "and the last light catches the tips of the waves. "
+) * 4
+
+def text_image(width, height):
+    return renderers.render_text_image("a bird flying over the sea", DESCRIPTION, width, height)
+
+def fallback_image(width, height):
+    return renderers.render_fallback_image(
+        "a bird flying over the sea",
+        "Automatic1111 API is not available",
+        "Install Automatic1111 and start the API server",
+        width,
+        height
+    )
+
+BENCHMARKS = {
+    'create_text_image': text_image,
+    'create_fallback_image': fallback_image
+}
+
+def time_render(func, width, height, runs, pooled):
+    """Return milliseconds per image"""
+    # Warm-up fills the font and background caches (and starts the pool)
+    renderers.render(func, width, height) if pooled else func(width, height)
+    start = time.perf_counter()
+    for _ in range(runs):
+        if pooled:
+            renderers.render(func, width, height)
+        else:
+            func(width, height)
+    return (time.perf_counter() - start) / runs * 1000
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", default="512x512,1024x1024,512x768")
+    parser.add_argument("--runs", type=int, default=20)
+    args = parser.parse_args()
+
+    print(f"{'renderer':<24}{'size':>11}{'inline ms':>11}{'pool ms':>10}")
+    try:
+        for name, func in BENCHMARKS.items():
+            for size in args.sizes.split(","):
+                width, height = map(int, size.split("x"))
+                inline = time_render(func, width, height, args.runs, pooled=False)
+                pooled = time_render(func, width, height, args.runs, pooled=True)
+                print(f"{name:<24}{size:>11}{inline:>11.1f}{pooled:>10.1f}")
+    finally:
+        renderers.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+"""
+Load-test the web app against mock backends
+
+Run from the repository root:
+
+    python -m benchmarks.load_test --requests 200 --concurrency 8
+    python -m benchmarks.load_test --url http://localhost:5000 --scenarios generate
+
+Without --url the app is started in-process (with its images written to a
+temporary directory) against the stand-ins from benchmarks.mock_backends,
+whose latency flags are accepted here too. Reports requests/sec and
+p50/p95/p99 latency for "/" and for "/generate", measured from submitting
+the job until its result is available.
+"""
+import os
+import sys
+import math
+import time
+import uuid
+import logging
+import argparse
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from benchmarks.mock_backends import start_mock_backends, add_latency_arguments, latency_from_args
+
+_local = threading.local()
+
+def session():
+    """Return this thread's keep-alive session"""
+    if not hasattr(_local, "session"):
+        _local.session = requests.Session()
+    return _local.session
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a list of numbers"""
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, math.ceil(fraction * len(ordered)) - 1))
+    return ordered[index]
+
+def request_index(base_url, args, number):
+    response = session().get(f"{base_url}/")
+    return response.status_code == 200
+
+def request_generate(base_url, args, number):
+    """Submit a generation and poll until its result is ready"""
+    prompt = args.prompt if args.repeat else f"{args.prompt} #{number} {uuid.uuid4().hex[:8]}"
+    response = session().post(f"{base_url}/generate", data={
+        'prompt': prompt,
+        'model': args.model,
+        'size': args.size,
+        'preset': args.preset
+    })
+    if response.status_code == 200:
+        # Answered from the result cache
+        return True
+    if response.status_code != 202:
+        return False
+
+    result_url = f"{base_url}{response.json()['result_url']}"
+    while True:
+        response = session().get(result_url)
+        if response.status_code != 202:
+            return response.status_code == 200 and response.json().get('success', False)
+        time.sleep(args.poll_interval)
+
+SCENARIOS = {
+    'index': request_index,
+    'generate': request_generate
+}
+
+def run_scenario(name, base_url, args):
+    """Send args.requests requests with args.concurrency in flight and return the statistics"""
+    func = SCENARIOS[name]
+    latencies = []
+    failures = 0
+    lock = threading.Lock()
+
+    def one(number):
+        nonlocal failures
+        start = time.perf_counter()
+        try:
+            ok = func(base_url, args, number)
+        except requests.RequestException:
+            ok = False
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed)
+            if not ok:
+                failures += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(one, range(args.requests)))
+    wall = time.perf_counter() - start
+
+    return {
+        'requests': len(latencies),
+        'failures': failures,
+        'rps': len(latencies) / wall,
+        'p50': percentile(latencies, 0.50),
+        'p95': percentile(latencies, 0.95),
+        'p99': percentile(latencies, 0.99)
+    }
+
+def start_app(args):
+    """Start mock backends and the app in this process; return the app's URL"""
+    ollama, automatic1111 = start_mock_backends(latency=latency_from_args(args))
+    os.environ['OLLAMA_HOST'] = ollama.url
+    os.environ['SD_API_HOST'] = automatic1111.url
+
+    # The app stores images relative to the working directory
+    os.chdir(tempfile.mkdtemp(prefix="load-test-"))
+    import app_hf
+    from werkzeug.serving import make_server
+
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = make_server("127.0.0.1", 0, app_hf.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"App on port {server.server_port} (images in {os.getcwd()}), "
+          f"mock Ollama on {ollama.url}, mock Automatic1111 on {automatic1111.url}")
+    return f"http://127.0.0.1:{server.server_port}"
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--url", help="Test a running app instead of starting one")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--model", default="sdxl")
+    parser.add_argument("--size", default="512x512")
+    parser.add_argument("--preset", default="fast")
+    parser.add_argument("--prompt", default="a bird flying over the sea at sunset")
+    parser.add_argument("--repeat", action="store_true", help="Send the same prompt every time (cache hits)")
+    parser.add_argument("--poll-interval", type=float, default=0.05)
+    add_latency_arguments(parser)
+    args = parser.parse_args()
+
+    # Let app_hf be imported after changing directory
+    sys.path.insert(0, os.getcwd())
+    base_url = args.url.rstrip("/") if args.url else start_app(args)
+
+    print(f"{'scenario':<10}{'requests':>9}{'failed':>8}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    for name in args.scenarios.split(","):
+        name = name.strip()
+        stats = run_scenario(name, base_url, args)
+        print(f"{name:<10}{stats['requests']:>9}{stats['failures']:>8}{stats['rps']:>9.1f}"
+              f"{stats['p50'] * 1000:>9.0f}{stats['p95'] * 1000:>9.0f}{stats['p99'] * 1000:>9.0f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,288 @@
+"""
+Stand-ins for the Ollama and Automatic1111 APIs with configurable latency
+
+Run from the repository root to serve both on their usual ports:
+
+    python -m benchmarks.mock_backends --txt2img-latency 2 --token-latency 0.02
+
+then start the app with OLLAMA_HOST/SD_API_HOST pointing at them. The
+servers answer every endpoint the app calls with well-formed responses
+(solid-colour PNGs for txt2img), sleeping as configured so the app's own
+overhead can be measured without GPUs or real models.
+"""
+import io
+import sys
+import json
+import time
+import base64
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from PIL import Image
+
+# Models the mock Ollama reports as installed
+OLLAMA_MODELS = [
+    "llava",
+    "llava:13b",
+    "bakllava",
+    "sdxl",
+    "stablelm-zephyr",
+    "brxce/stable-diffusion-prompt-generator"
+]
+
+# Checkpoints the mock Automatic1111 reports
+SD_CHECKPOINTS = [
+    "sdxl_base_1.0.safetensors [31e35c80fc]",
+    "v1-5-pruned-emaonly.safetensors [6ce0161689]"
+]
+
+# Seconds each operation takes; the CLI flags override these
+DEFAULT_LATENCY = {
+    'tags': 0.005,
+    'token': 0.01,      # Per generated token
+    'tokens': 40,       # Tokens per completion
+    'pull': 2.0,        # Whole download
+    'sd_models': 0.005,
+    'options': 0.005,
+    'checkpoint': 1.0,  # Switching checkpoints
+    'txt2img': 1.0,     # Per txt2img call
+    'image': 0.5        # Per image in the call
+}
+
+_png_cache = {}
+_png_lock = threading.Lock()
+
+def solid_png(width, height):
+    """Return a base64 PNG of the given size (cached, so serving it is cheap)"""
+    with _png_lock:
+        if (width, height) not in _png_cache:
+            buffer = io.BytesIO()
+            Image.new("RGB", (width, height), (40, 90, 140)).save(buffer, format="PNG")
+            _png_cache[(width, height)] = base64.b64encode(buffer.getvalue()).decode("ascii")
+        return _png_cache[(width, height)]
+
+class _Handler(BaseHTTPRequestHandler):
+    """Shared request plumbing; subclasses map paths to methods in ROUTES"""
+
+    ROUTES = {}
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def latency(self):
+        return self.server.latency
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if not length:
+            return {}
+        return json.loads(self.rfile.read(length))
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def start_ndjson(self):
+        """Start a chunked NDJSON response; write lines with send_line()"""
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+    def send_line(self, data):
+        line = json.dumps(data).encode("utf-8") + b"\n"
+        self.wfile.write(f"{len(line):x}\r\n".encode("ascii") + line + b"\r\n")
+        self.wfile.flush()
+
+    def end_ndjson(self):
+        self.wfile.write(b"0\r\n\r\n")
+
+    def dispatch(self, method):
+        route = self.ROUTES.get((method, self.path.split("?")[0]))
+        if route is None:
+            self.send_json({"error": "not found"}, 404)
+            return
+        getattr(self, route)()
+
+    def do_GET(self):
+        self.dispatch("GET")
+
+    def do_POST(self):
+        self.dispatch("POST")
+
+class OllamaHandler(_Handler):
+    ROUTES = {
+        ("GET", "/api/tags"): "tags",
+        ("POST", "/api/generate"): "generate",
+        ("POST", "/api/pull"): "pull"
+    }
+
+    def tags(self):
+        time.sleep(self.latency['tags'])
+        models = [{"name": name, "size": 4 * 1024 ** 3} for name in self.server.models]
+        self.send_json({"models": models})
+
+    def generate(self):
+        request = self.read_json()
+        prompt = request.get("prompt", "")
+        words = (prompt + ", highly detailed, dramatic lighting, 8k").split()
+        tokens = [words[i % len(words)] + " " for i in range(self.latency['tokens'])]
+
+        if not request.get("stream", True):
+            time.sleep(self.latency['token'] * len(tokens))
+            self.send_json({"model": request.get("model"), "response": "".join(tokens), "done": True})
+            return
+
+        self.start_ndjson()
+        try:
+            for token in tokens:
+                time.sleep(self.latency['token'])
+                self.send_line({"model": request.get("model"), "response": token, "done": False})
+            self.send_line({"model": request.get("model"), "response": "", "done": True})
+            self.end_ndjson()
+        except (BrokenPipeError, ConnectionResetError):
+            # The client stopped reading early, as streaming callers may
+            self.close_connection = True
+
+    def pull(self):
+        request = self.read_json()
+        name = request.get("name") or request.get("model")
+        total = 4 * 1024 ** 3
+        steps = 10
+
+        self.start_ndjson()
+        self.send_line({"status": "pulling manifest"})
+        for step in range(1, steps + 1):
+            time.sleep(self.latency['pull'] / steps)
+            self.send_line({"status": "downloading", "digest": "sha256:mock", "total": total,
+                            "completed": total * step // steps})
+        if name and name not in self.server.models:
+            self.server.models.append(name)
+        self.send_line({"status": "success"})
+        self.end_ndjson()
+
+class Automatic1111Handler(_Handler):
+    ROUTES = {
+        ("GET", "/sdapi/v1/sd-models"): "sd_models",
+        ("GET", "/sdapi/v1/options"): "get_options",
+        ("POST", "/sdapi/v1/options"): "set_options",
+        ("POST", "/sdapi/v1/txt2img"): "txt2img",
+        ("GET", "/sdapi/v1/progress"): "progress",
+        ("POST", "/sdapi/v1/interrupt"): "interrupt"
+    }
+
+    def sd_models(self):
+        time.sleep(self.latency['sd_models'])
+        self.send_json([{"title": title, "model_name": title.split(".")[0]} for title in SD_CHECKPOINTS])
+
+    def get_options(self):
+        time.sleep(self.latency['options'])
+        self.send_json({"sd_model_checkpoint": self.server.checkpoint})
+
+    def set_options(self):
+        checkpoint = self.read_json().get("sd_model_checkpoint")
+        if checkpoint and checkpoint != self.server.checkpoint:
+            time.sleep(self.latency['checkpoint'])
+            self.server.checkpoint = checkpoint
+        self.send_json({})
+
+    def txt2img(self):
+        request = self.read_json()
+        count = int(request.get("batch_size", 1)) * int(request.get("n_iter", 1))
+        image = solid_png(int(request.get("width", 512)), int(request.get("height", 512)))
+
+        # Automatic1111 processes one request at a time
+        with self.server.gpu:
+            self.server.sampling = int(request.get("steps", 20))
+            time.sleep(self.latency['txt2img'] + self.latency['image'] * count)
+            self.server.sampling = 0
+
+        self.send_json({
+            "images": [image] * count,
+            "parameters": request,
+            "info": json.dumps({"seed": request.get("seed", -1)})
+        })
+
+    def progress(self):
+        steps = self.server.sampling
+        self.send_json({
+            "progress": 0.5 if steps else 0,
+            "eta_relative": 0,
+            "state": {"sampling_step": steps // 2, "sampling_steps": steps},
+            "current_image": None
+        })
+
+    def interrupt(self):
+        self.send_json({})
+
+class MockServer(ThreadingHTTPServer):
+    """A mock backend serving on a background thread"""
+
+    daemon_threads = True
+
+    def __init__(self, handler, port=0, latency=None):
+        super().__init__(("127.0.0.1", port), handler)
+        self.latency = dict(DEFAULT_LATENCY, **(latency or {}))
+        self.models = list(OLLAMA_MODELS)
+        self.checkpoint = SD_CHECKPOINTS[0]
+        self.sampling = 0
+        self.gpu = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def handle_error(self, request, client_address):
+        # Load generators hang up on streams they no longer need
+        if isinstance(sys.exc_info()[1], (BrokenPipeError, ConnectionResetError)):
+            return
+        super().handle_error(request, client_address)
+
+def start_mock_backends(ollama_port=0, sd_port=0, latency=None):
+    """Start both mock servers and return (ollama, automatic1111); port 0 picks a free one"""
+    ollama = MockServer(OllamaHandler, ollama_port, latency).start()
+    automatic1111 = MockServer(Automatic1111Handler, sd_port, latency).start()
+    return ollama, automatic1111
+
+def add_latency_arguments(parser):
+    """Add a --<name>-latency flag for every entry of DEFAULT_LATENCY"""
+    for name, value in DEFAULT_LATENCY.items():
+        flag = "--tokens" if name == "tokens" else f"--{name.replace('_', '-')}-latency"
+        parser.add_argument(flag, dest=f"latency_{name}", type=type(value), default=value)
+
+def latency_from_args(args):
+    return {name: getattr(args, f"latency_{name}") for name in DEFAULT_LATENCY}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--ollama-port", type=int, default=11434)
+    parser.add_argument("--sd-port", type=int, default=7860)
+    add_latency_arguments(parser)
+    args = parser.parse_args()
+
+    ollama, automatic1111 = start_mock_backends(args.ollama_port, args.sd_port, latency_from_args(args))
+    print(f"Mock Ollama on {ollama.url}, mock Automatic1111 on {automatic1111.url} (Ctrl+C to stop)")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -73,6 +73,42 @@ def test_creation():
     print(f"✅ SUCCESS! Image saved to {os.path.abspath(test_image_path)}")
     return True
 
+def test_size_validation():
+    """Sizes must be WIDTHxHEIGHT strings and are clamped to what the page offers"""
+    from app_hf import app, parse_size, replay_arguments
+    
+    assert parse_size("768x512") == (768, 512)
+    assert parse_size("50000x50000") == (1024, 1024)
+    assert parse_size("1000X10") == (1000, 64)
+    for size in ["abcx1", "1x2x3", 512, None, "x512", "-512x512"]:
+        assert parse_size(size) is None
+    
+    client = app.test_client()
+    response = client.post('/generate_batch', json={'prompts': ['a bird'], 'size': 'abcx1'})
+    assert response.status_code == 400
+    assert client.post('/generate', data={'prompt': 'a bird', 'size': 512}).status_code == 400
+    
+    manifest = {'prompt': 'a bird', 'width': '512', 'height': 512}
+    assert replay_arguments({'manifest': manifest}) is None
+    assert replay_arguments({'manifest': manifest, 'size': '512x768'})['height'] == 768
+    assert client.post('/replay', json={'manifest': manifest}).status_code == 400
+
+def test_shared_generation_helpers():
+    """The request and result helpers both apps share split batches and drop the grid image"""
+    from app_hf import txt2img_payload, txt2img_images, fill_results, parse_ollama_line, add_token
+    
+    payload = txt2img_payload("a bird", 512, 512, num_images=5, seed=7)
+    assert payload['batch_size'] * payload['n_iter'] >= 5 and payload['seed'] == 7
+    images = [b"grid"] + [bytes([i]) for i in range(payload['batch_size'] * payload['n_iter'])]
+    assert txt2img_images(images, payload, 5) == images[1:6]
+    
+    results = [["a", None, None, {}], ["b", None, True, {}], ["c", None, True, {}]]
+    fill_results(results, ["image b", "image c"])
+    assert [entry[2] for entry in results] == [None, "image b", "image c"]
+    
+    assert parse_ollama_line('{"response": "bird", "done": false}') == ("bird", False)
+    assert add_token("a ", "bird", "llava", max_chars=6) == ("a bird", True)
+
 if __name__ == "__main__":
     result = test_creation()
     if result:
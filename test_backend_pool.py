@@ -0,0 +1,62 @@
+"""
+Tests for routing requests across backend servers
+"""
+import requests
+from utils.backend_pool import BackendPool, parse_hosts
+
+class FakeClient:
+    """Stands in for a BackendClient; fails with a connection error when down"""
+
+    def __init__(self, base_url, down=False):
+        self.base_url = base_url
+        self.down = down
+        self.timeouts = {}
+        self.calls = 0
+
+    def request(self, method, path, **kwargs):
+        self.calls += 1
+        if self.down:
+            raise requests.exceptions.ConnectionError(f"{self.base_url} refused the connection")
+        return self.base_url
+
+def test_parse_hosts():
+    """Hosts are split on commas, trimmed and lose trailing slashes"""
+    assert parse_hosts("http://a:1/, http://b:2 ,") == ["http://a:1", "http://b:2"]
+    assert parse_hosts(None) == []
+
+def test_least_busy_node_with_affinity_slack():
+    """Requests go to the least busy node unless a preferred one is close enough"""
+    pool = BackendPool('test', [FakeClient("http://a"), FakeClient("http://b")], affinity_slack=1)
+    a, b = pool.nodes
+
+    with pool.acquire() as first:
+        with pool.acquire() as second:
+            # Idle nodes are used in turn
+            assert {first, second} == {a, b}
+
+    prefer_a = lambda node: node is a
+    with pool.acquire(prefer_a), pool.acquire(prefer_a) as node:
+        # One request beyond the least busy node is within the slack
+        assert node is a
+        with pool.acquire(prefer_a) as node:
+            # Two is not
+            assert node is b
+
+def test_failover_marks_node_failed():
+    """A node refusing connections is skipped until its cooldown has passed"""
+    down, up = FakeClient("http://down", down=True), FakeClient("http://up")
+    pool = BackendPool('test', [down, up], cooldown=60)
+
+    assert pool.get("/status", prefer=lambda node: node.client is down) == "http://up"
+    assert not pool.nodes[0].healthy
+
+    assert [pool.get("/status") for _ in range(3)] == ["http://up"] * 3
+    assert down.calls == 1
+
+    # With every node down the error reaches the caller
+    up.down = True
+    try:
+        pool.get("/status")
+        assert False, "expected a ConnectionError"
+    except requests.exceptions.ConnectionError:
+        pass
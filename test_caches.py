@@ -0,0 +1,156 @@
+"""
+Tests for the generation result and prompt caches
+"""
+import os
+import time
+import sqlite3
+import tempfile
+import threading
+from PIL import Image
+from utils.result_cache import ResultCache, cache_key, normalize_prompt
+from utils.prompt_cache import PromptCache
+from utils.singleflight import SingleFlight
+
+def test_cache_key_ignores_prompt_formatting():
+    """Case and whitespace differences map to the same key"""
+    a = cache_key(prompt=normalize_prompt("A  Flying Bird "), width=512)
+    b = cache_key(prompt=normalize_prompt("a flying bird"), width=512)
+    c = cache_key(prompt=normalize_prompt("a flying bird"), width=768)
+    
+    assert a == b
+    assert a != c
+
+def test_result_cache_round_trip():
+    """A stored image is returned on the next lookup"""
+    with tempfile.TemporaryDirectory() as directory:
+        cache = ResultCache(directory)
+        key = cache_key(prompt="bird")
+        
+        assert cache.get(key) is None
+        cache.put(key, Image.new('RGB', (8, 8), (255, 0, 0)))
+        
+        path = cache.get(key)
+        assert path == os.path.join(directory, f"{key}.png")
+        assert Image.open(path).getpixel((0, 0)) == (255, 0, 0)
+
+def test_result_cache_evicts_least_recently_used():
+    """Entries beyond max_entries are removed oldest first"""
+    with tempfile.TemporaryDirectory() as directory:
+        cache = ResultCache(directory, max_entries=2)
+        keys = [cache_key(n=n) for n in range(3)]
+        
+        for i, key in enumerate(keys[:2]):
+            cache.put(key, b"data")
+            os.utime(cache.path(key), (time.time() - 100 + i, time.time() - 100 + i))
+        cache.put(keys[2], b"data")
+        
+        assert cache.get(keys[0]) is None
+        assert cache.get(keys[1]) is not None
+        assert cache.get(keys[2]) is not None
+
+def test_result_cache_counts_entries_not_files():
+    """With entry_extension, an entry made of an index and its images counts once"""
+    with tempfile.TemporaryDirectory() as directory:
+        cache = ResultCache(directory, max_entries=2, entry_extension=".json")
+        for n in range(2):
+            for extension in (".json", ".png", ".webp", ".jpg"):
+                cache.put(cache_key(n=n), b"data", extension)
+        
+        assert cache.evict() == 0
+        assert cache.get(cache_key(n=0), ".json") is not None
+
+def test_result_cache_expires_old_entries():
+    """Entries older than max_age are treated as misses"""
+    with tempfile.TemporaryDirectory() as directory:
+        cache = ResultCache(directory, max_age=60)
+        key = cache_key(prompt="old")
+        cache.put(key, b"data")
+        os.utime(cache.path(key), (time.time() - 120, time.time() - 120))
+        
+        assert cache.get(key) is None
+        assert not os.path.exists(cache.path(key))
+
+def test_prompt_cache_is_bounded_lru():
+    """The least recently used prompt is dropped first"""
+    cache = PromptCache(max_entries=2)
+    cache.put("a", "enhanced a")
+    cache.put("b", "enhanced b")
+    cache.get("a")
+    cache.put("c", "enhanced c")
+    
+    assert cache.get("a") == "enhanced a"
+    assert cache.get("b") is None
+    assert len(cache) == 2
+
+def test_prompt_cache_persists_to_disk():
+    """Entries written to SQLite are visible to a new cache instance"""
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "prompts.db")
+        PromptCache(path=path).put("bird", "a majestic bird, 4k")
+        
+        assert PromptCache(path=path).get("bird") == "a majestic bird, 4k"
+
+def test_prompt_cache_trims_disk_by_last_use():
+    """Hits keep an entry on disk ahead of newer but unused ones"""
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "prompts.db")
+        writer = PromptCache(path=path, max_disk_entries=2)
+        writer.put("old", "enhanced old")
+        writer.put("new", "enhanced new")
+        assert PromptCache(path=path, flush_interval=0).get("old") == "enhanced old"
+        
+        # Trimming keeps the rows used most recently
+        used_at = dict(sqlite3.connect(path).execute("SELECT key, used_at FROM prompts"))
+        assert used_at["old"] > used_at["new"]
+
+def test_singleflight_shares_concurrent_calls():
+    """Concurrent calls for one key run the function once"""
+    flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+    results = []
+    
+    def slow():
+        calls.append(1)
+        started.set()
+        release.wait()
+        return "done"
+    
+    leader = threading.Thread(target=lambda: results.append(flight.do("k", slow)))
+    leader.start()
+    started.wait()
+    follower = threading.Thread(target=lambda: results.append(flight.do("k", slow)))
+    follower.start()
+    while not follower.is_alive():
+        time.sleep(0.01)
+    time.sleep(0.05)
+    release.set()
+    leader.join()
+    follower.join()
+    
+    assert calls == [1]
+    assert results == ["done", "done"]
+
+def test_cached_results_never_change_their_urls(monkeypatch):
+    """Regenerating a cached request stores new files instead of rewriting the old ones"""
+    import app_hf
+    with tempfile.TemporaryDirectory() as directory:
+        cache = ResultCache(directory, prefix='cache', shard=True, evict_on_put=False)
+        monkeypatch.setattr(app_hf, "result_cache", cache)
+        monkeypatch.setattr(app_hf.storage_gc, "start", lambda: None)
+        key = cache_key(prompt="bird", seed=None)
+        
+        first = app_hf.save_result(Image.new('RGB', (8, 8), (255, 0, 0)), key, {'seed': 1})
+        assert app_hf.cached_variants(key)['image_path'] == first['image_path']
+        
+        # e.g. after the entry was evicted, with a new random seed
+        second = app_hf.save_result(Image.new('RGB', (8, 8), (0, 0, 255)), key, {'seed': 2})
+        assert second['image_path'] != first['image_path']
+        cached = app_hf.cached_variants(key)
+        assert cached['image_path'] == second['image_path']
+        assert cached['manifest'] == {'seed': 2}
+        
+        old = first['image_path'][len('/image/cache/'):]
+        assert Image.open(os.path.join(directory, 'cache', old)).getpixel((0, 0)) == (255, 0, 0)
+        assert app_hf.cached_variants(cache_key(prompt="other")) is None
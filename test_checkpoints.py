@@ -0,0 +1,73 @@
+"""
+Tests for switching Automatic1111 checkpoints
+"""
+import threading
+from utils.checkpoints import CheckpointManager
+
+class FakeResponse:
+    def __init__(self, data, status_code=200):
+        self.data = data
+        self.status_code = status_code
+        self.text = str(data)
+
+    def json(self):
+        return self.data
+
+class FakeClient:
+    """Stands in for Automatic1111's model list and options endpoints"""
+
+    def __init__(self, titles):
+        self.titles = titles
+        self.loaded = titles[0]
+        self.switching = threading.Event()
+        self.release = threading.Event()
+        self.release.set()
+
+    def get(self, path, timeout=None):
+        if path == "/sdapi/v1/sd-models":
+            return FakeResponse([{"title": title} for title in self.titles])
+        return FakeResponse({"sd_model_checkpoint": self.loaded})
+
+    def post(self, path, json=None):
+        self.switching.set()
+        self.release.wait()
+        self.loaded = json["sd_model_checkpoint"]
+        return FakeResponse({})
+
+def test_missing_checkpoint_is_looked_up_again():
+    """A name without a checkpoint is retried once miss_ttl has passed"""
+    client = FakeClient(["v1-5-pruned.safetensors"])
+    manager = CheckpointManager(client, miss_ttl=0)
+    assert manager.resolve("sdxl") is None
+
+    client.titles.append("sdxl_base_1.0.safetensors")
+    assert manager.resolve("sdxl") == "sdxl_base_1.0.safetensors"
+
+def test_switch_runs_without_the_lock():
+    """A slow checkpoint load holds back other leases but not the manager's lock"""
+    client = FakeClient(["v1-5-pruned.safetensors", "sdxl_base_1.0.safetensors"])
+    manager = CheckpointManager(client)
+    client.release.clear()
+    used = []
+
+    def use(model_name):
+        with manager.use(model_name) as title:
+            used.append(title)
+
+    switcher = threading.Thread(target=use, args=("sdxl",), daemon=True)
+    switcher.start()
+    assert client.switching.wait(5)
+
+    waiter = threading.Thread(target=use, args=("v1-5",), daemon=True)
+    waiter.start()
+    # invalidate() takes the lock, which the switch no longer holds
+    invalidated = threading.Thread(target=manager.invalidate, daemon=True)
+    invalidated.start()
+    invalidated.join(5)
+    assert not invalidated.is_alive()
+    assert used == []
+
+    client.release.set()
+    switcher.join(5)
+    waiter.join(5)
+    assert used == ["sdxl_base_1.0.safetensors", "v1-5-pruned.safetensors"]
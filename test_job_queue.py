@@ -0,0 +1,181 @@
+"""
+Tests for the background generation job queue
+"""
+import time
+import threading
+from utils.job_queue import JobQueue, JobStore, QueueFullError, current_job
+
+def wait_for(job, timeout=5):
+    """Wait until a job has finished"""
+    deadline = time.time() + timeout
+    while not job.done and time.time() < deadline:
+        time.sleep(0.01)
+    return job
+
+def test_job_completes():
+    """A submitted job runs on a worker and keeps its result"""
+    queue = JobQueue(workers=1)
+    job = wait_for(queue.submit(lambda a, b: a + b, 2, 3))
+    
+    assert job.status == "completed"
+    assert job.result == 5
+    assert queue.get(job.id) is job
+
+def test_job_failure_is_recorded():
+    """An exception in a job marks it failed instead of killing the worker"""
+    queue = JobQueue(workers=1)
+    
+    def explode():
+        raise ValueError("boom")
+    
+    failed = wait_for(queue.submit(explode))
+    assert failed.status == "failed"
+    assert failed.error == "boom"
+    
+    # The worker is still alive for the next job
+    assert wait_for(queue.submit(lambda: "ok")).result == "ok"
+
+def test_queue_applies_backpressure():
+    """Submitting beyond max_pending raises QueueFullError"""
+    queue = JobQueue(workers=1, max_pending=1)
+    release = threading.Event()
+    
+    running = queue.submit(release.wait)
+    while running.status != "running":
+        time.sleep(0.01)
+    queued = queue.submit(lambda: None)
+    
+    try:
+        queue.submit(lambda: None)
+        assert False, "expected QueueFullError"
+    except QueueFullError:
+        pass
+    
+    assert queue.position(queued) == 0
+    release.set()
+    assert wait_for(queued).status == "completed"
+
+def test_preferred_group_runs_first():
+    """Queued jobs for the preferred group jump ahead of other groups"""
+    queue = JobQueue(workers=1, preferred_group=lambda: "sdxl")
+    release = threading.Event()
+    order = []
+    
+    blocker = queue.submit(release.wait)
+    while blocker.status != "running":
+        time.sleep(0.01)
+    other = queue.submit(order.append, "other", group="sd15")
+    preferred = queue.submit(order.append, "sdxl", group="sdxl")
+    
+    release.set()
+    wait_for(other)
+    wait_for(preferred)
+    assert order == ["sdxl", "other"]
+
+def test_cancel_queued_and_running_jobs():
+    """Queued jobs are dropped at once; running jobs stop at their next check"""
+    from utils.job_queue import current_job
+    queue = JobQueue(workers=1)
+    started = threading.Event()
+    
+    def cooperative():
+        started.set()
+        while True:
+            current_job().check_cancelled()
+            time.sleep(0.01)
+    
+    running = queue.submit(cooperative)
+    started.wait()
+    queued = queue.submit(lambda: "never")
+    
+    assert queue.cancel(queued.id)
+    assert queued.status == "cancelled"
+    assert queue.cancel(running.id)
+    assert wait_for(running).status == "cancelled"
+    assert not queue.cancel(running.id)
+
+def test_microbatcher_fuses_concurrent_requests():
+    """Compatible requests arriving together run as one batch"""
+    from utils.batch_scheduler import MicroBatcher
+    calls = []
+    
+    def run_batch(key, items):
+        calls.append(list(items))
+        return [item.upper() for item in items]
+    
+    batcher = MicroBatcher(run_batch, max_batch_size=3, max_wait=0.5)
+    results = {}
+    threads = [
+        threading.Thread(target=lambda p=p: results.__setitem__(p, batcher.submit("512", p)))
+        for p in ("a", "b", "c")
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    
+    assert results == {"a": "A", "b": "B", "c": "C"}
+    assert len(calls) == 1
+    assert sorted(calls[0]) == ["a", "b", "c"]
+
+def test_async_queue_runs_and_cancels_tasks():
+    """AsyncJobQueue limits concurrent tasks and cancelling stops a running task"""
+    import asyncio
+    from utils.job_queue import AsyncJobQueue, current_job
+    
+    async def scenario():
+        queue = AsyncJobQueue(workers=1, max_pending=1)
+        
+        async def work(seconds):
+            await asyncio.sleep(seconds)
+            return current_job().id
+        
+        running = queue.submit(work, 10)
+        await asyncio.sleep(0)
+        queued = queue.submit(work, 0)
+        try:
+            queue.submit(work, 0)
+            assert False, "expected QueueFullError"
+        except QueueFullError:
+            pass
+        assert queue.position(queued) == 0
+        assert queue.stats()['running'] == 1
+        
+        assert queue.cancel(running.id)
+        while not queued.done:
+            await asyncio.sleep(0.01)
+        return running, queued
+    
+    running, queued = asyncio.run(scenario())
+    assert running.status == "cancelled"
+    assert queued.status == "completed"
+    assert queued.result == queued.id
+
+def test_store_shares_jobs_between_processes(tmp_path):
+    """A job accepted by one queue can be followed and cancelled through another"""
+    path = str(tmp_path / "jobs.sqlite3")
+    owner = JobQueue(workers=1, store=JobStore(path), sync_interval=0.05)
+    other = JobQueue(workers=1, store=JobStore(path))
+    
+    def generate():
+        job = current_job()
+        job.update_progress(stage='sampling')
+        while True:
+            job.check_cancelled()
+            time.sleep(0.01)
+    
+    def seen_by_other(job_id, check):
+        deadline = time.time() + 5
+        while not check(other.get(job_id)) and time.time() < deadline:
+            time.sleep(0.01)
+        return other.get(job_id)
+    
+    finished = owner.submit(lambda: ({'success': True}, 200))
+    assert seen_by_other(finished.id, lambda job: job.done).result == ({'success': True}, 200)
+    
+    running = owner.submit(generate)
+    assert seen_by_other(running.id, lambda job: job.progress.get('stage') == 'sampling').status == "running"
+    
+    assert other.cancel(running.id)
+    assert wait_for(running).status == "cancelled"
+    assert other.get("unknown") is None and not other.cancel("unknown")
@@ -0,0 +1,48 @@
+"""
+Tests for streaming base64 image extraction
+"""
+import json
+import base64
+import pytest
+from utils.json_images import Base64ArrayParser, iter_base64_array
+
+def split(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+def test_images_decoded_across_chunk_boundaries():
+    """Every image comes back intact however the body is chunked"""
+    images = [bytes(range(256)) * 40, b"\x89PNG small", b"x"]
+    body = json.dumps({
+        "images": [base64.b64encode(image).decode() for image in images],
+        "parameters": {"prompt": '"images": ["nope"]'},
+        "info": "{}"
+    }).encode()
+
+    for size in (1, 3, 7, 64, len(body)):
+        decoded = [bytes(item) for item in iter_base64_array(split(body, size), size_hint=16)]
+        assert decoded == images
+
+def test_escaped_slashes_are_ignored():
+    """JSON encoders that escape "/" don't corrupt the image"""
+    image = b"\xff\xfe\xfd" * 100
+    encoded = base64.b64encode(image).decode().replace("/", "\\/")
+    body = ('{"images": ["%s"]}' % encoded).encode()
+
+    assert [bytes(item) for item in iter_base64_array(split(body, 5))] == [image]
+
+def test_missing_or_truncated_array():
+    """A body without images yields nothing; a cut-off one is an error"""
+    assert list(iter_base64_array([b'{"detail": "error"}'])) == []
+    with pytest.raises(ValueError):
+        list(iter_base64_array([b'{"images": ["aGVsbG8']))
+
+def test_parser_accepts_pushed_chunks():
+    """Base64ArrayParser returns each item from the feed() call that completes it"""
+    body = json.dumps({"images": [base64.b64encode(b"first").decode(), base64.b64encode(b"second").decode()]})
+    parser = Base64ArrayParser()
+    items = []
+    for chunk in split(body.encode(), 4):
+        items.extend(bytes(item) for item in parser.feed(chunk))
+    parser.close()
+    assert items == [b"first", b"second"]
+    assert parser.done
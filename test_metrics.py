@@ -0,0 +1,46 @@
+"""
+Tests for the Prometheus metrics
+"""
+import pytest
+from utils.metrics import Counter, Gauge, Histogram, Registry
+
+def test_histogram_buckets_are_cumulative():
+    """Each bucket counts every observation up to its bound"""
+    histogram = Histogram('stage_seconds', 'Stage latency', ('stage',), buckets=(0.1, 1))
+    histogram.observe(0.05, stage='save')
+    histogram.observe(0.5, stage='save')
+    histogram.observe(5, stage='save')
+    text = histogram.render()
+
+    assert '# TYPE stage_seconds histogram' in text
+    assert 'stage_seconds_bucket{stage="save",le="0.1"} 1' in text
+    assert 'stage_seconds_bucket{stage="save",le="1"} 2' in text
+    assert 'stage_seconds_bucket{stage="save",le="+Inf"} 3' in text
+    assert 'stage_seconds_sum{stage="save"} 5.55' in text
+    assert 'stage_seconds_count{stage="save"} 3' in text
+
+    with pytest.raises(ValueError):
+        histogram.observe(1)
+
+def test_registry_renders_counters_and_gauges():
+    """Label values are escaped and callback gauges are read at scrape time"""
+    registry = Registry()
+    counter = registry.register(Counter('responses_total', 'Responses', ('status',)))
+    counter.inc(status='200')
+    counter.inc(2, status='a "quoted" value')
+    depth = [3]
+    registry.register(Gauge('queue_pending', 'Pending jobs', func=lambda: depth[0]))
+
+    # Registering the same name again returns the existing metric
+    assert registry.register(Counter('responses_total', 'Responses', ('status',))) is counter
+
+    text = registry.render()
+    assert 'responses_total{status="200"} 1' in text
+    assert 'responses_total{status="a \\"quoted\\" value"} 2' in text
+    assert 'queue_pending 3' in text
+    depth[0] = 0
+    assert 'queue_pending 0' in registry.render()
+
+    # Another app can point the gauge at its own source
+    registry.register(Gauge('queue_pending', 'Pending jobs')).set_function(lambda: 7)
+    assert 'queue_pending 7' in registry.render()
@@ -0,0 +1,90 @@
+"""
+Tests for the background model pull manager
+"""
+import time
+import sqlite3
+import threading
+from utils.model_pulls import PullManager
+
+def wait_for_status(manager, name, status, timeout=5):
+    """Wait until a pull has reached the given status"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        state = manager.status(name)
+        if state and state['status'] == status:
+            return state
+        time.sleep(0.01)
+    raise AssertionError(f"{name} did not reach {status}: {manager.status(name)}")
+
+def test_pull_reports_progress_and_is_shared(tmp_path):
+    """A second worker joins a running pull and sees its progress"""
+    path = str(tmp_path / "pulls.sqlite3")
+    release = threading.Event()
+    calls = []
+
+    def pull(name, report):
+        calls.append(name)
+        report(250, 1000, "downloading")
+        release.wait()
+        report(1000, 1000, "success")
+
+    first = PullManager(pull, path=path)
+    second = PullManager(pull, path=path)
+    assert first.start("llava")['status'] == "pulling"
+
+    # Progress is written for other workers about once a second
+    deadline = time.time() + 5
+    while (second.status("llava") or {}).get('completed') != 250 and time.time() < deadline:
+        time.sleep(0.05)
+    state = second.start("llava")
+    assert state['percent'] == 25.0
+    assert state['detail'] == "downloading"
+
+    release.set()
+    assert wait_for_status(second, "llava", "completed")['percent'] == 100.0
+    assert calls == ["llava"]
+
+def test_failed_pull_can_be_retried():
+    """A failure is reported with its error, and starting again retries it"""
+    attempts = []
+
+    def pull(name, report):
+        attempts.append(name)
+        if len(attempts) == 1:
+            raise Exception("connection reset")
+
+    manager = PullManager(pull)
+    manager.start("sdxl")
+    assert wait_for_status(manager, "sdxl", "failed")['error'] == "connection reset"
+
+    manager.start("sdxl")
+    wait_for_status(manager, "sdxl", "completed")
+    assert attempts == ["sdxl", "sdxl"]
+
+def test_interrupted_pull_is_resumed(tmp_path):
+    """A pull left behind by a process that stopped is resumed by the next one"""
+    path = str(tmp_path / "pulls.sqlite3")
+    PullManager(lambda name, report: None, path=path)
+    # A pull whose owner stopped writing its heartbeat long ago
+    db = sqlite3.connect(path)
+    db.execute("INSERT INTO pulls VALUES ('bakllava', 'pulling', 'downloading', 5, 10, NULL, 'gone', 0)")
+    db.commit()
+
+    resumed = []
+    restarted = PullManager(lambda name, report: resumed.append(name), path=path)
+    wait_for_status(restarted, "bakllava", "completed")
+    assert resumed == ["bakllava"]
+
+def test_pull_going_stale_later_is_resumed(tmp_path):
+    """A pull whose owner stops after this process started is resumed when looked at"""
+    path = str(tmp_path / "pulls.sqlite3")
+    resumed = []
+    manager = PullManager(lambda name, report: resumed.append(name), path=path)
+    assert manager.status("moondream") is None
+
+    db = sqlite3.connect(path)
+    db.execute("INSERT INTO pulls VALUES ('moondream', 'pulling', 'downloading', 5, 10, NULL, 'gone', 0)")
+    db.commit()
+
+    wait_for_status(manager, "moondream", "completed")
+    assert resumed == ["moondream"]
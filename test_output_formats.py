@@ -0,0 +1,36 @@
+"""
+Tests for output encoding and image variants
+"""
+from io import BytesIO
+from PIL import Image
+from utils import output_formats
+
+def png_bytes(size):
+    buffer = BytesIO()
+    Image.new('RGB', size, (10, 20, 30)).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+def test_png_bytes_are_kept_unchanged():
+    """Encoded PNGs are stored as received when the output format is PNG"""
+    data = png_bytes((600, 400))
+    variants = output_formats.encode_variants(data)
+
+    assert variants['full'] == (data, '.png')
+
+def test_variants_are_downscaled():
+    """Preview and thumbnail fit their configured sizes"""
+    variants = output_formats.encode_variants(Image.new('RGB', (1024, 768)))
+
+    for name, size in (('preview', output_formats.PREVIEW_SIZE), ('thumbnail', output_formats.THUMBNAIL_SIZE)):
+        data, extension = variants[name]
+        image = Image.open(BytesIO(data))
+        assert extension == output_formats.extension(output_formats.VARIANT_FORMAT)
+        assert max(image.size) == size
+
+def test_lossy_formats():
+    """WebP and JPEG encodes open back at the original size"""
+    image = Image.new('RGB', (64, 48), (200, 100, 50))
+    for fmt in ('webp', 'jpeg'):
+        decoded = Image.open(BytesIO(output_formats.encode(image, fmt)))
+        assert decoded.size == (64, 48)
+        assert decoded.format == fmt.upper()
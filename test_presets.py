@@ -0,0 +1,13 @@
+"""
+Tests for the speed/quality presets
+"""
+from utils.presets import resolve_preset, is_lcm_checkpoint
+
+def test_turbo_preset_needs_lcm_checkpoint():
+    """The LCM-only turbo preset falls back to the default for ordinary checkpoints"""
+    assert is_lcm_checkpoint("stabilityai/sdxl-turbo") and is_lcm_checkpoint("SimianLuo/LCM_Dreamshaper_v7")
+    assert not is_lcm_checkpoint("runwayml/stable-diffusion-v1-5")
+    assert resolve_preset("turbo", "balanced", lcm=True) == "turbo"
+    assert resolve_preset("turbo", "balanced", lcm=False) == "balanced"
+    assert resolve_preset("turbo", "turbo", lcm=False) == "quality"
+    assert resolve_preset("fast", "balanced", lcm=False) == "fast"
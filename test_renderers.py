@@ -0,0 +1,39 @@
+"""
+Tests for the text and fallback image renderers
+"""
+import numpy as np
+from PIL import Image, ImageDraw
+from utils import renderers
+
+def test_gradient_matches_per_row_drawing():
+    """The NumPy gradient is pixel-identical to drawing one line per row"""
+    width, height = 64, 97
+    expected = Image.new('RGB', (width, height))
+    draw = ImageDraw.Draw(expected)
+    for y in range(height):
+        r = int(100 + (y / height) * 50)
+        g = int(150 + (y / height) * 50)
+        b = int(200 + (y / height) * 30)
+        draw.line([(0, y), (width, y)], fill=(r, g, b))
+
+    actual = renderers.gradient_background(width, height)
+
+    assert np.array_equal(np.asarray(expected), np.asarray(actual))
+
+def test_render_in_process_pool():
+    """Images rendered by the pool come back to the caller"""
+    try:
+        image = renderers.render(renderers.render_fallback_image, "a bird", "error", "help", 128, 96)
+    finally:
+        renderers.shutdown()
+
+    assert image.size == (128, 96)
+
+def test_background_cache_returns_copies():
+    """Drawing on one background leaves the cached one untouched"""
+    first = renderers.background(32, 32)
+    first.putpixel((0, 0), (0, 0, 0))
+    second = renderers.background(32, 32)
+
+    assert second.getpixel((0, 0)) == (100, 150, 200)
+    assert (32, 32) in renderers._backgrounds
@@ -0,0 +1,163 @@
+"""
+Tests for the image storage backends and retention
+"""
+import io
+import os
+import time
+import hashlib
+import tempfile
+import pytest
+from utils.storage import LocalStorage, S3Storage, StorageGC, shard_name, collect
+from utils.result_cache import ResultCache
+
+def test_shard_name_spreads_files():
+    """Hash sharding nests names two levels deep, date sharding by day"""
+    name = shard_name("image.png", "hash", "outputs")
+    assert name.startswith("outputs/") and name.endswith("/image.png")
+    assert len(name.split("/")) == 4
+    assert shard_name("image.png", "date") == time.strftime("%Y/%m/%d") + "/image.png"
+
+def test_local_storage_round_trip():
+    """Stored files can be read, listed and deleted"""
+    with tempfile.TemporaryDirectory() as directory:
+        storage = LocalStorage(directory)
+        storage.put("a/b/image.png", b"data")
+
+        with storage.open("a/b/image.png") as f:
+            assert f.read() == b"data"
+        assert [name for name, _, _ in storage.list("a")] == ["a/b/image.png"]
+
+        storage.delete("a/b/image.png")
+        assert storage.stat("a/b/image.png") is None
+        with pytest.raises(ValueError):
+            storage.path("../outside.png")
+
+def test_collect_applies_age_and_quota():
+    """Expired files go first, then the oldest ones over the byte quota"""
+    with tempfile.TemporaryDirectory() as directory:
+        storage = LocalStorage(directory)
+        now = time.time()
+        for i, age in enumerate([1000, 30, 20, 10]):
+            name = f"outputs/{i}.png"
+            storage.put(name, b"x" * 10)
+            os.utime(storage.path(name), (now - age, now - age))
+
+        gc = StorageGC(interval=0)
+        gc.register(lambda: collect(storage, "outputs", max_bytes=20, max_age=500))
+
+        assert gc.run_once() == 2
+        assert sorted(name for name, _, _ in storage.list()) == ["outputs/2.png", "outputs/3.png"]
+
+def test_etag_survives_touch():
+    """Marking a file as recently used keeps its ETag, new contents change it"""
+    with tempfile.TemporaryDirectory() as directory:
+        storage = LocalStorage(directory)
+        storage.put("image.png", b"data")
+        etag = storage.etag("image.png")
+
+        os.utime(storage.path("image.png"), (time.time() + 10, time.time() + 10))
+        assert storage.etag("image.png") == etag
+        storage.put("image.png", b"other")
+        assert storage.etag("image.png") != etag
+
+def test_serve_image_conditional_and_range(monkeypatch):
+    """Images carry an ETag, answer If-None-Match with 304 and support Range"""
+    import app_hf
+    with tempfile.TemporaryDirectory() as directory:
+        monkeypatch.setattr(app_hf, "storage", LocalStorage(directory))
+        app_hf.storage.put("outputs/image.png", b"0123456789")
+        client = app_hf.app.test_client()
+
+        response = client.get("/image/outputs/image.png")
+        etag = response.headers["ETag"]
+        assert response.status_code == 200 and response.data == b"0123456789"
+        assert "immutable" in response.headers["Cache-Control"]
+
+        response = client.get("/image/outputs/image.png", headers={"If-None-Match": etag})
+        assert response.status_code == 304 and response.data == b""
+
+        response = client.get("/image/outputs/image.png", headers={"Range": "bytes=2-5"})
+        assert response.status_code == 206 and response.data == b"2345"
+        assert response.headers["Content-Range"] == "bytes 2-5/10"
+        response.close()
+
+        assert client.get("/image/outputs/missing.png").status_code == 404
+
+class FakeS3Client:
+    """Stands in for a boto3 S3 client, following S3's rules for copying an object onto itself"""
+
+    class exceptions:
+        class ClientError(Exception):
+            pass
+
+        class NoSuchKey(ClientError):
+            pass
+
+    def __init__(self):
+        self.objects = {}
+        self.copies = 0
+        self.throttled = False
+        self.bodies = []
+
+    def put_object(self, Bucket, Key, Body, ContentType="binary/octet-stream", Metadata=None):
+        self.objects[Key] = {"Body": Body, "ContentType": ContentType, "Metadata": Metadata or {},
+                             "LastModified": time.time()}
+
+    def head_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise self.exceptions.ClientError("404 Not Found")
+        obj = self.objects[Key]
+        return {"ContentLength": len(obj["Body"]), "ContentType": obj["ContentType"], "Metadata": obj["Metadata"],
+                "LastModified": type("LastModified", (), {"timestamp": lambda _: obj["LastModified"]})(),
+                "ETag": '"%s"' % hashlib.md5(obj["Body"]).hexdigest()}
+
+    def copy_object(self, Bucket, Key, CopySource, MetadataDirective="COPY", **kwargs):
+        if CopySource["Key"] not in self.objects:
+            raise self.exceptions.ClientError("NoSuchKey")
+        if self.throttled:
+            raise self.exceptions.ClientError("503 Slow Down")
+        if CopySource["Key"] == Key and MetadataDirective != "REPLACE":
+            raise self.exceptions.ClientError("This copy request is illegal")
+        self.copies += 1
+        self.put_object(Bucket, Key, self.objects[CopySource["Key"]]["Body"], **kwargs)
+
+    def get_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise self.exceptions.NoSuchKey(Key)
+        body = io.BytesIO(self.objects[Key]["Body"])
+        self.bodies.append(body)
+        return {"Body": body}
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop(Key, None)
+
+def test_s3_cache_hits_keep_content_type():
+    """Refreshing a hot S3 entry keeps its content type and only copies it once it has aged"""
+    client = FakeS3Client()
+    cache = ResultCache(S3Storage("bucket", "images", client=client), refresh_after=60, evict_on_put=False)
+    cache.put("key", b"data")
+
+    assert cache.get("key") == "s3://bucket/images/key.png"
+    assert client.copies == 0
+
+    client.objects["images/key.png"]["LastModified"] -= 120
+    assert cache.get("key") is not None
+    assert client.copies == 1
+    assert client.objects["images/key.png"]["ContentType"] == "image/png"
+
+    # Errors from S3 are misses rather than exceptions
+    client.objects["images/key.png"]["LastModified"] -= 120
+    client.throttled = True
+    assert cache.get("key") is None
+
+def test_serve_image_streams_and_closes_s3_objects(monkeypatch):
+    """Objects without a public URL are streamed through the app and closed afterwards"""
+    import app_hf
+    client = FakeS3Client()
+    monkeypatch.setattr(app_hf, "storage", S3Storage("bucket", client=client))
+    app_hf.storage.put("outputs/image.png", b"0123456789")
+
+    response = app_hf.app.test_client().get("/image/outputs/image.png")
+    assert response.status_code == 200 and response.data == b"0123456789"
+    response.close()
+    assert [body.closed for body in client.bodies] == [True]
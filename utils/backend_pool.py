@@ -0,0 +1,224 @@
+"""
+Routing of backend requests across several Ollama or Automatic1111 servers
+"""
+import os
+import time
+import threading
+import requests
+from contextlib import contextmanager, asynccontextmanager
+from urllib.parse import urlparse
+from utils import metrics
+
+# Seconds a node that refused a connection is skipped before it is tried again
+BACKEND_FAILURE_COOLDOWN = float(os.environ.get('BACKEND_FAILURE_COOLDOWN', '30'))
+
+BACKEND_NODE_HEALTHY = metrics.gauge(
+    'backend_node_healthy',
+    'Whether a backend node is considered healthy (1) or failed (0)',
+    ('backend', 'node')
+)
+BACKEND_NODE_OUTSTANDING = metrics.gauge(
+    'backend_node_outstanding',
+    'Requests in flight on a backend node',
+    ('backend', 'node')
+)
+
+def parse_hosts(spec):
+    """Parse a comma-separated list of backend URLs"""
+    return [host.strip().rstrip("/") for host in (spec or "").split(",") if host.strip()]
+
+def is_connection_error(error):
+    """Return True if a request failed because the node could not be reached"""
+    if isinstance(error, requests.exceptions.ConnectionError):
+        return True
+    try:
+        import httpx
+    except ImportError:
+        return False
+    return isinstance(error, (httpx.ConnectError, httpx.RemoteProtocolError))
+
+class BackendNode:
+    """One server of a pool, with its client and routing state"""
+
+    def __init__(self, client):
+        self.client = client
+        self.url = client.base_url
+        self.name = urlparse(self.url).netloc
+        self.healthy = True
+        self.failed_at = None
+        self.outstanding = 0
+        self.last_used = 0
+        # Ollama models installed on the node, filled in by the health probe
+        self.models = set()
+        # Node-specific helpers, e.g. its CheckpointManager or async client
+        self.checkpoints = None
+        self.async_client = None
+
+    def available(self, cooldown):
+        """Healthy, or failed long enough ago to be tried again"""
+        return self.healthy or time.time() - self.failed_at > cooldown
+
+class BackendPool:
+    """
+    Routes requests to the least busy healthy node of a backend
+
+    Each request goes to the available node with the fewest requests in
+    flight. Callers may prefer some nodes (e.g. those with a checkpoint
+    already loaded); a preferred node is used unless it has more than
+    `affinity_slack` requests in flight beyond the least busy node. A node
+    that refuses a connection is marked failed and the request is retried
+    on another one; failed nodes are skipped for `cooldown` seconds or
+    until a health probe succeeds.
+
+    Also offers the get/post/request interface of BackendClient, so a
+    pool with one node behaves like the client itself.
+    """
+
+    def __init__(self, name, clients, affinity_slack=float("inf"), cooldown=BACKEND_FAILURE_COOLDOWN):
+        if not clients:
+            raise Exception(f"No hosts configured for {name}")
+        self.name = name
+        self.nodes = [BackendNode(client) for client in clients]
+        self.affinity_slack = affinity_slack
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        for node in self.nodes:
+            BACKEND_NODE_HEALTHY.set(1, backend=self.name, node=node.name)
+            BACKEND_NODE_OUTSTANDING.set(0, backend=self.name, node=node.name)
+
+    @property
+    def timeouts(self):
+        return self.nodes[0].client.timeouts
+
+    def timeout_for(self, path):
+        """Return the default timeout for an endpoint"""
+        return self.nodes[0].client.timeout_for(path)
+
+    def healthy_nodes(self):
+        return [node for node in self.nodes if node.healthy]
+
+    def choose(self, prefer=None, exclude=()):
+        """
+        Return the node the next request should go to, or None if all are excluded
+
+        prefer is a function of a node returning True for preferred nodes.
+        When every remaining node has failed, the one that failed longest
+        ago is returned.
+        """
+        with self._lock:
+            return self._choose(prefer, exclude)
+
+    def _choose(self, prefer, exclude):
+        candidates = [node for node in self.nodes if node not in exclude]
+        if not candidates:
+            return None
+        available = [node for node in candidates if node.available(self.cooldown)]
+        if not available:
+            return min(candidates, key=lambda node: node.failed_at)
+
+        # Spread ties over nodes by picking the one used longest ago
+        least_busy = min(available, key=lambda node: (node.outstanding, node.last_used))
+        if prefer:
+            preferred = [node for node in available if prefer(node)
+                         and node.outstanding <= least_busy.outstanding + self.affinity_slack]
+            if preferred:
+                return min(preferred, key=lambda node: (node.outstanding, node.last_used))
+        return least_busy
+
+    @contextmanager
+    def acquire(self, prefer=None, exclude=()):
+        """Choose a node and count the block as a request in flight on it"""
+        with self._lock:
+            node = self._choose(prefer, exclude)
+            if node is None:
+                raise Exception(f"No {self.name} nodes available")
+            node.outstanding += 1
+            node.last_used = time.time()
+            BACKEND_NODE_OUTSTANDING.set(node.outstanding, backend=self.name, node=node.name)
+        try:
+            yield node
+        finally:
+            with self._lock:
+                node.outstanding -= 1
+                BACKEND_NODE_OUTSTANDING.set(node.outstanding, backend=self.name, node=node.name)
+
+    def mark_failed(self, node):
+        """Stop routing to a node until it recovers"""
+        with self._lock:
+            if node.healthy:
+                print(f"⚠️ {self.name} node {node.name} failed, routing around it")
+            node.healthy = False
+            node.failed_at = time.time()
+        BACKEND_NODE_HEALTHY.set(0, backend=self.name, node=node.name)
+
+    def mark_healthy(self, node):
+        with self._lock:
+            if not node.healthy:
+                print(f"✅ {self.name} node {node.name} is back")
+            node.healthy = True
+        BACKEND_NODE_HEALTHY.set(1, backend=self.name, node=node.name)
+
+    def _failover(self, node, error, tried):
+        """Record a failed attempt; re-raise when no node is left to try"""
+        if not is_connection_error(error):
+            raise error
+        self.mark_failed(node)
+        tried.append(node)
+        if len(tried) >= len(self.nodes):
+            raise error
+        print(f"Retrying {self.name} request on another node")
+
+    @contextmanager
+    def open(self, func, prefer=None):
+        """
+        Call func(node) on a chosen node, failing over to the next node on
+        connection errors, and yield its result
+
+        The node stays counted as busy until the block ends, so streamed
+        responses can be read inside it.
+        """
+        tried = []
+        while True:
+            with self.acquire(prefer, exclude=tried) as node:
+                try:
+                    result = func(node)
+                except Exception as e:
+                    self._failover(node, e, tried)
+                    continue
+                self.mark_healthy(node)
+                yield result
+                return
+
+    @asynccontextmanager
+    async def open_async(self, func, prefer=None):
+        """asyncio form of open(), for a coroutine function func"""
+        tried = []
+        while True:
+            with self.acquire(prefer, exclude=tried) as node:
+                try:
+                    result = await func(node)
+                except Exception as e:
+                    self._failover(node, e, tried)
+                    continue
+                self.mark_healthy(node)
+                yield result
+                return
+
+    def call(self, func, prefer=None):
+        """Return func(node) from the chosen node, with failover"""
+        with self.open(func, prefer) as result:
+            return result
+
+    async def call_async(self, func, prefer=None):
+        async with self.open_async(func, prefer) as result:
+            return result
+
+    def request(self, method, path, prefer=None, **kwargs):
+        """Send a request to the least busy node"""
+        return self.call(lambda node: node.client.request(method, path, **kwargs), prefer)
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request("POST", path, **kwargs)
@@ -0,0 +1,92 @@
+"""
+Micro-batching of concurrent generation requests
+"""
+import threading
+
+class _Batch:
+    """Requests collected for one fused backend call"""
+
+    def __init__(self):
+        self.items = []
+        self.size = 0
+        self.closed = threading.Event()
+        self.done = threading.Event()
+        self.results = None
+        self.error = None
+
+class MicroBatcher:
+    """
+    Fuses compatible requests that arrive close together into one call
+
+    Requests with the same key (e.g. model, size and steps) that arrive
+    within max_wait seconds of the first are collected into a batch of at
+    most max_batch_size images. The thread that opened the batch then runs
+    run_batch(key, items) for everyone and each caller receives its own
+    slice of the results. A request larger than max_batch_size runs as a
+    batch of its own.
+    """
+
+    def __init__(self, run_batch, max_batch_size=4, max_wait=0.05):
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._open = {}
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.requests = 0
+
+    def submit(self, key, item, size=1):
+        """
+        Add item to a batch for key, wait for the batch to run and return its result
+
+        Args:
+            key: Requests are only fused with others of an equal key
+            item: The request, passed to run_batch in a list with its batch mates
+            size: How many images the request accounts for in the batch
+        """
+        with self._lock:
+            batch = self._open.get(key)
+            leader = batch is None or batch.size + size > self.max_batch_size
+            if leader:
+                if batch is not None:
+                    # No room left; start the waiting batch and open a new one
+                    batch.closed.set()
+                batch = self._open[key] = _Batch()
+            index = len(batch.items)
+            batch.items.append(item)
+            batch.size += size
+            if batch.size >= self.max_batch_size:
+                batch.closed.set()
+                del self._open[key]
+
+        if leader:
+            self._run(key, batch)
+        else:
+            batch.done.wait()
+
+        if batch.error is not None:
+            raise batch.error
+        return batch.results[index]
+
+    def _run(self, key, batch):
+        """Wait for the batch to fill (or max_wait to pass), then execute it"""
+        batch.closed.wait(self.max_wait)
+        with self._lock:
+            if self._open.get(key) is batch:
+                del self._open[key]
+            self.batches += 1
+            self.requests += len(batch.items)
+
+        if len(batch.items) > 1:
+            print(f"Running fused batch of {len(batch.items)} requests ({batch.size} images)")
+        try:
+            batch.results = self.run_batch(key, batch.items)
+        except Exception as e:
+            batch.error = e
+        finally:
+            batch.done.set()
+
+    def stats(self):
+        """Return how many batches ran and how many requests they served"""
+        with self._lock:
+            return {'batches': self.batches, 'requests': self.requests}
@@ -0,0 +1,128 @@
+"""
+Tracks the Stable Diffusion checkpoint loaded in Automatic1111
+"""
+import time
+import threading
+from contextlib import contextmanager
+
+class CheckpointManager:
+    """
+    Switches Automatic1111 checkpoints only when a request needs a different one
+
+    Model names (e.g. "sdxl") are resolved to checkpoint titles once, and the
+    currently loaded checkpoint is remembered so the options endpoint is only
+    called on an actual change. Names without a checkpoint are looked up
+    again after miss_ttl seconds, so checkpoints added later are found. Jobs
+    hold a lease on their checkpoint while they generate, so a switch never
+    happens underneath a running txt2img; the switch itself runs without
+    the lock, with other leases waiting for it to finish.
+    """
+
+    def __init__(self, client, miss_ttl=60):
+        self.client = client
+        self.miss_ttl = miss_ttl
+        self.current_title = None
+        self.current_model = None
+        self._titles = {}
+        self._misses = {}
+        self._active = 0
+        self._switching = False
+        self._cond = threading.Condition()
+
+    def resolve(self, model_name):
+        """Return the checkpoint title for a model name, or None if there is none"""
+        if model_name in self._titles:
+            return self._titles[model_name]
+        if time.time() - self._misses.get(model_name, float('-inf')) < self.miss_ttl:
+            return None
+
+        response = self.client.get("/sdapi/v1/sd-models")
+        if response.status_code != 200:
+            print("⚠️ Unable to get model list from Automatic1111")
+            return None
+
+        title = None
+        for model in response.json():
+            model_title = model.get("title", "")
+            if model_name.lower() in model_title.lower():
+                title = model_title
+                break
+
+        if title:
+            print(f"Found {model_name} checkpoint: {title}")
+            self._titles[model_name] = title
+            self._misses.pop(model_name, None)
+        else:
+            print(f"⚠️ No {model_name} checkpoint found in Automatic1111, using default model")
+            self._misses[model_name] = time.time()
+        return title
+
+    def _loaded_title(self):
+        """Return the checkpoint Automatic1111 reports as loaded"""
+        if self.current_title is None:
+            response = self.client.get("/sdapi/v1/options", timeout=10)
+            if response.status_code == 200:
+                self.current_title = response.json().get("sd_model_checkpoint")
+        return self.current_title
+
+    def _switch(self, model_name, title):
+        """Load a checkpoint unless it is already active (caller has set _switching)"""
+        if self._loaded_title() != title:
+            print(f"Switching Automatic1111 checkpoint to {title}")
+            response = self.client.post(
+                "/sdapi/v1/options",
+                json={"sd_model_checkpoint": title}
+            )
+            if response.status_code != 200:
+                raise Exception(f"Failed to switch checkpoint: {response.text}")
+            self.current_title = title
+        self.current_model = model_name
+
+    @contextmanager
+    def use(self, model_name):
+        """Hold the checkpoint for model_name loaded for the duration of the block"""
+        try:
+            title = self.resolve(model_name)
+        except Exception as e:
+            print(f"⚠️ Error resolving checkpoint in Automatic1111: {str(e)}")
+            title = None
+
+        switch = False
+        with self._cond:
+            if title:
+                # Wait for jobs on a different checkpoint, and for a switch
+                # in progress, to finish first
+                while self._switching or (self._active and self.current_title != title):
+                    self._cond.wait()
+                if self.current_title == title:
+                    self.current_model = model_name
+                else:
+                    # Other leases wait while the checkpoint loads without the lock
+                    switch = self._switching = True
+            self._active += 1
+
+        try:
+            if switch:
+                try:
+                    self._switch(model_name, title)
+                except Exception as e:
+                    # Forget what we think is loaded; it is re-read next time
+                    self.current_title = None
+                    print(f"⚠️ Error setting model in Automatic1111: {str(e)}")
+                finally:
+                    with self._cond:
+                        self._switching = False
+                        self._cond.notify_all()
+            yield title
+        finally:
+            with self._cond:
+                self._active -= 1
+                self._cond.notify_all()
+
+    def invalidate(self):
+        """Forget resolved titles and the loaded checkpoint"""
+        with self._cond:
+            self._titles.clear()
+            self._misses.clear()
+            self.current_title = None
+            self.current_model = None
@@ -0,0 +1,83 @@
+"""
+CPU performance modes for the local diffusers pipeline
+"""
+import os
+import threading
+import torch
+
+# Selected CPU mode and tuning knobs
+CPU_MODE = os.environ.get('HF_CPU_MODE', 'fp32')
+NUM_THREADS = int(os.environ.get('HF_NUM_THREADS', '0'))  # 0 = torch default
+INTEROP_THREADS = int(os.environ.get('HF_INTEROP_THREADS', '0'))
+CHANNELS_LAST = os.environ.get('HF_CHANNELS_LAST', '1') == '1'
+ATTENTION_SLICING = os.environ.get('HF_ATTENTION_SLICING', '0') == '1'
+TORCH_COMPILE = os.environ.get('HF_TORCH_COMPILE', '0') == '1'
+
+# Supported modes:
+#   fp32 - full precision, the reference for accuracy
+#   bf16 - every component in bfloat16 (fast on CPUs with AVX512-BF16/AMX)
+#   int8 - dynamic int8 quantization of the UNet and text encoder linear layers
+CPU_MODES = ('fp32', 'bf16', 'int8')
+
+_threads_configured = False
+_threads_lock = threading.Lock()
+
+def configure_threads(num_threads=NUM_THREADS, interop_threads=INTEROP_THREADS):
+    """
+    Apply the torch intra-op and inter-op thread counts once per process
+
+    The inter-op pool can only be sized before torch first uses it, so this
+    must run before the first pipeline is loaded.
+    """
+    global _threads_configured
+    with _threads_lock:
+        if _threads_configured:
+            return
+        _threads_configured = True
+
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    if interop_threads:
+        try:
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError as e:
+            print(f"⚠️ Could not set inter-op threads: {str(e)}")
+    print(f"Torch using {torch.get_num_threads()} threads, {torch.get_num_interop_threads()} inter-op threads")
+
+def mode_dtype(mode):
+    """Return the dtype a pipeline should be loaded in for a CPU mode"""
+    if mode not in CPU_MODES:
+        raise ValueError(f"Unknown CPU mode {mode!r}, expected one of {', '.join(CPU_MODES)}")
+    return torch.bfloat16 if mode == 'bf16' else torch.float32
+
+def optimize_pipeline(pipeline, mode=CPU_MODE, channels_last=CHANNELS_LAST,
+                      attention_slicing=ATTENTION_SLICING, compile=TORCH_COMPILE):
+    """
+    Apply CPU optimizations to a loaded pipeline in place
+
+    Args:
+        pipeline: A diffusers pipeline already moved to the CPU
+        mode (str): One of CPU_MODES
+        channels_last (bool): Use the channels-last memory format for the UNet and VAE
+        attention_slicing (bool): Compute attention in slices to bound peak memory
+        compile (bool): Wrap the UNet with torch.compile
+
+    Returns:
+        The same pipeline
+    """
+    if mode == 'int8':
+        from torch.ao.quantization import quantize_dynamic
+        pipeline.unet = quantize_dynamic(pipeline.unet, {torch.nn.Linear}, dtype=torch.qint8)
+        pipeline.text_encoder = quantize_dynamic(pipeline.text_encoder, {torch.nn.Linear}, dtype=torch.qint8)
+
+    if channels_last:
+        pipeline.unet.to(memory_format=torch.channels_last)
+        pipeline.vae.to(memory_format=torch.channels_last)
+
+    if attention_slicing:
+        pipeline.enable_attention_slicing()
+
+    if compile:
+        pipeline.unet = torch.compile(pipeline.unet)
+
+    return pipeline
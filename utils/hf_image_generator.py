@@ -2,9 +2,204 @@
 Simplified image generation using Hugging Face models
 """
 import os
+import gc
+import random
+import threading
+from io import BytesIO
+from collections import OrderedDict
 import torch
 from PIL import Image, ImageDraw, ImageFont
+from PIL.PngImagePlugin import PngInfo
 import numpy as np
+from utils.result_cache import ResultCache, cache_key, normalize_prompt
+from utils.storage import StorageGC, create_storage
+from utils.batch_scheduler import MicroBatcher
+from utils.cpu_inference import CPU_MODE, configure_threads, mode_dtype, optimize_pipeline
+from utils.presets import get_preset, resolve_preset, is_lcm_checkpoint
+
+# Pipeline registry configuration
+DEFAULT_MODEL_ID = os.environ.get('HF_MODEL_ID', 'runwayml/stable-diffusion-v1-5')
+PIPELINE_CACHE_SIZE = int(os.environ.get('HF_PIPELINE_CACHE_SIZE', '1'))
+# Total memory the warm pipelines may use, in MB (0 disables the budget)
+PIPELINE_MEMORY_BUDGET_MB = int(os.environ.get('HF_PIPELINE_MEMORY_BUDGET_MB', '0'))
+# Speed/quality preset used when a request doesn't name one
+DEFAULT_PRESET = os.environ.get('HF_PRESET', 'balanced')
+
+# Warm pipelines keyed by (model_id, device, dtype, cpu_mode), least recently used first
+_pipelines = OrderedDict()
+_pipelines_lock = threading.Lock()
+_loading_locks = {}
+
+# Approximate projection of Stable Diffusion 1.x latents to RGB, used for
+# cheap low-resolution previews without running the VAE decoder
+LATENT_RGB_FACTORS = [
+    [0.3512, 0.2297, 0.3227],
+    [0.3250, 0.4974, 0.2350],
+    [-0.2829, 0.1762, 0.2721],
+    [-0.2120, -0.2616, -0.7177],
+]
+
+class GenerationCancelled(Exception):
+    """Raised when a progress callback asks to stop generating"""
+
+def latents_to_preview(latents):
+    """Turn the first latent of a batch into a small RGB preview image"""
+    factors = torch.tensor(LATENT_RGB_FACTORS, dtype=torch.float32)
+    latent = latents[0].detach().to("cpu", torch.float32)
+    rgb = torch.einsum("chw,cr->hwr", latent, factors)
+    rgb = ((rgb + 1) / 2).clamp(0, 1).mul(255).byte().numpy()
+    return Image.fromarray(rgb)
+
+def _step_callback(progress_callback, total_steps, preview_every):
+    """Adapt a progress callback to the diffusers callback_on_step_end hook"""
+    def on_step_end(pipeline, step, timestep, callback_kwargs):
+        preview = None
+        if preview_every and (step + 1) % preview_every == 0:
+            preview = latents_to_preview(callback_kwargs["latents"])
+        if progress_callback(step + 1, total_steps, preview) is False:
+            raise GenerationCancelled("Generation was cancelled")
+        return callback_kwargs
+    return on_step_end
+
+# Finished images keyed by their generation parameters, under a prefix of
+# their own so this cache and the web app's never evict each other's files
+result_cache = ResultCache(
+    create_storage(os.environ.get('HF_RESULT_CACHE_DIR', os.path.join('static', 'images'))),
+    prefix='hf-cache',
+    shard=True,
+    evict_on_put=False,  # Eviction runs in storage_gc
+    max_entries=int(os.environ.get('RESULT_CACHE_MAX_ENTRIES', '1000')),
+    max_bytes=int(os.environ.get('RESULT_CACHE_MAX_MB', '1024')) * 1024 * 1024,
+    max_age=int(os.environ.get('RESULT_CACHE_MAX_AGE', str(7 * 24 * 3600)))
+)
+storage_gc = StorageGC()
+storage_gc.register(result_cache.evict)
+
+def _make_scheduler(name, config):
+    """Build a diffusers scheduler by preset scheduler name from a pipeline's scheduler config"""
+    if name == 'dpmsolver++':
+        from diffusers import DPMSolverMultistepScheduler
+        return DPMSolverMultistepScheduler.from_config(
+            config, algorithm_type="dpmsolver++", use_karras_sigmas=True
+        )
+    if name == 'lcm':
+        from diffusers import LCMScheduler
+        return LCMScheduler.from_config(config)
+    raise ValueError(f"Unknown scheduler {name!r}")
+
+class _PipelineEntry:
+    """A loaded pipeline together with its size and inference lock"""
+
+    def __init__(self, pipeline, nbytes):
+        self.pipeline = pipeline
+        self.nbytes = nbytes
+        # Diffusers pipelines keep scheduler state, so calls must not overlap
+        self.lock = threading.Lock()
+        self._schedulers = {'default': pipeline.scheduler}
+
+    def use_scheduler(self, name):
+        """Swap in the named scheduler, building it on first use (caller holds the lock)"""
+        scheduler = self._schedulers.get(name)
+        if scheduler is None:
+            config = self._schedulers['default'].config
+            scheduler = self._schedulers[name] = _make_scheduler(name, config)
+        self.pipeline.scheduler = scheduler
+
+def _pipeline_nbytes(pipeline):
+    """Estimate the memory held by the parameters and buffers of a pipeline"""
+    total = 0
+    for component in getattr(pipeline, 'components', {}).values():
+        if isinstance(component, torch.nn.Module):
+            for tensor in list(component.parameters()) + list(component.buffers()):
+                total += tensor.numel() * tensor.element_size()
+    return total
+
+def _evict_pipelines():
+    """Drop least recently used pipelines until the registry fits its limits"""
+    budget = PIPELINE_MEMORY_BUDGET_MB * 1024 * 1024
+    evicted = False
+    while len(_pipelines) > 1:
+        total = sum(entry.nbytes for entry in _pipelines.values())
+        if len(_pipelines) <= PIPELINE_CACHE_SIZE and (not budget or total <= budget):
+            break
+        key, _ = _pipelines.popitem(last=False)
+        print(f"Evicting pipeline {key[0]} ({key[1]}, {key[2]}, {key[3]})")
+        evicted = True
+
+    if evicted:
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+def _load_pipeline(model_id, device, dtype, cpu_mode=None):
+    """Load a pipeline from disk or the Hugging Face hub"""
+    from diffusers import DiffusionPipeline
+
+    if cpu_mode:
+        configure_threads()
+    print(f"Loading pipeline {model_id} on {device} ({dtype}, mode {cpu_mode or 'default'})...")
+    pipeline = DiffusionPipeline.from_pretrained(
+        model_id,
+        torch_dtype=dtype,
+        use_safetensors=True,
+        safety_checker=None  # Disable safety checker for performance
+    )
+    pipeline = pipeline.to(device)
+    if cpu_mode:
+        optimize_pipeline(pipeline, cpu_mode)
+    return pipeline
+
+def get_pipeline(model_id=None, device="cpu", dtype=torch.float32, cpu_mode=None):
+    """
+    Return a warm pipeline, loading it on first use
+
+    Pipelines stay loaded for the life of the process and are evicted in
+    least-recently-used order once HF_PIPELINE_CACHE_SIZE or
+    HF_PIPELINE_MEMORY_BUDGET_MB is exceeded. On the CPU, cpu_mode selects
+    one of the utils.cpu_inference modes (fp32, bf16, int8), which also
+    determines the dtype.
+
+    Returns:
+        _PipelineEntry: The cached pipeline and the lock to hold while using it
+    """
+    if str(device) == "cpu" and cpu_mode:
+        dtype = mode_dtype(cpu_mode)
+    else:
+        cpu_mode = None
+    key = (model_id or DEFAULT_MODEL_ID, str(device), str(dtype), cpu_mode)
+
+    with _pipelines_lock:
+        entry = _pipelines.get(key)
+        if entry is not None:
+            _pipelines.move_to_end(key)
+            return entry
+        loading_lock = _loading_locks.setdefault(key, threading.Lock())
+
+    # Only one thread loads a given model; others wait for it
+    with loading_lock:
+        with _pipelines_lock:
+            entry = _pipelines.get(key)
+            if entry is not None:
+                _pipelines.move_to_end(key)
+                return entry
+
+        pipeline = _load_pipeline(key[0], device, dtype, cpu_mode)
+        entry = _PipelineEntry(pipeline, _pipeline_nbytes(pipeline))
+
+        with _pipelines_lock:
+            _pipelines[key] = entry
+            _loading_locks.pop(key, None)
+            _evict_pipelines()
+
+    return entry
+
+def clear_pipelines():
+    """Unload every cached pipeline"""
+    with _pipelines_lock:
+        _pipelines.clear()
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
 
 def generate_image(prompt, settings=None):
     """
@@ -12,11 +207,62 @@ def generate_image(prompt, settings=None):
     
     Args:
         prompt (str): The text prompt for image generation
-        settings (dict): Optional dictionary of settings for image generation
+        settings (dict): Optional dictionary of settings for image generation.
+            'progress_callback' is called as callback(step, total_steps, preview)
+            after every denoising step, where preview is a low-resolution PIL
+            image every 'preview_every' steps (else None). Returning False
+            cancels generation with GenerationCancelled.
         
     Returns:
         PIL.Image: The generated image
     """
+    return generate_images([prompt], settings)[0]
+
+def _result_key(prompt, model_id, width, height, preset, seed=None):
+    """Return the result cache key for one generated image"""
+    return cache_key(
+        prompt=normalize_prompt(prompt),
+        enhanced_prompt=None,
+        model=model_id,
+        width=width,
+        height=height,
+        steps=preset['steps'],
+        cfg_scale=preset['cfg_scale'],
+        sampler=preset['scheduler'],
+        seed=seed
+    )
+
+def random_seed():
+    """Pick a seed for a request that didn't ask for one"""
+    return random.randrange(2 ** 32)
+
+def _encode_png(image, seed):
+    """Encode an image as PNG with its seed in a text chunk"""
+    info = PngInfo()
+    info.add_text("seed", str(seed))
+    buffer = BytesIO()
+    image.save(buffer, format="PNG", pnginfo=info)
+    return buffer.getvalue()
+
+def generate_images(prompts, settings=None):
+    """
+    Generate images for several prompts in batched pipeline calls
+    
+    Args:
+        prompts (list): The text prompts for image generation
+        settings (dict): Settings as for generate_image(), plus
+            'num_images' (images per prompt, default 1) and 'batch_size'
+            (maximum images per forward pass, default 4). 'cpu_mode'
+            overrides HF_CPU_MODE when running on the CPU, and 'preset'
+            names a utils.presets speed/quality preset (default HF_PRESET).
+            'seed' makes generation reproducible: image n of a prompt uses
+            seed + n. 'seeds' gives a seed per prompt instead. Prompts
+            without a seed get a random one.
+        
+    Returns:
+        list: PIL images, num_images per prompt, ordered by prompt. Each
+        image's seed is in image.info['seed']
+    """
     # Default settings if none provided
     if settings is None:
         settings = {}
@@ -24,6 +270,44 @@ def generate_image(prompt, settings=None):
     # Extract settings with defaults
     width = settings.get('width', 512)
     height = settings.get('height', 512)
+    model_id = settings.get('model_id') or DEFAULT_MODEL_ID
+    # The LCM scheduler of the turbo preset only works with LCM checkpoints
+    requested_preset = settings.get('preset') or DEFAULT_PRESET
+    preset_name = resolve_preset(requested_preset, DEFAULT_PRESET, is_lcm_checkpoint(model_id))
+    if preset_name != requested_preset:
+        print(f"⚠️ Preset {requested_preset} is not available for {model_id}, using {preset_name}")
+    preset = get_preset(preset_name)
+    steps = preset['steps']
+    num_images = max(1, settings.get('num_images', 1))
+    batch_size = max(num_images, settings.get('batch_size', 4))
+    requested_seeds = settings.get('seeds') or [settings.get('seed')] * len(prompts)
+    seeds = [random_seed() if seed is None else seed for seed in requested_seeds]
+    
+    # Identical requests are answered from the result cache; keys identify a
+    # single image, so only one-image-per-prompt requests are cached
+    use_cache = settings.get('use_cache', True) and num_images == 1
+    if use_cache:
+        storage_gc.start()
+    images = [None] * (len(prompts) * num_images)
+    pending = []
+    for index, prompt in enumerate(prompts):
+        key = _result_key(prompt, model_id, width, height, preset, requested_seeds[index])
+        if use_cache and result_cache.get(key):
+            print(f"Serving cached image for prompt: '{prompt}'")
+            f = result_cache.open(key)
+            try:
+                image = Image.open(BytesIO(f.read()))
+                image.load()
+            finally:
+                f.close()
+            if 'seed' in image.info:
+                image.info['seed'] = int(image.info['seed'])
+            images[index] = image
+        else:
+            pending.append(index)
+    
+    if not pending:
+        return images
     
     try:
         # Try importing numpy explicitly
@@ -38,50 +322,127 @@ def generate_image(prompt, settings=None):
             
         # Now try using diffusers
         try:
-            from diffusers import DiffusionPipeline
-            
-            # Load a simpler model - StableDiffusionXLPipeline is too complex/large
-            print("Loading small pipeline...")
-            pipeline = DiffusionPipeline.from_pretrained(
-                "runwayml/stable-diffusion-v1-5", 
-                use_safetensors=True, 
-                safety_checker=None  # Disable safety checker for performance
+            # Reuse a warm pipeline instead of loading weights per request
+            entry = get_pipeline(
+                model_id,
+                device=settings.get('device', 'cpu'),
+                dtype=settings.get('dtype', torch.float32),
+                cpu_mode=settings.get('cpu_mode', CPU_MODE)
             )
             
-            # Run on CPU only for compatibility
-            pipeline = pipeline.to("cpu")
-            
-            # Generate the image
-            print(f"Generating image with prompt: '{prompt}'")
-            result = pipeline(
-                prompt=prompt,
-                width=width,
-                height=height,
-                num_inference_steps=20,  # Keep steps low for speed
-            )
+            # Report progress from the pipeline's step hook if requested
+            extra_args = {}
+            progress_callback = settings.get('progress_callback')
+            if progress_callback:
+                extra_args['callback_on_step_end'] = _step_callback(
+                    progress_callback, steps, settings.get('preview_every', 0)
+                )
             
-            # Get the image from the result
-            image = result.images[0]
+            # Run as many prompts per forward pass as the batch size allows
+            prompts_per_batch = max(1, batch_size // num_images)
+            for start in range(0, len(pending), prompts_per_batch):
+                chunk = pending[start:start + prompts_per_batch]
+                
+                # One generator per image so every image can be reproduced alone
+                device = settings.get('device', 'cpu')
+                generators = [
+                    torch.Generator(device).manual_seed(seeds[index] + n)
+                    for index in chunk for n in range(num_images)
+                ]
+                
+                # Generate the images
+                print(f"Generating {len(chunk) * num_images} image(s) for {len(chunk)} prompt(s)")
+                with entry.lock:
+                    entry.use_scheduler(preset['scheduler'])
+                    result = entry.pipeline(
+                        prompt=[prompts[index] for index in chunk],
+                        width=width,
+                        height=height,
+                        num_inference_steps=steps,
+                        guidance_scale=preset['cfg_scale'],
+                        num_images_per_prompt=num_images,
+                        generator=generators,
+                        **extra_args
+                    )
+                
+                # The pipeline returns num_images consecutive images per prompt
+                for position, index in enumerate(chunk):
+                    for n in range(num_images):
+                        image = result.images[position * num_images + n]
+                        image.info['seed'] = seeds[index] + n
+                        images[index * num_images + n] = image
+                        if use_cache:
+                            key = _result_key(prompts[index], model_id, width, height, preset, requested_seeds[index])
+                            result_cache.put(key, _encode_png(image, seeds[index] + n))
             
-            # Clean up
-            del pipeline
-            
-            return image
+            return images
             
+        except GenerationCancelled:
+            raise
         except Exception as e:
             print(f"Error using diffusers: {str(e)}")
             import traceback
             traceback.print_exc()
             # Continue to fallback
             
+    except GenerationCancelled:
+        raise
     except Exception as e:
-        print(f"Error in generate_image: {str(e)}")
+        print(f"Error in generate_images: {str(e)}")
         import traceback
         traceback.print_exc()
     
-    # Fallback: create a simple image with the prompt text
-    print("Falling back to creating a simple image with text")
-    return create_text_image(prompt, width, height)
+    # Fallback: create simple images with the prompt text
+    print("Falling back to creating simple images with text")
+    for index, prompt in enumerate(prompts):
+        for n in range(num_images):
+            if images[index * num_images + n] is None:
+                images[index * num_images + n] = create_text_image(prompt, width, height)
+    return images
+
+def _run_fused_batch(key, items):
+    """Generate the prompts of several batched_generate_image() calls together"""
+    prompts = [prompt for prompt, _ in items]
+    # Requests in one batch share the key, so the first one's settings apply
+    # to all, except for each request's own seed
+    settings = dict(items[0][1], seeds=[request_settings.get("seed") for _, request_settings in items])
+    images = generate_images(prompts, settings)
+    num_images = len(images) // len(prompts)
+    return [images[i * num_images:(i + 1) * num_images] for i in range(len(prompts))]
+
+# Fuses concurrent compatible generate requests into one pipeline call
+_batcher = MicroBatcher(
+    _run_fused_batch,
+    max_batch_size=int(os.environ.get('MICROBATCH_MAX_SIZE', '4')),
+    max_wait=int(os.environ.get('MICROBATCH_MAX_WAIT_MS', '50')) / 1000
+)
+
+def batched_generate_image(prompt, settings=None):
+    """
+    Like generate_image(), but fused with concurrent compatible requests
+    
+    Calls from different threads with the same model, device, dtype, CPU
+    mode, preset, size and image count that arrive within MICROBATCH_MAX_WAIT_MS of each other
+    run as one pipeline batch. Per-request progress callbacks are not
+    supported in fused batches and are ignored.
+    
+    Returns:
+        list: The num_images PIL images generated for this prompt
+    """
+    settings = dict(settings or {})
+    settings.pop('progress_callback', None)
+    num_images = max(1, settings.get('num_images', 1))
+    key = (
+        settings.get('model_id') or DEFAULT_MODEL_ID,
+        str(settings.get('device', 'cpu')),
+        str(settings.get('dtype', torch.float32)),
+        settings.get('cpu_mode', CPU_MODE),
+        settings.get('preset') or DEFAULT_PRESET,
+        settings.get('width', 512),
+        settings.get('height', 512),
+        num_images
+    )
+    return _batcher.submit(key, (prompt, settings), size=num_images)
 
 def create_text_image(text, width=512, height=512):
     """Create a simple image with the text"""
@@ -0,0 +1,195 @@
+"""
+Pooled HTTP clients for the Ollama and Automatic1111 backends
+"""
+import os
+import time
+import asyncio
+import requests
+from contextlib import asynccontextmanager
+from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from utils import metrics
+
+# Connection pool and retry configuration shared by all backend clients
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', '10'))
+HTTP_RETRIES = int(os.environ.get('HTTP_RETRIES', '2'))
+HTTP_BACKOFF = float(os.environ.get('HTTP_BACKOFF', '0.3'))
+
+def parse_timeouts(spec):
+    """
+    Parse per-endpoint timeouts from a string like "/api/pull=7200,/sdapi/v1/txt2img=300"
+    """
+    timeouts = {}
+    for item in (spec or "").split(","):
+        if "=" in item:
+            path, seconds = item.split("=", 1)
+            timeouts[path.strip()] = float(seconds)
+    return timeouts
+
+# Overrides for the built-in endpoint timeouts
+HTTP_TIMEOUTS = parse_timeouts(os.environ.get('HTTP_TIMEOUTS'))
+
+# Responses to GET requests that are retried
+RETRY_STATUSES = (502, 503, 504)
+
+# For streamed responses the latency covers the time until the headers arrived
+BACKEND_LATENCY = metrics.histogram(
+    'backend_request_seconds',
+    'Latency of backend HTTP requests, including retries',
+    ('backend', 'endpoint')
+)
+BACKEND_RESPONSES = metrics.counter(
+    'backend_responses_total',
+    'Backend HTTP responses by status code ("error" when none was received)',
+    ('backend', 'endpoint', 'status')
+)
+
+class BackendClient:
+    """
+    Keep-alive HTTP client for one backend
+
+    Wraps a requests.Session whose connection pool is reused across calls
+    and threads. Connection failures, and 502/503/504 responses to GET
+    requests, are retried with exponential backoff. Each endpoint path has
+    its own default timeout, which callers can override per call.
+    Latency and status codes are recorded per endpoint under the client's
+    name (the backend's host by default).
+    """
+
+    def __init__(self, base_url, timeouts=None, default_timeout=30,
+                 pool_size=HTTP_POOL_SIZE, retries=HTTP_RETRIES, backoff=HTTP_BACKOFF, name=None):
+        self.base_url = base_url.rstrip("/")
+        self.name = name or urlparse(self.base_url).netloc
+        self.default_timeout = default_timeout
+        self.timeouts = dict(timeouts or {})
+        self.timeouts.update(HTTP_TIMEOUTS)
+
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            read=0,  # A read timeout means the backend is busy; don't pile on
+            status=retries,
+            backoff_factor=backoff,
+            status_forcelist=RETRY_STATUSES,
+            allowed_methods=frozenset(["GET", "HEAD"]),
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=pool_size,
+            max_retries=retry
+        )
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def url(self, path):
+        return f"{self.base_url}{path}"
+
+    def timeout_for(self, path):
+        """Return the default timeout for an endpoint"""
+        return self.timeouts.get(path, self.default_timeout)
+
+    def request(self, method, path, timeout=None, **kwargs):
+        """Send a request to the backend, using the endpoint's timeout unless one is given"""
+        if timeout is None:
+            timeout = self.timeout_for(path)
+
+        start = time.perf_counter()
+        status = "error"
+        try:
+            response = self.session.request(method, self.url(path), timeout=timeout, **kwargs)
+            status = response.status_code
+            return response
+        finally:
+            BACKEND_LATENCY.observe(time.perf_counter() - start, backend=self.name, endpoint=path)
+            BACKEND_RESPONSES.inc(backend=self.name, endpoint=path, status=status)
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request("POST", path, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+class AsyncBackendClient:
+    """
+    asyncio counterpart of BackendClient, used by the ASGI app
+
+    Requires httpx. Uses the same pool size, retry, timeout and metrics
+    configuration: failed connections are retried by the transport, and
+    502/503/504 responses to GET requests with exponential backoff.
+    """
+
+    def __init__(self, base_url, timeouts=None, default_timeout=30,
+                 pool_size=HTTP_POOL_SIZE, retries=HTTP_RETRIES, backoff=HTTP_BACKOFF, name=None):
+        try:
+            import httpx
+        except ImportError:
+            raise Exception("The async backend clients require httpx (pip install httpx)")
+
+        self.base_url = base_url.rstrip("/")
+        self.name = name or urlparse(self.base_url).netloc
+        self.default_timeout = default_timeout
+        self.timeouts = dict(timeouts or {})
+        self.timeouts.update(HTTP_TIMEOUTS)
+        self.retries = retries
+        self.backoff = backoff
+
+        limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+        self.client = httpx.AsyncClient(
+            base_url=self.base_url,
+            transport=httpx.AsyncHTTPTransport(retries=retries, limits=limits)
+        )
+
+    def timeout_for(self, path):
+        """Return the default timeout for an endpoint"""
+        return self.timeouts.get(path, self.default_timeout)
+
+    async def request(self, method, path, timeout=None, **kwargs):
+        """Send a request and return the response with its body read"""
+        if timeout is None:
+            timeout = self.timeout_for(path)
+
+        start = time.perf_counter()
+        status = "error"
+        try:
+            for attempt in range(self.retries + 1):
+                response = await self.client.request(method, path, timeout=timeout, **kwargs)
+                status = response.status_code
+                if method != "GET" or status not in RETRY_STATUSES or attempt == self.retries:
+                    return response
+                await asyncio.sleep(self.backoff * 2 ** attempt)
+        finally:
+            BACKEND_LATENCY.observe(time.perf_counter() - start, backend=self.name, endpoint=path)
+            BACKEND_RESPONSES.inc(backend=self.name, endpoint=path, status=status)
+
+    @asynccontextmanager
+    async def stream(self, method, path, timeout=None, **kwargs):
+        """Send a request and yield the response before its body is read"""
+        if timeout is None:
+            timeout = self.timeout_for(path)
+
+        start = time.perf_counter()
+        status = "error"
+        try:
+            async with self.client.stream(method, path, timeout=timeout, **kwargs) as response:
+                status = response.status_code
+                BACKEND_LATENCY.observe(time.perf_counter() - start, backend=self.name, endpoint=path)
+                yield response
+        finally:
+            if status == "error":
+                BACKEND_LATENCY.observe(time.perf_counter() - start, backend=self.name, endpoint=path)
+            BACKEND_RESPONSES.inc(backend=self.name, endpoint=path, status=status)
+
+    async def get(self, path, **kwargs):
+        return await self.request("GET", path, **kwargs)
+
+    async def post(self, path, **kwargs):
+        return await self.request("POST", path, **kwargs)
+
+    async def aclose(self):
+        await self.client.aclose()
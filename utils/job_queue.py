@@ -0,0 +1,475 @@
+"""
+Background job queue for long-running image generation
+"""
+import json
+import time
+import uuid
+import asyncio
+import sqlite3
+import threading
+import traceback
+import contextvars
+from collections import deque
+
+class QueueFullError(Exception):
+    """Raised when the queue already holds the maximum number of pending jobs"""
+
+class JobCancelled(Exception):
+    """Raised inside a job that has been asked to stop"""
+
+# The job each worker thread (or asyncio task) is currently running
+_local = threading.local()
+_current_task_job = contextvars.ContextVar('job', default=None)
+
+def current_job():
+    """Return the Job running on the calling worker thread or task, or None"""
+    return getattr(_local, 'job', None) or _current_task_job.get()
+
+class Job:
+    """A unit of work submitted to the queue"""
+
+    def __init__(self, func, args, kwargs, group=None):
+        self.id = str(uuid.uuid4())
+        self.group = group
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.status = "queued"  # queued, running, completed, failed, cancelled
+        self.progress = {}
+        self.progress_version = 0
+        self.cancel_requested = False
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        # Position in its queue as last written to a JobStore
+        self.queue_position = 0
+
+    @property
+    def done(self):
+        return self.status in ("completed", "failed", "cancelled")
+
+    def update_progress(self, **fields):
+        """Merge fields into the job's progress report"""
+        self.progress = dict(self.progress, **fields)
+        self.progress_version += 1
+
+    def check_cancelled(self):
+        """Raise JobCancelled if cancellation has been requested"""
+        if self.cancel_requested:
+            raise JobCancelled("Generation was cancelled")
+
+    def to_dict(self):
+        """Return a JSON-serialisable summary of the job"""
+        return {
+            'job_id': self.id,
+            'status': self.status,
+            'progress': self.progress,
+            'error': self.error,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at
+        }
+
+class JobStore:
+    """
+    Shares the state of jobs between worker processes through SQLite
+
+    A job runs in the process that accepted it, which writes its status,
+    progress and result here so any other process can report on it and
+    flag it for cancellation. Jobs whose process stopped writing for
+    stale_after seconds are reported as failed.
+    """
+
+    FIELDS = ('id', 'status', 'progress', 'progress_version', 'queue_position', 'cancel_requested',
+              'result', 'error', 'created_at', 'started_at', 'finished_at', 'updated_at')
+
+    def __init__(self, path=":memory:", stale_after=60):
+        self.stale_after = stale_after
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs "
+            "(id TEXT PRIMARY KEY, status TEXT NOT NULL, progress TEXT, progress_version INTEGER NOT NULL, "
+            "queue_position INTEGER NOT NULL, cancel_requested INTEGER NOT NULL, result TEXT, error TEXT, "
+            "created_at REAL NOT NULL, started_at REAL, finished_at REAL, updated_at REAL NOT NULL)"
+        )
+
+    def save(self, job, queue_position=0):
+        """Write a job's current state, keeping cancellation requests made elsewhere"""
+        with self._lock:
+            # Read under the lock, and never overwrite a finished job, so a
+            # late write of an older state can't undo the final one
+            values = (
+                job.id, job.status, json.dumps(job.progress, default=str), job.progress_version, queue_position,
+                int(job.cancel_requested), json.dumps(job.result, default=str), job.error,
+                job.created_at, job.started_at, job.finished_at, time.time()
+            )
+            self._db.execute(
+                f"INSERT INTO jobs ({', '.join(self.FIELDS)}) VALUES ({', '.join('?' * len(self.FIELDS))}) "
+                "ON CONFLICT(id) DO UPDATE SET status = excluded.status, progress = excluded.progress, "
+                "progress_version = excluded.progress_version, queue_position = excluded.queue_position, "
+                "cancel_requested = MAX(cancel_requested, excluded.cancel_requested), result = excluded.result, "
+                "error = excluded.error, started_at = excluded.started_at, finished_at = excluded.finished_at, "
+                "updated_at = excluded.updated_at WHERE jobs.status IN ('queued', 'running')",
+                values
+            )
+
+    def load(self, job_id):
+        """Return a snapshot of a stored job as a Job that can't be run, or None"""
+        with self._lock:
+            row = self._db.execute(
+                f"SELECT {', '.join(self.FIELDS)} FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        if row is None:
+            return None
+
+        state = dict(zip(self.FIELDS, row))
+        job = Job(None, None, None)
+        for field in ('id', 'status', 'progress_version', 'queue_position', 'error',
+                      'created_at', 'started_at', 'finished_at'):
+            setattr(job, field, state[field])
+        job.progress = json.loads(state['progress'])
+        job.cancel_requested = bool(state['cancel_requested'])
+        result = json.loads(state['result'])
+        # JSON turns the (response, status_code) tuples of the web app into lists
+        job.result = tuple(result) if isinstance(result, list) else result
+        if not job.done and time.time() - state['updated_at'] > self.stale_after:
+            job.status = "failed"
+            job.error = "The worker process running this job stopped"
+            job.finished_at = state['updated_at']
+        return job
+
+    def request_cancel(self, job_id):
+        """Flag an unfinished job for cancellation by its process; returns False if there is none"""
+        with self._lock:
+            cursor = self._db.execute(
+                "UPDATE jobs SET cancel_requested = 1 WHERE id = ? AND status IN ('queued', 'running') "
+                "AND updated_at > ?",
+                (job_id, time.time() - self.stale_after)
+            )
+        return cursor.rowcount > 0
+
+    def cancel_requested(self, job_ids):
+        """Return which of the given jobs have been flagged for cancellation"""
+        if not job_ids:
+            return set()
+        with self._lock:
+            rows = self._db.execute(
+                f"SELECT id FROM jobs WHERE cancel_requested = 1 AND id IN ({', '.join('?' * len(job_ids))})",
+                list(job_ids)
+            ).fetchall()
+        return {row[0] for row in rows}
+
+    def expire(self, cutoff):
+        """Forget jobs that finished, or stopped being updated, before cutoff"""
+        with self._lock:
+            self._db.execute(
+                "DELETE FROM jobs WHERE finished_at < ? OR updated_at < ?",
+                (cutoff, cutoff - self.stale_after)
+            )
+
+class JobQueue:
+    """
+    Bounded queue served by a fixed pool of worker threads
+
+    Submitting more than max_pending jobs raises QueueFullError so callers
+    can apply backpressure instead of queueing unbounded work. Finished
+    jobs are kept for result_ttl seconds so clients can collect results.
+
+    Jobs may carry a group (e.g. the checkpoint they need). When
+    preferred_group is given, workers run queued jobs of that group (or
+    with no group) ahead of others, unless the oldest job has already
+    waited max_group_wait seconds.
+
+    With a JobStore, jobs are also visible to the queues of other processes
+    using the same store: get() falls back to the store, cancel() flags
+    jobs there, and a sync thread writes the progress of this process's jobs
+    every sync_interval seconds and picks up their cancellation requests.
+    """
+
+    def __init__(self, workers=2, max_pending=32, result_ttl=3600,
+                 preferred_group=None, max_group_wait=30, store=None, sync_interval=1):
+        self.workers = max(1, workers)
+        self.max_pending = max_pending
+        self.result_ttl = result_ttl
+        self.preferred_group = preferred_group
+        self.max_group_wait = max_group_wait
+        self.store = store
+        self.sync_interval = sync_interval
+        self._pending = deque()
+        self._jobs = {}
+        self._running = 0
+        self._cond = threading.Condition()
+        self._threads = []
+        self._sync_thread = None
+
+    def _start_workers(self):
+        """Start the worker threads (and the store's sync thread) on first use"""
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._worker, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        if self.store is not None and self._sync_thread is None:
+            self._sync_thread = threading.Thread(target=self._sync_loop, daemon=True)
+            self._sync_thread.start()
+
+    def submit(self, func, *args, group=None, **kwargs):
+        """Queue func(*args, **kwargs) and return the Job tracking it"""
+        with self._cond:
+            self._expire_finished()
+            if len(self._pending) >= self.max_pending:
+                raise QueueFullError("Generation queue is full, please try again shortly")
+
+            job = Job(func, args, kwargs, group)
+            self._jobs[job.id] = job
+            self._pending.append(job)
+            self._start_workers()
+            self._cond.notify()
+        self._save(job)
+        return job
+
+    def get(self, job_id):
+        """
+        Return the job with the given id, or None if unknown or expired
+
+        Jobs of other processes are returned as snapshots from the store;
+        get them again to see later progress.
+        """
+        with self._cond:
+            job = self._jobs.get(job_id)
+        if job is None and self.store is not None:
+            job = self.store.load(job_id)
+        return job
+
+    def cancel(self, job_id):
+        """
+        Cancel a job
+
+        Queued jobs are removed immediately. Running jobs are flagged and
+        stop at their next check_cancelled() call. Returns False if the job
+        is unknown or already finished.
+        """
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if job is None:
+                # Running in another process, which picks the request up
+                return self.store is not None and self.store.request_cancel(job_id)
+            if job.done:
+                return False
+            job.cancel_requested = True
+            if job.status == "queued":
+                self._pending.remove(job)
+                job.status = "cancelled"
+                job.error = "Generation was cancelled"
+                job.finished_at = time.time()
+                job.args = job.kwargs = None
+        self._save(job)
+        return True
+
+    def position(self, job):
+        """Return how many jobs are ahead of a queued job (0 once running)"""
+        with self._cond:
+            if job.id not in self._jobs:
+                return job.queue_position
+            try:
+                return self._pending.index(job)
+            except ValueError:
+                return 0
+
+    def stats(self):
+        """Return the current queue depth and number of busy workers"""
+        with self._cond:
+            return {
+                'pending': len(self._pending),
+                'running': self._running,
+                'workers': self.workers,
+                'max_pending': self.max_pending
+            }
+
+    def _expire_finished(self):
+        """Forget finished jobs older than result_ttl (caller holds the lock)"""
+        cutoff = time.time() - self.result_ttl
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job.done and job.finished_at < cutoff]
+        for job_id in expired:
+            del self._jobs[job_id]
+        if self.store is not None:
+            self.store.expire(cutoff)
+
+    def _save(self, job):
+        if self.store is None:
+            return
+        try:
+            self.store.save(job, self.position(job))
+        except sqlite3.Error as e:
+            print(f"⚠️ Could not save the state of job {job.id}: {str(e)}")
+
+    def _sync_loop(self):
+        """Write the state of this process's unfinished jobs and apply cancellations from other processes"""
+        while True:
+            time.sleep(self.sync_interval)
+            with self._cond:
+                active = [job for job in self._jobs.values() if not job.done]
+            for job in active:
+                self._save(job)
+            try:
+                flagged = self.store.cancel_requested([job.id for job in active if not job.cancel_requested])
+            except sqlite3.Error as e:
+                print(f"⚠️ Could not read job cancellations: {str(e)}")
+                continue
+            for job_id in flagged:
+                self.cancel(job_id)
+
+    def _next_job(self):
+        """Pick the next job to run (caller holds the lock)"""
+        oldest = self._pending[0]
+        if self.preferred_group is None or time.time() - oldest.created_at > self.max_group_wait:
+            return self._pending.popleft()
+
+        preferred = self.preferred_group()
+        for job in self._pending:
+            if job.group is None or job.group == preferred:
+                self._pending.remove(job)
+                return job
+        return self._pending.popleft()
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                job = self._next_job()
+                job.status = "running"
+                job.started_at = time.time()
+                self._running += 1
+            self._save(job)
+
+            _local.job = job
+            try:
+                result = job.func(*job.args, **job.kwargs)
+                status, error = "completed", None
+            except JobCancelled as e:
+                result, status, error = None, "cancelled", str(e)
+            except Exception as e:
+                traceback.print_exc()
+                result, status, error = None, "failed", str(e)
+            finally:
+                _local.job = None
+
+            with self._cond:
+                job.result = result
+                job.error = error
+                job.status = status
+                job.finished_at = time.time()
+                self._running -= 1
+                # Drop references to the request arguments
+                job.args = job.kwargs = None
+            self._save(job)
+
+class AsyncJobQueue:
+    """
+    asyncio counterpart of JobQueue, used by the ASGI app
+
+    Jobs are coroutine functions run as tasks on the event loop, at most
+    `workers` at a time, so a job waiting on a backend holds no thread.
+    Backpressure, result retention and cancellation work as in JobQueue;
+    cancelling a running job also cancels its task. Jobs run in order of
+    submission (groups are not used).
+    """
+
+    def __init__(self, workers=2, max_pending=32, result_ttl=3600):
+        self.workers = max(1, workers)
+        self.max_pending = max_pending
+        self.result_ttl = result_ttl
+        self._pending = deque()
+        self._jobs = {}
+        self._tasks = {}
+        self._running = 0
+        self._slots = None
+
+    def submit(self, func, *args, group=None, **kwargs):
+        """Schedule await func(*args, **kwargs) and return the Job tracking it"""
+        self._expire_finished()
+        if len(self._pending) >= self.max_pending:
+            raise QueueFullError("Generation queue is full, please try again shortly")
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.workers)
+
+        job = Job(func, args, kwargs, group)
+        self._jobs[job.id] = job
+        self._pending.append(job)
+        self._tasks[job.id] = asyncio.ensure_future(self._run(job))
+        return job
+
+    def get(self, job_id):
+        """Return the job with the given id, or None if unknown or expired"""
+        return self._jobs.get(job_id)
+
+    def cancel(self, job_id):
+        """Cancel a queued or running job; returns False if it is unknown or finished"""
+        job = self._jobs.get(job_id)
+        if job is None or job.done:
+            return False
+        job.cancel_requested = True
+        task = self._tasks.get(job_id)
+        if task is not None:
+            task.cancel()
+        return True
+
+    def position(self, job):
+        """Return how many jobs are ahead of a queued job (0 once running)"""
+        try:
+            return self._pending.index(job)
+        except ValueError:
+            return 0
+
+    def stats(self):
+        """Return the current queue depth and number of busy workers"""
+        return {
+            'pending': len(self._pending),
+            'running': self._running,
+            'workers': self.workers,
+            'max_pending': self.max_pending
+        }
+
+    def _expire_finished(self):
+        cutoff = time.time() - self.result_ttl
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job.done and job.finished_at < cutoff]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    async def _run(self, job):
+        result, error = None, None
+        started = False
+        try:
+            async with self._slots:
+                self._pending.remove(job)
+                started = True
+                job.status = "running"
+                job.started_at = time.time()
+                self._running += 1
+                _current_task_job.set(job)
+                try:
+                    result = await job.func(*job.args, **job.kwargs)
+                    status = "completed"
+                finally:
+                    self._running -= 1
+        except (JobCancelled, asyncio.CancelledError):
+            status, error = "cancelled", "Generation was cancelled"
+        except Exception as e:
+            traceback.print_exc()
+            status, error = "failed", str(e)
+        finally:
+            if not started and job in self._pending:
+                self._pending.remove(job)
+            self._tasks.pop(job.id, None)
+
+        job.result = result
+        job.error = error
+        job.status = status
+        job.finished_at = time.time()
+        # Drop references to the request arguments
+        job.args = job.kwargs = None
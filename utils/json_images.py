@@ -0,0 +1,137 @@
+"""
+Incremental extraction of base64 images from a streamed JSON response
+"""
+import binascii
+
+class _Base64Buffer:
+    """Decodes base64 text piece by piece into a preallocated buffer"""
+
+    def __init__(self, size_hint):
+        self.buffer = bytearray(max(size_hint, 1024))
+        self.length = 0
+        self.pending = b""
+
+    def feed(self, text):
+        """Decode every complete 4-character group of text"""
+        text = self.pending + text.replace(b"\\", b"")  # JSON may escape "/" as "\/"
+        usable = len(text) - len(text) % 4
+        self.pending = text[usable:]
+        if usable:
+            self._write(binascii.a2b_base64(text[:usable]))
+
+    def _write(self, data):
+        end = self.length + len(data)
+        if end > len(self.buffer):
+            # The hint was too small; grow geometrically
+            self.buffer.extend(bytearray(max(end - len(self.buffer), len(self.buffer))))
+        self.buffer[self.length:end] = data
+        self.length = end
+
+    def finish(self):
+        """Return a view of the decoded bytes"""
+        if self.pending:
+            self._write(binascii.a2b_base64(self.pending))
+            self.pending = b""
+        return memoryview(self.buffer)[:self.length]
+
+class Base64ArrayParser:
+    """
+    Push-based extraction of a JSON array of base64 strings
+
+    Scans the raw response body for "<key>": [ ... ] without parsing the
+    rest of the document, so a multi-megabyte response never has to be held
+    as text or Python strings. Each item is decoded into its own buffer,
+    preallocated to size_hint bytes. feed() works with any source of chunks,
+    including async responses.
+    """
+
+    def __init__(self, key=b"images", size_hint=0):
+        self.key = key
+        self.size_hint = size_hint
+        self.marker = b'"' + key + b'"'
+        self.data = b""
+        self.state = "key"  # key -> open -> items -> string -> ... -> done
+        self.decoder = None
+
+    @property
+    def done(self):
+        return self.state == "done"
+
+    def feed(self, chunk):
+        """Consume a chunk of the body and return the items it completed, as memoryviews"""
+        items = []
+        if self.done:
+            return items
+        data = self.data + chunk
+        key = self.key
+
+        while data:
+            if self.state == "key":
+                index = data.find(self.marker)
+                if index < 0:
+                    # Keep a tail in case the marker spans two chunks
+                    data = data[-len(self.marker):]
+                    break
+                data = data[index + len(self.marker):]
+                self.state = "open"
+            elif self.state == "open":
+                data = data.lstrip(b" \t\r\n:")
+                if not data:
+                    break
+                if data[:1] != b"[":
+                    raise ValueError(f"Expected an array for {key.decode()}")
+                data = data[1:]
+                self.state = "items"
+            elif self.state == "items":
+                data = data.lstrip(b" \t\r\n,")
+                if not data:
+                    break
+                if data[:1] == b"]":
+                    self.state = "done"
+                    data = b""
+                    break
+                if data[:1] != b'"':
+                    raise ValueError(f"Expected base64 strings in {key.decode()}")
+                data = data[1:]
+                self.decoder = _Base64Buffer(self.size_hint)
+                self.state = "string"
+            else:
+                end = data.find(b'"')
+                if end < 0:
+                    # Don't split an escape sequence across chunks
+                    keep = 1 if data.endswith(b"\\") else 0
+                    self.decoder.feed(data[:len(data) - keep])
+                    data = data[len(data) - keep:]
+                    break
+                self.decoder.feed(data[:end])
+                data = data[end + 1:]
+                items.append(self.decoder.finish())
+                self.decoder = None
+                self.state = "items"
+
+        self.data = data
+        return items
+
+    def close(self):
+        """Check that the body ended outside the array (or never contained it)"""
+        if self.state not in ("key", "done"):
+            raise ValueError("Response ended inside the image array")
+
+def iter_base64_array(chunks, key=b"images", size_hint=0):
+    """
+    Yield the decoded items of a JSON array of base64 strings as it streams in
+
+    See Base64ArrayParser; each item is yielded as a memoryview once its
+    closing quote arrives.
+
+    Args:
+        chunks: Iterable of bytes, e.g. response.iter_content()
+        key (bytes): Name of the array field
+        size_hint (int): Expected decoded size of one item
+    """
+    parser = Base64ArrayParser(key, size_hint)
+    for chunk in chunks:
+        yield from parser.feed(chunk)
+        if parser.done:
+            return
+    parser.close()
@@ -0,0 +1,196 @@
+"""
+Background downloads of Ollama models with progress, shared between workers
+"""
+import os
+import time
+import uuid
+import sqlite3
+import threading
+import traceback
+
+class PullManager:
+    """
+    Runs model pulls in the background and tracks their progress
+
+    pull_func(name, report) performs the download, calling
+    report(completed_bytes, total_bytes, detail) as progress arrives, and
+    raises on failure. At most max_concurrent pulls run at once in this
+    process; further ones wait with the detail "queued".
+
+    State is kept in a SQLite database so every worker process sees the
+    same pulls and restarts don't lose them. A pull is owned by the process
+    that started it, which writes its progress every second or so; a second
+    request for the same model joins it instead of starting another
+    download. Pulls whose owner stopped heartbeating (e.g. because it was
+    restarted) are resumed by the next process to look at them, and Ollama
+    continues from the layers it already has.
+    """
+
+    def __init__(self, pull_func, path=":memory:", max_concurrent=1, stale_after=60):
+        self.pull_func = pull_func
+        self.stale_after = stale_after
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._slots = threading.Semaphore(max(1, max_concurrent))
+        # Latest progress of this process's pulls; the heartbeat writes it to the database
+        self._active = {}
+        self._lock = threading.Lock()
+        self._resumed = False
+        self._heartbeat = None
+
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS pulls "
+            "(name TEXT PRIMARY KEY, status TEXT NOT NULL, detail TEXT, completed INTEGER NOT NULL, "
+            "total INTEGER NOT NULL, error TEXT, owner TEXT, updated_at REAL NOT NULL)"
+        )
+
+    def start(self, name):
+        """Start pulling name unless a live pull exists; return its status()"""
+        self._resume_interrupted()
+        if self._claim(name, resume_only=False):
+            self._launch(name)
+        return self.status(name)
+
+    def status(self, name):
+        """
+        Return the state of a model's pull, or None if it was never pulled
+
+        The dict has 'status' ("pulling", "completed" or "failed"), 'detail'
+        (Ollama's status line), 'completed' and 'total' bytes, 'percent'
+        (None until the size is known) and 'error'.
+        """
+        self._resume_interrupted()
+        state, stale = self._read(name)
+        if stale and self._claim(name, resume_only=True):
+            print(f"Resuming interrupted pull of model {name}")
+            self._launch(name)
+            state, stale = self._read(name)
+        if state is None:
+            return None
+
+        state['percent'] = round(100 * state['completed'] / state['total'], 1) if state['total'] else None
+        return state
+
+    def _read(self, name):
+        """Return a pull's state (None if unknown) and whether its owner stopped heartbeating"""
+        with self._lock:
+            state = self._active.get(name)
+            if state is not None:
+                return dict(state), False
+            row = self._db.execute(
+                "SELECT status, detail, completed, total, error, updated_at FROM pulls WHERE name = ?", (name,)
+            ).fetchone()
+        if row is None:
+            return None, False
+        state = dict(zip(('status', 'detail', 'completed', 'total', 'error'), row))
+        return state, state['status'] == "pulling" and time.time() - row[5] >= self.stale_after
+
+    def active(self):
+        """Return the number of pulls this process is running or has queued"""
+        with self._lock:
+            return len(self._active)
+
+    def _claim(self, name, resume_only):
+        """
+        Take ownership of a pull unless another process's pull of it is alive
+
+        With resume_only only interrupted pulls are claimed.
+        """
+        now = time.time()
+        with self._lock:
+            if name in self._active:
+                return False
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._db.execute(
+                    "SELECT status, updated_at FROM pulls WHERE name = ?", (name,)
+                ).fetchone()
+                pulling = row is not None and row[0] == "pulling"
+                alive = pulling and now - row[1] < self.stale_after
+                if alive or (resume_only and not pulling):
+                    self._db.execute("COMMIT")
+                    return False
+                self._db.execute(
+                    "INSERT OR REPLACE INTO pulls (name, status, detail, completed, total, error, owner, updated_at) "
+                    "VALUES (?, 'pulling', 'queued', 0, 0, NULL, ?, ?)",
+                    (name, self.owner, now)
+                )
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+            self._active[name] = {'status': 'pulling', 'detail': 'queued', 'completed': 0, 'total': 0, 'error': None}
+        self._start_heartbeat()
+        return True
+
+    def _launch(self, name):
+        thread = threading.Thread(target=self._run, args=(name,), daemon=True)
+        thread.start()
+
+    def _run(self, name):
+        def report(completed, total, detail):
+            # Written to the database by the heartbeat
+            with self._lock:
+                self._active[name].update(completed=completed, total=total, detail=detail)
+
+        with self._slots:
+            report(0, 0, "starting")
+            try:
+                print(f"Starting pull of model {name}...")
+                self.pull_func(name, report)
+                print(f"✅ Successfully pulled {name}")
+                status, error = "completed", None
+            except Exception as e:
+                traceback.print_exc()
+                print(f"❌ Error pulling model {name}: {str(e)}")
+                status, error = "failed", str(e)
+
+        # Stored and forgotten together, so a retry seen right after the
+        # failure isn't mistaken for a duplicate of the finished pull
+        with self._lock:
+            self._active[name].update(status=status, error=error)
+            self._store(name)
+            del self._active[name]
+
+    def _write(self, name):
+        """Store the in-memory state of one of this process's pulls"""
+        with self._lock:
+            if name in self._active:
+                self._store(name)
+
+    def _store(self, name):
+        """Write a pull's state to the database; the caller holds the lock"""
+        state = self._active[name]
+        self._db.execute(
+            "UPDATE pulls SET status = ?, detail = ?, completed = ?, total = ?, error = ?, updated_at = ? "
+            "WHERE name = ? AND owner = ?",
+            (state['status'], state['detail'], state['completed'], state['total'], state['error'],
+             time.time(), name, self.owner)
+        )
+
+    def _resume_interrupted(self):
+        """Resume, once per process, pulls whose owner went away"""
+        with self._lock:
+            if self._resumed:
+                return
+            self._resumed = True
+            names = [row[0] for row in self._db.execute("SELECT name FROM pulls WHERE status = 'pulling'")]
+        for name in names:
+            if self._claim(name, resume_only=True):
+                print(f"Resuming interrupted pull of model {name}")
+                self._launch(name)
+
+    def _start_heartbeat(self):
+        with self._lock:
+            if self._heartbeat is None:
+                self._heartbeat = threading.Thread(target=self._heartbeat_loop, daemon=True)
+                self._heartbeat.start()
+
+    def _heartbeat_loop(self):
+        """Write the progress of this process's pulls, which also keeps queued and silent ones alive"""
+        while True:
+            time.sleep(min(1, self.stale_after / 3))
+            with self._lock:
+                names = list(self._active)
+            for name in names:
+                self._write(name)
@@ -0,0 +1,85 @@
+"""
+Encoding of generated images and their preview/thumbnail variants
+"""
+import os
+from io import BytesIO
+from PIL import Image
+
+# Format of the full-size image: png, webp or jpeg
+OUTPUT_FORMAT = os.environ.get('OUTPUT_FORMAT', 'png').lower()
+PNG_COMPRESS_LEVEL = int(os.environ.get('PNG_COMPRESS_LEVEL', '6'))  # 0-9, lower is faster
+WEBP_QUALITY = int(os.environ.get('WEBP_QUALITY', '85'))
+WEBP_LOSSLESS = os.environ.get('WEBP_LOSSLESS', '0') == '1'
+JPEG_QUALITY = int(os.environ.get('JPEG_QUALITY', '90'))
+
+# Smaller variants the UI loads first; a size of 0 disables the variant
+PREVIEW_SIZE = int(os.environ.get('PREVIEW_SIZE', '512'))
+THUMBNAIL_SIZE = int(os.environ.get('THUMBNAIL_SIZE', '256'))
+VARIANT_FORMAT = os.environ.get('VARIANT_FORMAT', 'webp').lower()
+VARIANT_QUALITY = int(os.environ.get('VARIANT_QUALITY', '75'))
+
+EXTENSIONS = {
+    'png': '.png',
+    'webp': '.webp',
+    'jpeg': '.jpg'
+}
+
+def extension(fmt=OUTPUT_FORMAT):
+    """Return the file extension for a format"""
+    if fmt not in EXTENSIONS:
+        raise ValueError(f"Unsupported output format {fmt!r}, expected one of {', '.join(EXTENSIONS)}")
+    return EXTENSIONS[fmt]
+
+def is_encoded(image):
+    """Return True if image is already encoded file contents rather than a PIL image"""
+    return isinstance(image, (bytes, bytearray, memoryview))
+
+def encode(image, fmt=OUTPUT_FORMAT, quality=None):
+    """Encode a PIL image in a format and return the file contents"""
+    buffer = BytesIO()
+    if fmt == 'png':
+        image.save(buffer, format='PNG', compress_level=PNG_COMPRESS_LEVEL)
+    elif fmt == 'webp':
+        if WEBP_LOSSLESS and quality is None:
+            image.save(buffer, format='WEBP', lossless=True)
+        else:
+            image.save(buffer, format='WEBP', quality=quality or WEBP_QUALITY, method=4)
+    elif fmt == 'jpeg':
+        # JPEG has no alpha channel
+        image.convert('RGB').save(buffer, format='JPEG', quality=quality or JPEG_QUALITY, optimize=True)
+    else:
+        extension(fmt)
+    return buffer.getvalue()
+
+def encode_variants(image):
+    """
+    Encode the full image and its preview and thumbnail
+
+    image is a PIL image or encoded PNG bytes. PNG bytes are kept unchanged
+    for the full image when the output format is PNG, so they are only
+    decoded if a smaller variant has to be produced.
+
+    Returns:
+        dict: Variant name ('full', 'preview', 'thumbnail') -> (data, extension)
+    """
+    decoded = None
+    if is_encoded(image):
+        if OUTPUT_FORMAT == 'png':
+            variants = {'full': (image, extension('png'))}
+        else:
+            decoded = Image.open(BytesIO(image))
+            variants = {'full': (encode(decoded), extension())}
+    else:
+        decoded = image
+        variants = {'full': (encode(image), extension())}
+
+    for name, size in (('preview', PREVIEW_SIZE), ('thumbnail', THUMBNAIL_SIZE)):
+        if not size:
+            continue
+        if decoded is None:
+            decoded = Image.open(BytesIO(image))
+        small = decoded.copy()
+        small.thumbnail((size, size))
+        variants[name] = (encode(small, VARIANT_FORMAT, VARIANT_QUALITY), extension(VARIANT_FORMAT))
+
+    return variants
@@ -0,0 +1,69 @@
+"""
+Speed/quality presets shared by the diffusion backends
+"""
+
+# Each preset sets the sampling steps and guidance scale, the Automatic1111
+# sampler and the diffusers scheduler ("default" keeps the checkpoint's own).
+# LCM sampling turns the output of ordinary checkpoints into noise, so
+# lcm_only presets are only used with LCM-distilled (or turbo) checkpoints
+PRESETS = {
+    'turbo': {
+        'description': 'Turbo (4 steps, LCM/turbo checkpoints only)',
+        'steps': 4,
+        'cfg_scale': 1.5,
+        'sampler': 'LCM',
+        'scheduler': 'lcm',
+        'lcm_only': True
+    },
+    'fast': {
+        'description': 'Fast (10 steps)',
+        'steps': 10,
+        'cfg_scale': 7.0,
+        'sampler': 'DPM++ 2M Karras',
+        'scheduler': 'dpmsolver++'
+    },
+    'balanced': {
+        'description': 'Balanced (20 steps)',
+        'steps': 20,
+        'cfg_scale': 7.5,
+        'sampler': 'DPM++ 2M Karras',
+        'scheduler': 'dpmsolver++'
+    },
+    'quality': {
+        'description': 'Quality (30 steps)',
+        'steps': 30,
+        'cfg_scale': 7.5,
+        'sampler': 'DPM++ 2M Karras',
+        'scheduler': 'default'
+    }
+}
+
+# Checkpoint names containing one of these are taken to be LCM-capable,
+# e.g. "SimianLuo/LCM_Dreamshaper_v7" or "stabilityai/sdxl-turbo"
+LCM_CHECKPOINT_TAGS = ('lcm', 'turbo')
+
+def get_preset(name, default='quality'):
+    """Return the settings of a preset, falling back to the default for unknown names"""
+    return PRESETS.get(name) or PRESETS[default]
+
+def is_lcm_checkpoint(name):
+    """Guess from its name whether a checkpoint is distilled for few-step LCM sampling"""
+    name = (name or "").lower()
+    return any(tag in name for tag in LCM_CHECKPOINT_TAGS)
+
+def available_presets(lcm):
+    """Return the presets usable with a checkpoint that is (or isn't) LCM-capable"""
+    return {name: preset for name, preset in PRESETS.items() if lcm or not preset.get('lcm_only')}
+
+def resolve_preset(name, default, lcm):
+    """
+    Return the name of the preset to use for a requested one
+
+    Unknown presets, and LCM-only ones for checkpoints that aren't
+    LCM-capable, are replaced by the default (or "quality" if the default
+    can't be used either).
+    """
+    usable = available_presets(lcm)
+    if name in usable:
+        return name
+    return default if default in usable else 'quality'
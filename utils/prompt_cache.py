@@ -0,0 +1,109 @@
+"""
+Memoization of enhanced prompts
+"""
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+
+class PromptCache:
+    """
+    Bounded LRU cache of enhanced prompts with an optional SQLite layer
+
+    The in-memory layer holds the max_entries most recently used prompts.
+    When a path is given, entries are also written to a SQLite database so
+    they survive restarts and are shared between worker processes; the
+    database keeps at most max_disk_entries rows, dropping the least
+    recently used. Hits are recorded in the database in batches, on the
+    next write or once flush_interval seconds or 100 hits have passed.
+    """
+
+    def __init__(self, max_entries=1024, path=None, max_disk_entries=100000, flush_interval=60):
+        self.max_entries = max_entries
+        self.max_disk_entries = max_disk_entries
+        self.path = path
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        self._writes = 0
+        self.flush_interval = flush_interval
+        # Hits not yet recorded in the database, key -> time of the last one
+        self._used = {}
+        self._flushed_at = time.time()
+
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS prompts "
+                "(key TEXT PRIMARY KEY, value TEXT NOT NULL, used_at REAL NOT NULL)"
+            )
+            self._db.commit()
+
+    def get(self, key):
+        """Return the cached value for key, or None"""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self._mark_used(key)
+                return self._entries[key]
+
+            if self._db is None:
+                return None
+            row = self._db.execute("SELECT value FROM prompts WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self._remember(key, row[0])
+            self._mark_used(key)
+            return row[0]
+
+    def put(self, key, value):
+        """Store a value in memory and, if configured, on disk"""
+        with self._lock:
+            self._remember(key, value)
+            if self._db is None:
+                return
+            self._db.execute(
+                "INSERT OR REPLACE INTO prompts (key, value, used_at) VALUES (?, ?, ?)",
+                (key, value, time.time())
+            )
+            self._used.pop(key, None)
+            self._flush_used()
+            self._writes += 1
+            # Trim the database now and then rather than on every write
+            if self._writes % 100 == 0:
+                self._db.execute(
+                    "DELETE FROM prompts WHERE key NOT IN "
+                    "(SELECT key FROM prompts ORDER BY used_at DESC LIMIT ?)",
+                    (self.max_disk_entries,)
+                )
+            self._db.commit()
+
+    def _mark_used(self, key):
+        """Record a hit, writing the batch to the database when it is due (caller holds the lock)"""
+        if self._db is None:
+            return
+        self._used[key] = time.time()
+        if len(self._used) >= 100 or time.time() - self._flushed_at >= self.flush_interval:
+            self._flush_used()
+            self._db.commit()
+
+    def _flush_used(self):
+        """Write the pending hits' times to the database (caller holds the lock and commits)"""
+        if self._used:
+            self._db.executemany(
+                "UPDATE prompts SET used_at = MAX(used_at, ?) WHERE key = ?",
+                [(used_at, key) for key, used_at in self._used.items()]
+            )
+            self._used.clear()
+        self._flushed_at = time.time()
+
+    def _remember(self, key, value):
+        """Insert into the memory layer (caller holds the lock)"""
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
@@ -0,0 +1,209 @@
+"""
+Renderers for the text and fallback images, runnable in a process pool
+"""
+import os
+import sys
+import types
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from collections import OrderedDict
+import multiprocessing
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+# Worker processes used for rendering (0 renders on the calling thread)
+RENDER_PROCESSES = int(os.environ.get('RENDER_PROCESSES', str(min(4, os.cpu_count() or 1))))
+
+# Layout of the description in render_text_image
+TEXT_IMAGE_MAX_LINES = 15
+TEXT_IMAGE_CHAR_WIDTH = 10  # rough estimate of text width per character
+
+# Vertical gradient shared by both images: top and bottom RGB colors
+GRADIENT_TOP = (100, 150, 200)
+GRADIENT_BOTTOM = (150, 200, 230)
+
+# Prebuilt backgrounds kept per process, keyed by (width, height)
+BACKGROUND_CACHE_SIZE = 16
+
+_pool = None
+_pool_lock = threading.Lock()
+
+# Loaded fonts keyed by size, shared by every render in this process
+_fonts = {}
+_fonts_lock = threading.Lock()
+
+_backgrounds = OrderedDict()
+_backgrounds_lock = threading.Lock()
+
+def get_font(size):
+    """Load Arial at a size once per process, falling back to the default font"""
+    with _fonts_lock:
+        font = _fonts.get(size)
+        if font is None:
+            try:
+                font = ImageFont.truetype("Arial", size)
+            except OSError:
+                font = ImageFont.load_default()
+            _fonts[size] = font
+        return font
+
+def background(width, height):
+    """Return a fresh copy of the gradient background for a size, building it once"""
+    key = (width, height)
+    with _backgrounds_lock:
+        image = _backgrounds.get(key)
+        if image is not None:
+            _backgrounds.move_to_end(key)
+    if image is None:
+        image = gradient_background(width, height)
+        with _backgrounds_lock:
+            _backgrounds[key] = image
+            while len(_backgrounds) > BACKGROUND_CACHE_SIZE:
+                _backgrounds.popitem(last=False)
+    return image.copy()
+
+def gradient_background(width, height):
+    """Build the vertical gradient background as one NumPy array"""
+    top = np.array(GRADIENT_TOP, dtype=np.float64)
+    bottom = np.array(GRADIENT_BOTTOM, dtype=np.float64)
+    fraction = (np.arange(height) / height)[:, None]
+    # Truncate like int() did for the per-row colors
+    rows = (top + fraction * (bottom - top)).astype(np.uint8)
+    pixels = np.broadcast_to(rows[:, None, :], (height, width, 3))
+    return Image.fromarray(np.ascontiguousarray(pixels), 'RGB')
+
+def wrap_text(text, max_width):
+    """Split text into lines of at most max_width (estimated) pixels"""
+    lines = []
+    current_line = ""
+    for word in text.split():
+        test_line = current_line + " " + word if current_line else word
+        # Estimate text width (this is approximate)
+        if len(test_line) * TEXT_IMAGE_CHAR_WIDTH < max_width:
+            current_line = test_line
+        else:
+            lines.append(current_line)
+            current_line = word
+    if current_line:
+        lines.append(current_line)
+    return lines
+
+def text_image_capacity(width):
+    """Return roughly how many description characters render_text_image can show"""
+    chars_per_line = (width - 60) // TEXT_IMAGE_CHAR_WIDTH
+    # One extra line so overflowing text still gets its "..." marker
+    return chars_per_line * (TEXT_IMAGE_MAX_LINES + 1)
+
+def render_text_image(prompt, description, width=512, height=512):
+    """Draw the prompt and a wrapped description on the gradient background"""
+    image = background(width, height)
+    draw = ImageDraw.Draw(image)
+
+    # Add the prompt text to the image
+    draw.text(
+        (width // 2, 50),
+        f"Prompt: {prompt}",
+        font=get_font(24),
+        fill=(255, 255, 255),
+        anchor="mm"
+    )
+
+    # Limit the description to a reasonable number of lines
+    lines = wrap_text(description, width - 60)
+    if len(lines) > TEXT_IMAGE_MAX_LINES:
+        lines = lines[:TEXT_IMAGE_MAX_LINES - 1] + ["..."]
+
+    caption_font = get_font(16)
+    y_position = 100
+    for line in lines:
+        draw.text((30, y_position), line, font=caption_font, fill=(255, 255, 255))
+        y_position += 24
+
+    return image
+
+def render_fallback_image(prompt, error_message, help_message, width=512, height=512):
+    """Draw an error message, the prompt and a help message on the gradient background"""
+    image = background(width, height)
+    draw = ImageDraw.Draw(image)
+    caption_font = get_font(20)
+
+    draw.text(
+        (width // 2, height // 3),
+        error_message,
+        font=caption_font,
+        fill=(255, 0, 0),
+        anchor="mm"
+    )
+    draw.text(
+        (width // 2, height // 2),
+        f"Prompt: {prompt}",
+        font=get_font(28),
+        fill=(255, 255, 255),
+        anchor="mm"
+    )
+    draw.text(
+        (width // 2, height * 2/3),
+        help_message,
+        font=caption_font,
+        fill=(255, 255, 255),
+        anchor="mm"
+    )
+
+    return image
+
+def _init_worker():
+    """Load the fonts once when a render worker starts"""
+    for size in (16, 24):
+        get_font(size)
+
+def _get_pool():
+    """Start the render pool and all of its workers on first use"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # Forking would copy the web app's threads and their held locks
+            pool = ProcessPoolExecutor(
+                max_workers=RENDER_PROCESSES,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker
+            )
+            # Spawned workers re-run the __main__ module (e.g. app_hf.py and
+            # all its module-level setup) unless it has no file, so start
+            # them all now with a bare __main__ in its place. Afterwards they
+            # only import this module and the functions they are sent.
+            main = sys.modules['__main__']
+            sys.modules['__main__'] = types.ModuleType('__main__')
+            try:
+                started = [pool.submit(os.getpid) for _ in range(RENDER_PROCESSES)]
+            finally:
+                sys.modules['__main__'] = main
+            for future in started:
+                future.result()
+            _pool = pool
+        return _pool
+
+def render(func, *args):
+    """
+    Run one of the render functions and return its image
+
+    Rendering happens in the process pool so concurrent requests don't
+    serialize on the GIL. If the pool is disabled or broken the image is
+    rendered on the calling thread instead.
+    """
+    if RENDER_PROCESSES > 0:
+        try:
+            return _get_pool().submit(func, *args).result()
+        except BrokenProcessPool as e:
+            # A worker died; start a fresh pool next time
+            print(f"⚠️ Render pool failed, rendering in-process: {str(e)}")
+            shutdown()
+    return func(*args)
+
+def shutdown():
+    """Stop the render pool"""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False)
+            _pool = None
@@ -0,0 +1,129 @@
+"""
+Content-addressed cache of generated images
+"""
+import json
+import time
+import hashlib
+import threading
+from io import BytesIO
+from utils.storage import LocalStorage, collect
+
+def normalize_prompt(prompt):
+    """Collapse case and whitespace so trivially different prompts share an entry"""
+    return " ".join((prompt or "").lower().split())
+
+def cache_key(**fields):
+    """Hash the generation parameters into a cache key"""
+    encoded = json.dumps(fields, sort_keys=True, default=str)
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+class ResultCache:
+    """
+    Maps a hash of the generation parameters to a stored image file
+
+    Entries are files named after their key, kept in a directory or any
+    utils.storage backend, so the cache survives restarts and can be shared
+    by several worker processes. Entries live below prefix, optionally in
+    hash-sharded subdirectories, and use the cache's extension unless
+    another one is given, e.g. for the preview variants of an image.
+    put_content() stores data under the hash of its contents instead, for
+    files whose URLs must never change what they point to. A hit refreshes
+    the file's modification time once it is older than refresh_after
+    seconds, so hot entries aren't rewritten on every hit (a server-side
+    copy on S3); eviction removes the least recently used files once
+    max_entries or max_bytes is exceeded, and any entry unused for max_age
+    seconds. When an entry is several files, entry_extension names the one
+    file per entry that counts toward max_entries. With evict_on_put=False
+    eviction is left to a background task calling evict().
+    """
+
+    def __init__(self, storage, max_entries=1000, max_bytes=1024 * 1024 * 1024,
+                 max_age=7 * 24 * 3600, extension=".png", prefix="", shard=False,
+                 evict_on_put=True, refresh_after=3600, entry_extension=None):
+        if isinstance(storage, str):
+            storage = LocalStorage(storage)
+        self.storage = storage
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.extension = extension
+        self.prefix = prefix
+        self.shard = shard
+        self.evict_on_put = evict_on_put
+        self.refresh_after = refresh_after
+        self.entry_extension = entry_extension
+        self._lock = threading.Lock()
+
+    def filename(self, key, extension=None):
+        """Return the storage name of an entry"""
+        name = f"{key}{extension or self.extension}"
+        if self.shard:
+            # Keys are hashes, so their first characters spread entries evenly
+            name = f"{key[:2]}/{key[2:4]}/{name}"
+        return f"{self.prefix}/{name}" if self.prefix else name
+
+    def path(self, key, extension=None):
+        return self.storage.path(self.filename(key, extension))
+
+    def get(self, key, extension=None):
+        """Return the path of a cached image, or None on a miss"""
+        name = self.filename(key, extension)
+        stat = self.storage.stat(name)
+        if stat is None:
+            return None
+        age = time.time() - stat[1]
+        try:
+            if age > self.max_age:
+                self.storage.delete(name)
+                return None
+            if age > self.refresh_after:
+                # Mark the entry as recently used
+                self.storage.touch(name)
+        except OSError:
+            return None
+        return self.storage.path(name)
+
+    def open(self, key, extension=None):
+        """Open a cached image for reading"""
+        return self.storage.open(self.filename(key, extension))
+
+    def put(self, key, image, extension=None):
+        """
+        Store an image under a key and return its path
+
+        Args:
+            key (str): Cache key from cache_key()
+            image: A PIL image, or the already encoded file contents as bytes
+            extension (str): File extension, defaults to the cache's own
+        """
+        if not isinstance(image, (bytes, bytearray, memoryview)):
+            buffer = BytesIO()
+            image.save(buffer, format="PNG")
+            image = buffer.getvalue()
+
+        name = self.storage.put(self.filename(key, extension), image)
+        if self.evict_on_put:
+            self.evict()
+        return self.storage.path(name)
+
+    def put_content(self, data, extension=None):
+        """Store encoded file contents under their SHA-256 and return that key"""
+        key = hashlib.sha256(data).hexdigest()
+        if self.get(key, extension) is None:
+            self.put(key, data, extension)
+        return key
+
+    def evict(self):
+        """Remove expired entries, then the least recently used ones over the limits"""
+        counted = None
+        if self.entry_extension:
+            counted = lambda name: name.endswith(self.entry_extension)
+        with self._lock:
+            return collect(
+                self.storage,
+                self.prefix,
+                max_entries=self.max_entries,
+                max_bytes=self.max_bytes,
+                max_age=self.max_age,
+                counted=counted
+            )
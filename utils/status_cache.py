@@ -0,0 +1,104 @@
+"""
+TTL cache for backend health and model status checks
+"""
+import time
+import threading
+import traceback
+
+class _Entry:
+    """Cached result of one probe"""
+
+    def __init__(self, probe):
+        self.probe = probe
+        self.value = None
+        self.updated_at = None
+        # Held while the probe runs so a service is never probed twice at once
+        self.probe_lock = threading.Lock()
+
+class StatusCache:
+    """
+    Cache of status probes that is refreshed in the background
+
+    Each probe is a function performing the actual health-check request.
+    Reads return the last known value without any network I/O; stale
+    values are refreshed by a background thread every ttl seconds or on
+    invalidate(). Only the very first read of a probe runs it inline.
+    """
+
+    def __init__(self, ttl=30):
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._refresher = None
+
+    def register(self, name, probe):
+        """Register a probe function under a name"""
+        with self._lock:
+            self._entries[name] = _Entry(probe)
+
+    def get(self, name):
+        """Return the cached value of a probe"""
+        entry = self._entries[name]
+        self._start_refresher()
+
+        if entry.updated_at is None:
+            # Nothing cached yet, so the first caller has to wait for a probe
+            with entry.probe_lock:
+                if entry.updated_at is None:
+                    self._run_probe(entry)
+        elif time.time() - entry.updated_at > self.ttl:
+            self._refresh_in_background(name)
+
+        return entry.value
+
+    def refresh(self, name, blocking=True):
+        """
+        Run a probe now and store its result
+
+        With blocking=False the call returns immediately if another thread
+        is already refreshing the same probe.
+        """
+        entry = self._entries[name]
+        if not entry.probe_lock.acquire(blocking=blocking):
+            return
+        try:
+            self._run_probe(entry)
+        finally:
+            entry.probe_lock.release()
+
+    def invalidate(self, name, wait=False):
+        """Mark a cached value as stale and re-probe it"""
+        entry = self._entries[name]
+        if entry.updated_at is not None:
+            entry.updated_at = 0
+
+        if wait:
+            self.refresh(name)
+        else:
+            self._refresh_in_background(name)
+
+    def _run_probe(self, entry):
+        """Call a probe, keeping the previous value if it raises (caller holds probe_lock)"""
+        try:
+            entry.value = entry.probe()
+        except Exception:
+            traceback.print_exc()
+        entry.updated_at = time.time()
+
+    def _refresh_in_background(self, name):
+        thread = threading.Thread(target=self.refresh, args=(name, False), daemon=True)
+        thread.start()
+
+    def _start_refresher(self):
+        """Start the periodic refresh thread on first use"""
+        with self._lock:
+            if self._refresher is not None:
+                return
+            self._refresher = threading.Thread(target=self._refresh_loop, daemon=True)
+            self._refresher.start()
+
+    def _refresh_loop(self):
+        while True:
+            time.sleep(self.ttl)
+            for name in list(self._entries):
+                self.refresh(name, blocking=False)
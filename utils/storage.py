@@ -0,0 +1,327 @@
+"""
+Storage backends for generated images
+"""
+import os
+import time
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+# Backend selection and retention
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'local')
+STORAGE_GC_INTERVAL = int(os.environ.get('STORAGE_GC_INTERVAL', '600'))
+
+# S3-compatible backend configuration (AWS, MinIO, ...)
+S3_BUCKET = os.environ.get('S3_BUCKET')
+S3_PREFIX = os.environ.get('S3_PREFIX', '')
+S3_ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL')
+S3_PUBLIC_URL = os.environ.get('S3_PUBLIC_URL')  # Serve objects from here instead of through the app
+
+CONTENT_TYPES = {
+    '.png': 'image/png',
+    '.webp': 'image/webp',
+    '.jpg': 'image/jpeg',
+    '.json': 'application/json'
+}
+
+def shard_name(name, scheme="hash", prefix=""):
+    """
+    Place a file name in a sharded directory
+
+    "hash" spreads names over 256 * 256 directories by a hash of the name,
+    "date" groups them by day (which also makes age-based cleanup cheap to
+    reason about) and "none" keeps them flat.
+    """
+    if scheme == "hash":
+        digest = hashlib.sha256(name.encode("utf-8")).hexdigest()
+        name = f"{digest[:2]}/{digest[2:4]}/{name}"
+    elif scheme == "date":
+        name = f"{time.strftime('%Y/%m/%d')}/{name}"
+    return f"{prefix}/{name}" if prefix else name
+
+class LocalStorage:
+    """Stores files below a directory on the local filesystem"""
+
+    def __init__(self, root, etag_cache_size=4096):
+        self.root = os.path.abspath(root)
+        # Content hashes keyed by path, remembered with the file's mtime and size
+        self._etags = OrderedDict()
+        self._etags_lock = threading.Lock()
+        self.etag_cache_size = etag_cache_size
+
+    def path(self, name):
+        """Return the filesystem path of a stored file"""
+        path = os.path.abspath(os.path.join(self.root, name))
+        if not path.startswith(self.root + os.sep):
+            raise ValueError(f"Invalid storage name {name!r}")
+        return path
+
+    def local_path(self, name):
+        return self.path(name)
+
+    def url(self, name):
+        """Local files are served by the app"""
+        return None
+
+    def put(self, name, data):
+        """Store data under name, atomically replacing any existing file"""
+        path = self.path(name)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+
+        # Write to a temporary file first so readers never see a partial image
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return name
+
+    def open(self, name):
+        """Open a stored file for reading"""
+        return open(self.path(name), "rb")
+
+    def stat(self, name):
+        """Return (size, modification time) of a stored file, or None if it is missing"""
+        try:
+            stat = os.stat(self.path(name))
+        except OSError:
+            return None
+        return stat.st_size, stat.st_mtime
+
+    def etag(self, name):
+        """Return a strong ETag (SHA-256 of the contents) for a stored file, or None if it is missing"""
+        path = self.path(name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        # put() replaces files atomically, so new contents get a new inode,
+        # while touching a file to mark it as recently used keeps its ETag
+        version = (stat.st_dev, stat.st_ino, stat.st_size)
+
+        with self._etags_lock:
+            cached = self._etags.get(path)
+            if cached and cached[0] == version:
+                self._etags.move_to_end(path)
+                return cached[1]
+
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(256 * 1024), b""):
+                digest.update(chunk)
+        etag = digest.hexdigest()
+
+        with self._etags_lock:
+            self._etags[path] = (version, etag)
+            while len(self._etags) > self.etag_cache_size:
+                self._etags.popitem(last=False)
+        return etag
+
+    def touch(self, name):
+        os.utime(self.path(name))
+
+    def delete(self, name):
+        try:
+            os.remove(self.path(name))
+        except OSError:
+            pass
+
+    def list(self, prefix=""):
+        """Yield (name, size, modification time) for the files below prefix"""
+        top = os.path.join(self.root, prefix) if prefix else self.root
+        for directory, _, files in os.walk(top):
+            for filename in files:
+                if filename.endswith(".tmp"):
+                    continue
+                path = os.path.join(directory, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                name = os.path.relpath(path, self.root).replace(os.sep, "/")
+                yield name, stat.st_size, stat.st_mtime
+
+class S3Storage:
+    """
+    Stores files as objects in an S3-compatible bucket
+
+    Requires boto3. endpoint_url points the client at a non-AWS server
+    such as MinIO, or client passes in an already configured one. When
+    public_url is set, clients fetch objects from there directly; otherwise
+    the app streams them. Request errors are raised as OSError, like the
+    local backend's.
+    """
+
+    def __init__(self, bucket, prefix="", endpoint_url=None, public_url=None, client=None):
+        if client is None:
+            try:
+                import boto3
+            except ImportError:
+                raise Exception("The S3 storage backend requires boto3 (pip install boto3)")
+            client = boto3.client("s3", endpoint_url=endpoint_url)
+
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+        self.public_url = public_url.rstrip("/") if public_url else None
+        self.client = client
+
+    def key(self, name):
+        return f"{self.prefix}/{name}" if self.prefix else name
+
+    def path(self, name):
+        return f"s3://{self.bucket}/{self.key(name)}"
+
+    def local_path(self, name):
+        return None
+
+    def url(self, name):
+        return f"{self.public_url}/{self.key(name)}" if self.public_url else None
+
+    def put(self, name, data):
+        content_type = CONTENT_TYPES.get(os.path.splitext(name)[1], "application/octet-stream")
+        self.client.put_object(Bucket=self.bucket, Key=self.key(name), Body=bytes(data), ContentType=content_type)
+        return name
+
+    def open(self, name):
+        """Return a streaming body for an object"""
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=self.key(name))["Body"]
+        except self.client.exceptions.NoSuchKey:
+            raise FileNotFoundError(name)
+
+    def stat(self, name):
+        try:
+            head = self.client.head_object(Bucket=self.bucket, Key=self.key(name))
+        except Exception:
+            return None
+        return head["ContentLength"], head["LastModified"].timestamp()
+
+    def etag(self, name):
+        """Return the object's ETag, or None if it is missing"""
+        try:
+            head = self.client.head_object(Bucket=self.bucket, Key=self.key(name))
+        except Exception:
+            return None
+        return head["ETag"].strip('"')
+
+    def touch(self, name):
+        """
+        Refresh an object's modification time
+
+        S3 can only do that by copying the object onto itself, which needs
+        its content type and metadata restated, so this costs a HEAD and a
+        server-side copy; ResultCache calls it sparingly.
+        """
+        key = self.key(name)
+        try:
+            head = self.client.head_object(Bucket=self.bucket, Key=key)
+            self.client.copy_object(
+                Bucket=self.bucket,
+                Key=key,
+                CopySource={"Bucket": self.bucket, "Key": key},
+                MetadataDirective="REPLACE",
+                ContentType=head.get("ContentType", "application/octet-stream"),
+                Metadata=head.get("Metadata", {})
+            )
+        except self.client.exceptions.ClientError as e:
+            raise OSError(f"Could not touch {key}: {str(e)}")
+
+    def delete(self, name):
+        try:
+            self.client.delete_object(Bucket=self.bucket, Key=self.key(name))
+        except self.client.exceptions.ClientError as e:
+            raise OSError(f"Could not delete {self.key(name)}: {str(e)}")
+
+    def list(self, prefix=""):
+        start = len(self.prefix) + 1 if self.prefix else 0
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.key(prefix)):
+            for item in page.get("Contents", []):
+                yield item["Key"][start:], item["Size"], item["LastModified"].timestamp()
+
+def create_storage(root):
+    """Create the storage backend selected by STORAGE_BACKEND"""
+    if STORAGE_BACKEND == 's3':
+        if not S3_BUCKET:
+            raise Exception("STORAGE_BACKEND=s3 requires S3_BUCKET")
+        print(f"Storing images in S3 bucket {S3_BUCKET}")
+        return S3Storage(S3_BUCKET, S3_PREFIX, S3_ENDPOINT_URL, S3_PUBLIC_URL)
+    return LocalStorage(root)
+
+def collect(storage, prefix="", max_entries=None, max_bytes=None, max_age=None, counted=None):
+    """
+    Remove expired files below prefix, then the least recently used ones over the limits
+
+    counted(name) picks the files that count toward max_entries, e.g. one
+    index file per entry made of several files; by default every file does.
+
+    Returns:
+        int: Number of files removed
+    """
+    # Oldest first
+    entries = sorted(storage.list(prefix), key=lambda entry: entry[2])
+    now = time.time()
+    total = sum(size for _, size, _ in entries)
+    count = sum(1 for name, _, _ in entries if counted is None or counted(name))
+    removed = 0
+
+    for name, size, mtime in entries:
+        expired = max_age is not None and now - mtime > max_age
+        over_count = max_entries is not None and count > max_entries
+        over_bytes = max_bytes is not None and total > max_bytes
+        if not (expired or over_count or over_bytes):
+            break
+        storage.delete(name)
+        if counted is None or counted(name):
+            count -= 1
+        total -= size
+        removed += 1
+    return removed
+
+class StorageGC:
+    """
+    Runs retention tasks (e.g. collect() for each storage prefix) periodically
+
+    Tasks run on one daemon thread, started on first use, so cleanup never
+    happens on a request thread.
+    """
+
+    def __init__(self, interval=STORAGE_GC_INTERVAL):
+        self.interval = interval
+        self._tasks = []
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def register(self, task):
+        """Add a callable to run on every collection pass"""
+        self._tasks.append(task)
+
+    def run_once(self):
+        """Run every task once and return the total number of files removed"""
+        removed = 0
+        for task in self._tasks:
+            try:
+                removed += task() or 0
+            except Exception as e:
+                print(f"⚠️ Storage cleanup failed: {str(e)}")
+        if removed:
+            print(f"Storage cleanup removed {removed} file(s)")
+        return removed
+
+    def start(self):
+        """Start the collection thread unless it is already running"""
+        with self._lock:
+            if self._thread is None and self.interval > 0:
+                self._thread = threading.Thread(target=self._loop, daemon=True)
+                self._thread.start()
+
+    def _loop(self):
+        while True:
+            self.run_once()
+            time.sleep(self.interval)